@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+# Standalone LuaJIT post-mortem analysis of the ELF core files.
+# The lj-* commands provided by luajit-gdb.py and luajit_lldb.py are run
+# right against the core file with no debugger involved:
+#
+#   luajit-core.py [--exe <path>] [--layout <path>] <core> <command> [<args>]
+#   luajit-core.py help [<command>]
+#
+# The minidump written by lj-minidump is accepted in place of the core file.
+# The command arguments are joined back into the command line the same as
+# typed in the debugger, so the quotes meant for the command are to be
+# escaped from the shell (e.g. lj-tab <GCtab *> key '"42"').
+#
+# The core file is mapped into memory, so only the pages actually touched
+# by the command are loaded. There is no debug info at hand, so the layout
+# of the LuaJIT structures is taken from the cache filled by luajit-gdb.py
+# or luajit_lldb.py for the same build (see LAYOUT in luajit_dbg.py), i.e.
+# the build is to be loaded once in the debugger with the extension.
+
+import argparse
+import bisect
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+# The objects are decoded by the debugger agnostic core located next to
+# this script.
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import luajit_dbg  # noqa: E402
+
+# ELF {{{
+
+
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+
+ET_CORE = 4
+
+PT_LOAD = 1
+PT_NOTE = 4
+
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+
+NT_GNU_BUILD_ID = 3
+NT_FILE = 0x46494c45
+
+# struct module formats of the ELF records for ELFCLASS32 and ELFCLASS64
+# respectively. Program headers and symbols have the different order of
+# the fields in ELFCLASS32, so they are reordered to the tuples below.
+EHDR_FORMAT = ('16sHHIIIIIHHHHHH', '16sHHIQQQIHHHHHH')
+PHDR_FORMAT = ('IIIIIIII', 'IIQQQQQQ')
+SHDR_FORMAT = ('IIIIIIIIII', 'IIQQQQIIQQ')
+SYM_FORMAT = ('IIIBBH', 'IBBHQQ')
+
+Ehdr = collections.namedtuple('Ehdr', [
+    'ident', 'type', 'machine', 'version', 'entry', 'phoff', 'shoff',
+    'flags', 'ehsize', 'phentsize', 'phnum', 'shentsize', 'shnum',
+    'shstrndx',
+])
+Phdr = collections.namedtuple('Phdr', [
+    'type', 'flags', 'offset', 'vaddr', 'paddr', 'filesz', 'memsz', 'align',
+])
+Shdr = collections.namedtuple('Shdr', [
+    'name', 'type', 'flags', 'addr', 'offset', 'size', 'link', 'info',
+    'addralign', 'entsize',
+])
+Sym = collections.namedtuple('Sym', [
+    'name', 'info', 'other', 'shndx', 'value', 'size',
+])
+
+
+class ELFReader(object):
+    # Decoder of the ELF records read via the given <read> function that
+    # receives the file offset and the size of the data. The same decoder
+    # is used both for the files and for the images in the core memory.
+
+    def __init__(self, read):
+        self.read = read
+        ident = bytearray(read(0, 16))
+        if ident[:4] != bytearray(b'\x7fELF'):
+            raise luajit_dbg.Error('not an ELF file')
+        self.elf64 = ident[4] == ELFCLASS64
+        self.endian = '<' if ident[5] == ELFDATA2LSB else '>'
+        self.ehdr = Ehdr(*self.unpack(EHDR_FORMAT, 0))
+
+    def unpack(self, formats, offset):
+        fmt = self.endian + formats[self.elf64]
+        return struct.unpack(fmt, self.read(offset, struct.calcsize(fmt)))
+
+    def phdrs(self):
+        for i in range(self.ehdr.phnum):
+            fields = self.unpack(PHDR_FORMAT,
+                                 self.ehdr.phoff + i * self.ehdr.phentsize)
+            if not self.elf64:
+                # p_flags follows p_memsz in ELFCLASS32.
+                fields = fields[:1] + fields[6:7] + fields[1:6] + fields[7:]
+            yield Phdr(*fields)
+
+    def shdrs(self):
+        for i in range(self.ehdr.shnum):
+            yield Shdr(*self.unpack(SHDR_FORMAT,
+                                    self.ehdr.shoff + i * self.ehdr.shentsize))
+
+    def notes(self):
+        # The generator yields (<type>, <name>, <desc>) for every note of
+        # every PT_NOTE segment.
+        for phdr in self.phdrs():
+            if phdr.type != PT_NOTE:
+                continue
+            align = phdr.align if phdr.align in (4, 8) else 4
+            offset, end = phdr.offset, phdr.offset + phdr.filesz
+            while offset + 12 <= end:
+                namesz, descsz, ntype = struct.unpack(self.endian + 'III',
+                                                      self.read(offset, 12))
+                offset += 12
+                name = self.read(offset, namesz).rstrip(b'\0')
+                offset += (namesz + align - 1) & ~(align - 1)
+                desc = self.read(offset, descsz)
+                offset += (descsz + align - 1) & ~(align - 1)
+                yield ntype, name, desc
+
+    def build_id(self):
+        for ntype, name, desc in self.notes():
+            if ntype == NT_GNU_BUILD_ID and name == b'GNU':
+                return ''.join('{:02x}'.format(c) for c in bytearray(desc))
+        return None
+
+    def link_vaddr(self):
+        # The address the beginning of the file is linked at, so the load
+        # bias is the difference between the address the file is mapped at
+        # and this one.
+        for phdr in self.phdrs():
+            if phdr.type == PT_LOAD:
+                return phdr.vaddr - phdr.offset
+        return 0
+
+
+class ELFFile(ELFReader):
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            raise luajit_dbg.Error('{}: {}'.format(path, e))
+        ELFReader.__init__(self, self.read_file)
+
+    def read_file(self, offset, size):
+        if offset + size > len(self.data):
+            raise luajit_dbg.Error('{}: truncated ELF file'.format(self.path))
+        return self.data[offset:offset + size]
+
+    def symbols(self):
+        # The generator yields (<name>, <value>) for every defined symbol
+        # from .symtab and .dynsym sections.
+        shdrs = list(self.shdrs())
+        symsize = struct.calcsize(self.endian + SYM_FORMAT[self.elf64])
+        for shdr in shdrs:
+            if shdr.type not in (SHT_SYMTAB, SHT_DYNSYM):
+                continue
+            strtab = shdrs[shdr.link].offset
+            for offset in range(shdr.offset, shdr.offset + shdr.size,
+                                symsize):
+                fields = self.unpack(SYM_FORMAT, offset)
+                if not self.elf64:
+                    fields = fields[:1] + fields[3:] + fields[1:3]
+                sym = Sym(*fields)
+                if not sym.name or not sym.shndx:
+                    continue
+                start = strtab + sym.name
+                end = self.data.find(b'\0', start)
+                yield self.data[start:end].decode('latin-1'), sym.value
+
+
+# }}}
+
+
+# Core file {{{
+
+
+def read_chunks(read_chunk, addr, size):
+    # Read the region that may span several segments (or blocks) via the
+    # given function reading the part of the region within one of them.
+    chunks = []
+    while size > 0:
+        chunk = read_chunk(addr, size)
+        chunks.append(chunk)
+        addr += len(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# The file mapped into the memory of the process (see NT_FILE note).
+FileMapping = collections.namedtuple('FileMapping', [
+    'start', 'end', 'offset', 'path',
+])
+
+
+class CoreFile(ELFFile):
+
+    def __init__(self, path):
+        ELFFile.__init__(self, path)
+        if self.ehdr.type != ET_CORE:
+            raise luajit_dbg.Error('{}: not a core file'.format(path))
+        # PT_LOAD segments are sorted by the address to be looked up via
+        # bisection.
+        self.segments = sorted(
+            (phdr.vaddr, phdr) for phdr in self.phdrs()
+            if phdr.type == PT_LOAD
+        )
+        self.starts = [vaddr for vaddr, _ in self.segments]
+        self.mappings = self.file_mappings()
+        self.files = {}
+
+    def file_mappings(self):
+        mappings = []
+        word = 'Q' if self.elf64 else 'I'
+        wordsize = struct.calcsize(word)
+        for ntype, name, desc in self.notes():
+            if ntype != NT_FILE:
+                continue
+            count, pagesize = struct.unpack_from(self.endian + 2 * word,
+                                                 desc)
+            ranges = struct.unpack_from(
+                '{}{}{}'.format(self.endian, 3 * count, word), desc,
+                2 * wordsize
+            )
+            paths = desc[(2 + 3 * count) * wordsize:].split(b'\0')
+            for i in range(count):
+                start, end, offset = ranges[3 * i:3 * i + 3]
+                mappings.append(FileMapping(start, end, offset * pagesize,
+                                            paths[i].decode('latin-1')))
+        return mappings
+
+    def mapped_file(self, path):
+        if path not in self.files:
+            try:
+                self.files[path] = ELFFile(path).data
+            except luajit_dbg.Error:
+                self.files[path] = None
+        return self.files[path]
+
+    def read_mapped_file(self, addr, size):
+        # The file-backed mappings are not dumped to the core file unless
+        # they are modified (see coredump_filter in core(5)), so the file
+        # itself is read (e.g. for the bytecode of the builtins).
+        for mapping in self.mappings:
+            if mapping.start <= addr and addr + size <= mapping.end:
+                data = self.mapped_file(mapping.path)
+                offset = mapping.offset + addr - mapping.start
+                if data is not None and offset + size <= len(data):
+                    return data[offset:offset + size]
+        return None
+
+    def read_chunk(self, addr, size):
+        # Read the part of the given region within the single segment.
+        index = bisect.bisect_right(self.starts, addr) - 1
+        if index >= 0:
+            vaddr, phdr = self.segments[index]
+            if addr < vaddr + phdr.memsz:
+                size = min(size, vaddr + phdr.memsz - addr)
+                if addr + size <= vaddr + phdr.filesz:
+                    offset = phdr.offset + addr - vaddr
+                    return self.data[offset:offset + size]
+                data = self.read_mapped_file(addr, size)
+                if data is not None:
+                    return data
+        raise luajit_dbg.MemoryReadError(
+            'Cannot access memory at address 0x{:x}'.format(addr)
+        )
+
+    def read_memory(self, addr, size):
+        return read_chunks(self.read_chunk, addr, size)
+
+    def regions(self):
+        # Only the memory dumped to the core file is considered.
+        return [(vaddr, vaddr + phdr.filesz)
+                for vaddr, phdr in self.segments if phdr.filesz]
+
+    def modules(self):
+        # The generator yields (<path>, <address>) for every file mapped
+        # into the memory from its beginning, i.e. for every ELF module.
+        seen = set()
+        for mapping in self.mappings:
+            if mapping.offset == 0 and mapping.path not in seen:
+                seen.add(mapping.path)
+                yield mapping.path, mapping.start
+
+    def module_build_id(self, base):
+        # The first page of every ELF module is dumped to the core file by
+        # default, and the notes are located within the first loadable
+        # segment, i.e. they are mapped right at the file offsets.
+        try:
+            return ELFReader(
+                lambda offset, size: self.read_memory(base + offset, size)
+            ).build_id()
+        except (luajit_dbg.Error, struct.error):
+            return None
+
+
+# }}}
+
+
+# Minidump {{{
+
+
+class MinidumpFile(object):
+    # Reader of the minidump written by lj-minidump (see the format in
+    # luajit_dbg.py). The blocks are decompressed on demand and only the
+    # recently used ones are kept decompressed.
+    CAPACITY = 64
+
+    def __init__(self, path):
+        try:
+            with open(path, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            size = struct.calcsize(luajit_dbg.MINIDUMP_HEADER)
+            _, offset, length = struct.unpack(luajit_dbg.MINIDUMP_HEADER,
+                                              self.data[:size])
+            self.header = json.loads(
+                self.data[offset:offset + length].decode('ascii')
+            )
+        except (IOError, OSError, ValueError, struct.error) as e:
+            raise luajit_dbg.Error('{}: {}'.format(path, e))
+        if self.header.get('version') != luajit_dbg.MINIDUMP_VERSION:
+            raise luajit_dbg.Error('{}: unsupported minidump version'.format(
+                path
+            ))
+        self.blocks = sorted(self.header['blocks'])
+        self.starts = [block[0] for block in self.blocks]
+        self.cache = collections.OrderedDict()
+
+    @staticmethod
+    def detect(path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read(len(luajit_dbg.MINIDUMP_MAGIC)) \
+                    == luajit_dbg.MINIDUMP_MAGIC
+        except (IOError, OSError):
+            return False
+
+    def block(self, index):
+        if index in self.cache:
+            data = self.cache.pop(index)
+        else:
+            _, _, offset, size = self.blocks[index]
+            data = zlib.decompress(self.data[offset:offset + size])
+            while len(self.cache) >= self.CAPACITY:
+                self.cache.popitem(last=False)
+        self.cache[index] = data
+        return data
+
+    def read_chunk(self, addr, size):
+        index = bisect.bisect_right(self.starts, addr) - 1
+        if index >= 0:
+            start, length, _, _ = self.blocks[index]
+            if addr < start + length:
+                offset = addr - start
+                return self.block(index)[offset:offset + size]
+        raise luajit_dbg.MemoryReadError(
+            'Cannot access memory at address 0x{:x}: not in the minidump'
+            .format(addr)
+        )
+
+    def read_memory(self, addr, size):
+        return read_chunks(self.read_chunk, addr, size)
+
+    def regions(self):
+        return [(start, start + length)
+                for start, length, _, _ in self.blocks]
+
+
+# }}}
+
+
+class ImageBackend(luajit_dbg.Backend):
+    # The memory image (i.e. the core file or the minidump) is either
+    # mapped into memory or cached by blocks, so there is nothing to cache.
+    cached = False
+    # There is no debug info at hand, so only the cached layout is used.
+    debuginfo = False
+
+    def __init__(self, image):
+        self.image = image
+
+    def read_memory(self, addr, size):
+        return self.image.read_memory(addr, size)
+
+    def memory_regions(self):
+        return self.image.regions()
+
+    def evaluate(self, expr):
+        # Only the addresses and the names of the pointer globals are
+        # supported with no debug info at hand.
+        try:
+            return int(expr, 0)
+        except ValueError:
+            pass
+        value = self.lookup_global(expr)
+        if value is None:
+            raise luajit_dbg.Error('cannot evaluate {}'.format(expr))
+        return value
+
+
+class CoreBackend(ImageBackend):
+
+    def __init__(self, core, module, base):
+        ImageBackend.__init__(self, core)
+        # The ELF file the symbols are taken from and the address it is
+        # mapped at (None if it's not found in the core file).
+        self.module = module
+        self.base = base
+        self.symbols = None
+
+    def load_symbols(self):
+        if self.symbols is None:
+            self.symbols = {}
+            if self.module is not None:
+                elf = ELFFile(self.module)
+                # The non-PIE executables are linked at the fixed address.
+                bias = self.base - elf.link_vaddr() \
+                    if self.base is not None else 0
+                for name, value in elf.symbols():
+                    self.symbols.setdefault(name, value + bias)
+        return self.symbols
+
+    def lookup_global(self, name):
+        addr = self.load_symbols().get(name)
+        if addr is None:
+            return None
+        return luajit_dbg.read_uint(addr, 8 if self.image.elf64 else 4)
+
+
+class MinidumpBackend(ImageBackend):
+
+    def lookup_global(self, name):
+        # The values of the globals are stored by lj-minidump.
+        return self.image.header['globals'].get(name)
+
+
+def load_layout_file(path):
+    try:
+        with open(path) as f:
+            layout = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise luajit_dbg.Error('{}: {}'.format(path, e))
+    if layout.get('version') != luajit_dbg.LAYOUT_VERSION:
+        raise luajit_dbg.Error('{}: unsupported layout version'.format(path))
+    return layout
+
+
+def find_luajit(core, exe):
+    # Find the LuaJIT module in the core file, i.e. the given executable
+    # (or shared library) or the first module with the cached layout.
+    # Returns the module path, the address it's mapped at, its build-id
+    # and its layout.
+    build_id = ELFFile(exe).build_id() if exe else None
+    for path, base in core.modules():
+        module_build_id = core.module_build_id(base)
+        if exe is not None:
+            if module_build_id == build_id:
+                return exe, base, build_id, luajit_dbg.load_layout(build_id)
+        elif module_build_id is not None:
+            layout = luajit_dbg.load_layout(module_build_id)
+            if layout is not None:
+                return path, base, module_build_id, layout
+    if exe is not None:
+        # The core file has no NT_FILE note (e.g. it's generated by the
+        # ancient kernel), so the executable is considered non-PIE.
+        return exe, None, build_id, luajit_dbg.load_layout(build_id) \
+            if build_id else None
+    raise luajit_dbg.Error(
+        'LuaJIT module with the cached layout is not found, either load '
+        'it once in gdb or lldb with the LuaJIT extension or use --exe'
+    )
+
+
+def configure(args):
+    if MinidumpFile.detect(args.core):
+        # The minidump is self-contained, so --exe is not required.
+        dump = MinidumpFile(args.core)
+        backend = MinidumpBackend(dump)
+        module = args.core
+        build_id = dump.header['build_id']
+        layout = dump.header['layout']
+        endian = dump.header['endian']
+    else:
+        core = CoreFile(args.core)
+        module, base, build_id, layout = find_luajit(core, args.exe)
+        backend = CoreBackend(core, module, base)
+        endian = core.endian
+    if args.layout is not None:
+        layout = load_layout_file(args.layout)
+    if layout is None:
+        raise luajit_dbg.Error(
+            '{}: the layout is not cached, load it once in gdb or lldb '
+            'with the LuaJIT extension or use --layout'.format(module)
+        )
+    luajit_dbg.configure(backend, layout, build_id, endian)
+
+
+def dump_help(names):
+    for name in names:
+        if name not in luajit_dbg.COMMANDS:
+            sys.stderr.write('luajit-core.py: unknown command {}\n'.format(
+                name
+            ))
+            return 1
+        sys.stdout.write(luajit_dbg.COMMANDS[name].__doc__.strip() + '\n\n')
+    return 0
+
+
+def main(argv):
+    if argv[:1] == ['help']:
+        return dump_help(argv[1:] or list(luajit_dbg.COMMANDS.keys()))
+
+    parser = argparse.ArgumentParser(
+        prog='luajit-core.py',
+        description='Run the LuaJIT post-mortem analysis command against '
+                    'the ELF core file.',
+        epilog='Use "luajit-core.py help [<command>]" for the help on the '
+               'commands.',
+    )
+    parser.add_argument('--exe', metavar='PATH',
+                        help='the executable or the shared library with '
+                             'LuaJIT (default: the module with the cached '
+                             'layout)')
+    parser.add_argument('--layout', metavar='PATH',
+                        help='the layout of the LuaJIT structures to be '
+                             'used instead of the cached one')
+    parser.add_argument('--json', action='store_true',
+                        help='emit the newline-delimited JSON records '
+                             'instead of the text')
+    parser.add_argument('core', help='the core file or the minidump')
+    parser.add_argument('command', choices=list(luajit_dbg.COMMANDS.keys()),
+                        metavar='command',
+                        help='one of: ' + ', '.join(luajit_dbg.COMMANDS))
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='the command arguments')
+    args = parser.parse_args(argv)
+
+    try:
+        configure(args)
+        # The arguments are parsed by the command itself (some of them
+        # keep the quotes, see lj-tab), so they're passed as is.
+        arg = ' '.join((['--json'] if args.json else []) + args.args)
+        for chunk in luajit_dbg.run(args.command, arg):
+            sys.stdout.write(chunk)
+        sys.stdout.flush()
+    except luajit_dbg.Error as e:
+        sys.stderr.write('luajit-core.py: {}\n'.format(e))
+        return 1
+    except BrokenPipeError:
+        # The reader of the output is gone (e.g. it's piped to head), so
+        # the rest of the output is dropped silently.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
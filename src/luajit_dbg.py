@@ -0,0 +1,6499 @@
+# Debugger agnostic core of the LuaJIT post-mortem analysis extensions.
+# The LuaJIT objects are decoded from the raw memory read via the pluggable
+# backend (see Backend below), so the same lj-* commands are provided by
+# luajit-gdb.py, luajit_lldb.py and the standalone luajit-core.py.
+
+import argparse
+import array
+import bisect
+import codecs
+import collections
+import heapq
+import json
+import math
+import os
+import random
+import re
+import shlex
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+# make script compatible with the ancient Python {{{
+
+
+LEGACY = re.match(r'^2\.', sys.version)
+
+if LEGACY:
+    int = long
+    range = xrange
+
+
+# }}}
+
+
+# Errors {{{
+
+
+class Error(Exception):
+    # The error reported to the user as is, with no traceback.
+    pass
+
+
+class MemoryReadError(Error):
+    pass
+
+
+# }}}
+
+
+# Backend {{{
+
+
+class Backend(object):
+    # The memory and the debug info of the process being inspected are
+    # accessed only via the backend below. Every frontend (i.e. debugger
+    # extension or CLI) provides its own implementation.
+
+    # Whether the memory read via the backend is to be cached page by page
+    # (see MemoryCache). Backends with no overhead of the memory reads
+    # (e.g. the memory mapped core file) disable it.
+    cached = True
+    # Whether the types layout can be resolved from the debug info (see
+    # resolve_layout). Otherwise, only the cached layout is used.
+    debuginfo = True
+
+    def read_memory(self, addr, size):
+        # Read <size> bytes at <addr>. MemoryReadError is raised if the
+        # memory can't be read.
+        raise NotImplementedError
+
+    def memory_key(self):
+        # The memory cache is dropped when the returned key is changed
+        # (e.g. another process is selected or the process is resumed).
+        return None
+
+    def lookup_global(self, name):
+        # Get the value of the pointer global variable with the given name
+        # or None if there is no such variable.
+        raise NotImplementedError
+
+    def evaluate(self, expr):
+        # Evaluate the address expression given as a command argument.
+        raise NotImplementedError
+
+    def type_size(self, typestr):
+        # Get the size of the given type or None if there is no such type.
+        raise NotImplementedError
+
+    def field_layout(self, typestr, field):
+        # Get [<offset>, <size>] of the given field of the given type or
+        # None if there is no such field.
+        raise NotImplementedError
+
+    def enum_values(self, typestr):
+        # Get [[<name>, <value>]] of the enumerators of the given enum type
+        # in the order they are declared or None if there is no such type.
+        raise NotImplementedError
+
+    def interrupted(self):
+        # Whether the user requested to interrupt the command. The backends
+        # raising KeyboardInterrupt on Ctrl-C need no polling.
+        return False
+
+    def memory_regions(self):
+        # Get [(<start>, <end>)] of the readable memory regions of the
+        # process or None if they are not known (see lj-vm --scan).
+        return None
+
+    def thread_variables(self, name, depth):
+        # Get [(<thread id>, <value>)] of the pointer local variable with
+        # the given name found in the <depth> newest frames of every
+        # thread (the threads with no such variable are omitted).
+        return []
+
+    def thread_evaluate(self, expr):
+        # Get [(<thread id>, <value>)] of the address expression evaluated
+        # in every thread (e.g. the thread-local variable).
+        return []
+
+
+BACKEND = None
+
+
+# }}}
+
+
+# Type layout cache {{{
+
+
+# The layout of the LuaJIT structures (i.e. type sizes and field offsets)
+# and the compile-time flags are resolved from the debug info that is
+# quite slow for the huge binaries (e.g. Tarantool). Hence the resolved
+# values are stored on disk, keyed by the GNU build-id of the objfile, so
+# the next sessions load them instantly. The cache is shared by all the
+# frontends and is the only source of the layout for the ones with no
+# debug info (see luajit-core.py). Bump the version below when the cache
+# format changes.
+LAYOUT_VERSION = 1
+
+# Layout of the objfile being debugged:
+# {
+#   'version': LAYOUT_VERSION,
+#   'flags': {<flag name>: <value>},
+#   'types': {<type name>: {
+#     'size': <sizeof type>,
+#     'fields': {<field name>: [<field offset>, <field size>]},
+#     'absent': [<field name>],
+#   } or None if the type is absent in this build},
+#   'enums': {<enum name>: [[<enumerator name>, <value>]] or None if the
+#     enum is absent in this build},
+# }
+LAYOUT = None
+LAYOUT_PATH = None
+# GNU build-id of the objfile being debugged (None if it has no one).
+BUILD_ID = None
+
+# The types and fields the decoders below rely on. All of them are
+# resolved at once when the layout is created, so the cached layout is
+# complete enough to decode the memory with no debug info at hand. The
+# fields missing in the particular build (e.g. the ones of the segmented
+# lightuserdata for 32-bit platforms) are recorded as absent.
+LAYOUT_TYPES = {
+    'CTState':     ['tab', 'sizetab', 'finalizer'],
+    'CType':       ['info', 'size'],
+    'GCRef':       [],
+    'GCState':     ['total', 'threshold', 'debt', 'estimate', 'stepmul',
+                    'pause', 'sweepstr', 'root', 'gray', 'grayagain',
+                    'weak', 'mmudata', 'state', 'lightudnum',
+                    'lightudseg'],
+    'GCcdata':     ['ctypeid'],
+    'GCcdataVar':  ['offset', 'len', 'extra'],
+    'GCfuncC':     ['ffid', 'nupvalues', 'f', 'pc', 'env', 'upvalue'],
+    'GCfuncL':     ['uvptr'],
+    'GChead':      ['nextgc', 'marked', 'gct'],
+    'GCproto':     ['sizept', 'chunkname', 'firstline', 'k', 'sizekgc',
+                    'sizekn', 'sizebc', 'numline', 'lineinfo', 'varinfo'],
+    'GCstr':       ['len', 'hash', 'strflags'],
+    'GCtab':       ['colo', 'asize', 'hmask', 'array', 'node',
+                    'metatable', 'freetop'],
+    'GCtrace':     ['nins', 'nk', 'nsnap', 'nsnapmap', 'traceno',
+                    'mcode', 'szmcode', 'startpt', 'ir', 'snap', 'snapmap',
+                    'startpc', 'mcloop', 'link', 'root', 'linktype'],
+    'GCudata':     ['len', 'metatable', 'env'],
+    'GCupval':     ['closed', 'tv', 'v'],
+    'GG_State':    ['g', 'J'],
+    'IRIns':       ['op1', 'op2', 't', 'o', 'i', 'gcr'],
+    'MCode':       [],
+    'Node':        ['val', 'key', 'next', 'freetop'],
+    'SnapEntry':   [],
+    'SnapShot':    ['mapofs', 'ref', 'mcofs', 'nslots', 'topslot', 'nent',
+                    'count'],
+    'TValue':      [],
+    'global_State': ['gc', 'strmask', 'strnum', 'strhash', 'mainthref',
+                     'vmstate', 'ctype_state', 'registrytv', 'gcroot',
+                     'strbloom', 'strhash_hit', 'strhash_miss', 'cur_L'],
+    'jit_State':   ['state', 'trace', 'sizetrace'],
+    'lua_State':   ['glref', 'stack', 'maxstack', 'top', 'base',
+                    'stacksize', 'env', 'openupval', 'status', 'cframe'],
+}
+
+# The enums the decoders below rely on (see LAYOUT_TYPES). The IR opcodes
+# and types are taken from them, since their values differ between the
+# LuaJIT versions.
+LAYOUT_ENUMS = ('IROp', 'IRType', 'IRCallID', 'IRFPMathOp', 'TraceLink')
+
+
+def layout_cache_path(build_id):
+    cache = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'luajit', 'layout', build_id + '.json')
+
+
+def load_layout(build_id):
+    try:
+        with open(layout_cache_path(build_id)) as cache:
+            layout = json.load(cache)
+    except (IOError, OSError, ValueError):
+        return None
+    return layout if layout.get('version') == LAYOUT_VERSION else None
+
+
+def new_layout(flags):
+    return {'version': LAYOUT_VERSION, 'flags': flags, 'types': {},
+            'enums': {}}
+
+
+def save_layout():
+    # The cache is just an optimization, so it's not a big deal if it
+    # can't be stored (e.g. read-only home directory).
+    if LAYOUT_PATH is None:
+        return
+    try:
+        cachedir = os.path.dirname(LAYOUT_PATH)
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        # Write to the temporary file at first to not leave a partially
+        # written cache for the concurrent sessions.
+        tmp = '{}.{}'.format(LAYOUT_PATH, os.getpid())
+        with open(tmp, 'w') as cache:
+            json.dump(LAYOUT, cache, sort_keys=True)
+        os.rename(tmp, LAYOUT_PATH)
+    except (IOError, OSError):
+        pass
+
+
+def resolve_type(typestr):
+    size = BACKEND.type_size(typestr)
+    LAYOUT['types'][typestr] = None if size is None \
+        else {'size': size, 'fields': {}, 'absent': []}
+
+
+def resolve_field(typestr, field):
+    layout = LAYOUT['types'][typestr]
+    member = BACKEND.field_layout(typestr, field)
+    if member is None:
+        layout['absent'].append(field)
+    else:
+        layout['fields'][field] = member
+
+
+def resolve_enum(typestr):
+    # The enums are absent in the layouts cached by the previous versions
+    # of the script.
+    LAYOUT.setdefault('enums', {})[typestr] = BACKEND.enum_values(typestr)
+
+
+def resolve_layout():
+    # Resolve all the types and fields from LAYOUT_TYPES missing in the
+    # layout (e.g. the one cached by the previous version of the script).
+    if not BACKEND.debuginfo:
+        return
+    types = LAYOUT['types']
+    updated = False
+    for typestr, fields in LAYOUT_TYPES.items():
+        if typestr not in types:
+            resolve_type(typestr)
+            updated = True
+        layout = types[typestr]
+        if layout is None:
+            continue
+        for field in fields:
+            if field not in layout['fields'] \
+                    and field not in layout['absent']:
+                resolve_field(typestr, field)
+                updated = True
+    for typestr in LAYOUT_ENUMS:
+        if typestr not in LAYOUT.get('enums', {}):
+            resolve_enum(typestr)
+            updated = True
+    if updated:
+        save_layout()
+
+
+def type_layout(typestr):
+    types = LAYOUT['types']
+    if typestr not in types:
+        if not BACKEND.debuginfo:
+            raise Error('{} layout is not cached for this build'.format(
+                typestr
+            ))
+        resolve_type(typestr)
+        save_layout()
+    if types[typestr] is None:
+        raise Error('{} is not available in this build'.format(typestr))
+    return types[typestr]
+
+
+def has_field(typestr, field):
+    layout = type_layout(typestr)
+    if field not in layout['fields'] and field not in layout['absent']:
+        if not BACKEND.debuginfo:
+            raise Error('{}.{} layout is not cached for this build'.format(
+                typestr, field
+            ))
+        resolve_field(typestr, field)
+        save_layout()
+    return field in layout['fields']
+
+
+def enum_layout(typestr):
+    enums = LAYOUT.get('enums', {})
+    if typestr not in enums:
+        if not BACKEND.debuginfo:
+            raise Error('{} layout is not cached for this build'.format(
+                typestr
+            ))
+        resolve_enum(typestr)
+        save_layout()
+    if LAYOUT['enums'][typestr] is None:
+        raise Error('{} is not available in this build'.format(typestr))
+    return LAYOUT['enums'][typestr]
+
+
+def sizeof(typestr):
+    return type_layout(typestr)['size']
+
+
+def fieldof(typestr, field):
+    if not has_field(typestr, field):
+        raise Error('{}.{} is not available in this build'.format(
+            typestr, field
+        ))
+    return type_layout(typestr)['fields'][field]
+
+
+def offsetof(typestr, field):
+    return fieldof(typestr, field)[0]
+
+
+# }}}
+
+
+# Const {{{
+
+
+LJ_64 = None
+LJ_GC64 = None
+LJ_FR2 = None
+LJ_DUALNUM = None
+ENDIAN = None
+
+LJ_GCVMASK = ((1 << 47) - 1)
+LJ_TISNUM = None
+PADDING = None
+
+# These constants are meaningful only for 'LJ_64' mode.
+LJ_LIGHTUD_BITS_SEG = 8
+LJ_LIGHTUD_BITS_LO = 47 - LJ_LIGHTUD_BITS_SEG
+LIGHTUD_SEG_MASK = (1 << LJ_LIGHTUD_BITS_SEG) - 1
+LIGHTUD_LO_MASK = (1 << LJ_LIGHTUD_BITS_LO) - 1
+
+
+# }}}
+
+
+# Types {{{
+
+
+def i2notu32(val):
+    return ~int(val) & 0xFFFFFFFF
+
+
+LJ_T = {
+    'NIL':     i2notu32(0),
+    'FALSE':   i2notu32(1),
+    'TRUE':    i2notu32(2),
+    'LIGHTUD': i2notu32(3),
+    'STR':     i2notu32(4),
+    'UPVAL':   i2notu32(5),
+    'THREAD':  i2notu32(6),
+    'PROTO':   i2notu32(7),
+    'FUNC':    i2notu32(8),
+    'TRACE':   i2notu32(9),
+    'CDATA':   i2notu32(10),
+    'TAB':     i2notu32(11),
+    'UDATA':   i2notu32(12),
+    'NUMX':    i2notu32(13),
+}
+
+
+# The type names by the itype values (see typenames).
+LJ_TNAMES = {LJ_T[k]: 'LJ_T' + k for k in LJ_T.keys()}
+
+
+def typenames(value):
+    return LJ_TNAMES.get(int(value), 'LJ_TINVALID')
+
+
+# }}}
+
+
+def configure(backend, layout, build_id, endian):
+    global BACKEND, LAYOUT, LAYOUT_PATH, BUILD_ID, ENDIAN
+    global LJ_64, LJ_GC64, LJ_FR2, LJ_DUALNUM, LJ_TISNUM, PADDING
+    global SELECTED_VM
+    BACKEND = backend
+    LAYOUT = layout
+    # The layout is not cached for the objfile with no build-id.
+    BUILD_ID = build_id
+    LAYOUT_PATH = layout_cache_path(build_id) if build_id else None
+    ENDIAN = endian
+
+    LJ_64 = LAYOUT['flags']['LJ_64']
+    LJ_FR2 = LJ_GC64 = LAYOUT['flags']['LJ_GC64']
+    LJ_DUALNUM = LAYOUT['flags']['LJ_DUALNUM']
+    PADDING = ' ' * len(':' + hex((1 << (47 if LJ_GC64 else 32)) - 1))
+    LJ_TISNUM = 0xfffeffff if LJ_64 and not LJ_GC64 else LJ_T['NUMX']
+
+    MEMORY.invalidate()
+    FIELD_DECODERS.clear()
+    PROTO_DEBUGINFO.clear()
+    IR_NAMES.clear()
+    KNOWN_VMS.clear()
+    SELECTED_VM = None
+    resolve_layout()
+
+
+# Memory cache {{{
+
+
+# Every inferior memory read is a network round trip for the remote
+# targets (e.g. gdbserver), so the memory is read page by page and the
+# pages are kept until the inferior is resumed. All the bulk reads (see
+# read_memory) are routed through the cache.
+class MemoryCache(object):
+    PAGE_SIZE = 4096
+    # The number of the cached pages (i.e. 4Mb).
+    CAPACITY = 1024
+    # The maximum number of the pages read ahead for the sequential walks.
+    READAHEAD = 16
+
+    def __init__(self):
+        # Pages are ordered from the least recently used to the most one.
+        self.pages = collections.OrderedDict()
+        self.key = None
+        self.readahead = 0
+        self.lastpage = None
+        # The structures derived from the memory (see stop_cached).
+        self.derived = {}
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+        self.transferred = 0
+        self.invalidations = 0
+
+    def invalidate(self):
+        if self.pages:
+            self.invalidations += 1
+        self.pages.clear()
+        self.derived.clear()
+        self.readahead = 0
+        self.lastpage = None
+
+    def validate(self, key):
+        # The cache is dropped when the inferior being read is changed.
+        if key != self.key:
+            self.invalidate()
+            self.key = key
+
+    def fetch(self, addr, size):
+        data = BACKEND.read_memory(addr, size)
+        self.reads += 1
+        self.transferred += size
+        return data
+
+    def load(self, first, last):
+        # Read-ahead window grows while the pages are missed sequentially.
+        if self.lastpage is not None and first == self.lastpage + 1:
+            self.readahead = min(max(1, 2 * self.readahead), self.READAHEAD)
+        else:
+            self.readahead = 0
+        ahead = 0
+        while ahead < self.readahead and last + ahead + 1 not in self.pages:
+            ahead += 1
+        try:
+            data = self.fetch(first * self.PAGE_SIZE,
+                              (last + ahead - first + 1) * self.PAGE_SIZE)
+        except MemoryReadError:
+            # The pages read ahead may be not mapped.
+            if not ahead:
+                raise
+            ahead = 0
+            data = self.fetch(first * self.PAGE_SIZE,
+                              (last - first + 1) * self.PAGE_SIZE)
+        for page in range(first, last + ahead + 1):
+            offset = (page - first) * self.PAGE_SIZE
+            self.pages[page] = data[offset:offset + self.PAGE_SIZE]
+        while len(self.pages) > self.CAPACITY:
+            self.pages.popitem(last=False)
+        self.lastpage = last + ahead
+
+    def read(self, addr, size):
+        # Huge regions (e.g. the whole table array part) are read as is
+        # to not flush the whole cache.
+        if not size or size > self.CAPACITY * self.PAGE_SIZE // 4:
+            return self.fetch(addr, size)
+        first = addr // self.PAGE_SIZE
+        last = (addr + size - 1) // self.PAGE_SIZE
+        chunks = []
+        page = first
+        try:
+            while page <= last:
+                end = page
+                if page in self.pages:
+                    self.hits += 1
+                else:
+                    # Consecutive missed pages are read with a single read.
+                    while end < last and end + 1 not in self.pages:
+                        end += 1
+                    self.misses += end - page + 1
+                    self.load(page, end)
+                for cached in range(page, end + 1):
+                    # Re-insert the page to mark it as the most recently
+                    # used one.
+                    data = self.pages.pop(cached)
+                    self.pages[cached] = data
+                    chunks.append(data)
+                page = end + 1
+        except MemoryReadError:
+            # The object may be located at the end of the mapping and the
+            # page it belongs to is not readable in whole (e.g. in the
+            # truncated core file), so fallback to the plain read.
+            return self.fetch(addr, size)
+        offset = addr - first * self.PAGE_SIZE
+        return b''.join(chunks)[offset:offset + size]
+
+    def counters(self):
+        return {
+            'pages': len(self.pages),
+            'bytes': len(self.pages) * self.PAGE_SIZE,
+            'hits': self.hits,
+            'misses': self.misses,
+            'reads': self.reads,
+            'transferred': self.transferred,
+            'invalidated': self.invalidations,
+        }
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return [
+            'pages: {} ({} bytes)'.format(
+                len(self.pages), len(self.pages) * self.PAGE_SIZE
+            ),
+            'hits: {} ({:.1%})'.format(
+                self.hits, self.hits / float(requests) if requests else 0
+            ),
+            'misses: {}'.format(self.misses),
+            'reads: {} ({} bytes transferred)'.format(
+                self.reads, self.transferred
+            ),
+            'invalidated: {}'.format(self.invalidations),
+        ]
+
+
+MEMORY = MemoryCache()
+
+
+def stop_cached(key, build):
+    # Get the structure derived from the inferior memory (e.g. the heap
+    # graph) by the given <key>. It's built via <build> once and dropped
+    # along with the cached pages, i.e. when the inferior is resumed.
+    if BACKEND.cached:
+        MEMORY.validate(BACKEND.memory_key())
+    if key not in MEMORY.derived:
+        MEMORY.derived[key] = build()
+    return MEMORY.derived[key]
+
+
+# }}}
+
+
+# Memory access {{{
+
+
+# Number of records decoded by a single struct.unpack_from call and the
+# number of output lines written at once.
+CHUNK_SIZE = 4096
+# The period (in seconds) the output is written with at least.
+FLUSH_PERIOD = 0.1
+
+# struct module format codes for the fields of the corresponding size.
+UINT_FORMAT = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+INT_FORMAT = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+
+def read_memory(addr, size):
+    if not BACKEND.cached:
+        return BACKEND.read_memory(addr, size)
+    MEMORY.validate(BACKEND.memory_key())
+    return MEMORY.read(addr, size)
+
+
+def read_uint(addr, size, signed=False):
+    fmt = ENDIAN + (INT_FORMAT if signed else UINT_FORMAT)[size]
+    return struct.unpack(fmt, read_memory(addr, size))[0]
+
+
+def read_field(addr, typestr, field, signed=False):
+    # Pointers, GCRef and MRef are read as the unsigned integers of the
+    # corresponding size.
+    offset, size = fieldof(typestr, field)
+    return read_uint(addr + offset, size, signed)
+
+
+# The compiled decoders for read_fields by the type and the fields.
+FIELD_DECODERS = {}
+
+
+def read_fields(addr, typestr, fields):
+    # Read the given fields of the structure with a single read. Signed
+    # fields are prefixed with '-' (see field_decoder).
+    key = (typestr, tuple(fields))
+    if key not in FIELD_DECODERS:
+        FIELD_DECODERS[key] = (
+            sizeof(typestr),
+            [field_decoder(typestr, field) for field in fields],
+        )
+    size, decoders = FIELD_DECODERS[key]
+    buf = read_memory(addr, size)
+    return [heap_unpack(buf, decoder) for decoder in decoders]
+
+
+def struct_format(size, fields):
+    # Build struct module format for the record of the given <size> with
+    # the given (offset, format code) <fields>; the gaps are padded.
+    fmt, pos = '', 0
+    for offset, code in sorted(fields):
+        if offset > pos:
+            fmt += '{}x'.format(offset - pos)
+        fmt += code
+        pos = offset + struct.calcsize('<' + code)
+    if size > pos:
+        fmt += '{}x'.format(size - pos)
+    return fmt
+
+
+def unpack_records(buf, fmt, count):
+    # The generator decodes <count> records of the same <fmt> laid out
+    # back to back in the <buf>. Every record is represented as a tuple
+    # of its fields. Records are unpacked chunk by chunk to keep
+    # the memory footprint low for huge regions.
+    size = struct.calcsize(ENDIAN + fmt)
+    width = len(struct.unpack(ENDIAN + fmt, b'\0' * size))
+    for start in range(0, count, CHUNK_SIZE):
+        nrecs = min(CHUNK_SIZE, count - start)
+        fields = iter(struct.unpack_from(ENDIAN + fmt * nrecs, buf,
+                                         start * size))
+        for record in zip(*[fields] * width):
+            yield record
+
+
+def strx64(val):
+    return '0x{:x}'.format(val & 0xFFFFFFFFFFFFFFFF)
+
+
+# }}}
+
+
+# Frames {{{
+
+
+FRAME_TYPE = 0x3
+FRAME_P = 0x4
+FRAME_TYPEP = FRAME_TYPE | FRAME_P
+
+FRAME = {
+    'LUA':    0x0,
+    'C':      0x1,
+    'CONT':   0x2,
+    'VARG':   0x3,
+    'LUAP':   0x4,
+    'CP':     0x5,
+    'PCALL':  0x6,
+    'PCALLH': 0x7,
+}
+
+
+def frametypes(ft):
+    return {
+        FRAME['LUA']:  'L',
+        FRAME['C']:    'C',
+        FRAME['CONT']: 'M',
+        FRAME['VARG']: 'V',
+    }.get(ft, '?')
+
+
+def bc_a(ins):
+    return (ins >> 8) & 0xff
+
+
+# }}}
+
+
+# VM state {{{
+
+
+# The symbols for the main coroutine considering the host app.
+MAIN_L_GLOBALS = (
+    # LuaJIT main coro (see luajit/src/luajit.c)
+    'globalL',
+    # Tarantool main coro (see tarantool/src/lua/init.h)
+    'tarantool_L',
+    # TODO: Add more
+)
+
+
+# The global_State the commands are run for (see lj-vm) or None for the
+# one of the main coroutine found via the globals above.
+SELECTED_VM = None
+
+
+def main_L():
+    if SELECTED_VM is not None:
+        return read_field(SELECTED_VM, 'global_State', 'mainthref')
+    for main in MAIN_L_GLOBALS:
+        lstate = BACKEND.lookup_global(main)
+        if lstate:
+            return lstate
+    raise Error('main Lua coroutine is not found')
+
+
+def L(lstate=None):
+    return lstate if lstate else main_L()
+
+
+def G(L):
+    return read_field(L, 'lua_State', 'glref')
+
+
+def J(g):
+    return g - offsetof('GG_State', 'g') + offsetof('GG_State', 'J')
+
+
+def gcstate(g):
+    return g + offsetof('global_State', 'gc')
+
+
+def vm_state(g):
+    return {
+        i2notu32(0): 'INTERP',
+        i2notu32(1): 'LFUNC',
+        i2notu32(2): 'FFUNC',
+        i2notu32(3): 'CFUNC',
+        i2notu32(4): 'GC',
+        i2notu32(5): 'EXIT',
+        i2notu32(6): 'RECORD',
+        i2notu32(7): 'OPT',
+        i2notu32(8): 'ASM',
+    }.get(read_field(g, 'global_State', 'vmstate'), 'TRACE')
+
+
+def gc_state(g):
+    return {
+        0: 'PAUSE',
+        1: 'PROPAGATE',
+        2: 'ATOMIC',
+        3: 'SWEEPSTRING',
+        4: 'SWEEP',
+        5: 'FINALIZE',
+        6: 'LAST',
+    }.get(read_field(gcstate(g), 'GCState', 'state'), 'INVALID')
+
+
+def jit_state(g):
+    return {
+        0:    'IDLE',
+        0x10: 'ACTIVE',
+        0x11: 'RECORD',
+        0x12: 'START',
+        0x13: 'END',
+        0x14: 'ASM',
+        0x15: 'ERR',
+    }.get(read_field(J(g), 'jit_State', 'state'), 'INVALID')
+
+
+# }}}
+
+
+# VM discovery {{{
+
+
+# The process may run several independent VMs (i.e. global_State
+# instances), e.g. one per worker thread. The VMs are found via the main
+# coroutine globals, the lua_State variables in the frames of the native
+# threads, the thread-local anchors given by the user and the GG_State
+# signature scan. They are kept in the order they are found, so their
+# numbers are stable within the session: {<global_State *>: [<source>]}.
+KNOWN_VMS = collections.OrderedDict()
+# The per-thread expressions holding lua_State * (see lj-vm --tls).
+TLS_ANCHORS = []
+# The name of the lua_State variables in the LuaJIT (and the host app)
+# functions and the number of the newest frames it's looked up in.
+THREAD_STATE_VAR = 'L'
+THREAD_FRAMES = 32
+# The memory is scanned by the windows of the given size.
+VMSCAN_WINDOW = 1 << 21
+# See FF_C in lj_obj.h.
+FF_C = 1
+
+
+def vm_valid(g):
+    # Whether the given address is the global_State, i.e. its main
+    # coroutine refers it back.
+    try:
+        mainthread = read_field(g, 'global_State', 'mainthref')
+        return bool(mainthread) and G(mainthread) == g and typenames(
+            i2notu32(read_field(mainthread, 'GChead', 'gct'))
+        ) == 'LJ_TTHREAD'
+    except MemoryReadError:
+        return False
+
+
+def vm_of(addr):
+    # Get the global_State by the given lua_State or global_State address
+    # or None if it's neither of them.
+    try:
+        gct = typenames(i2notu32(read_field(addr, 'GChead', 'gct')))
+        g = G(addr) if gct == 'LJ_TTHREAD' else addr
+    except MemoryReadError:
+        return None
+    return g if vm_valid(g) else None
+
+
+def vm_add(g, source):
+    sources = KNOWN_VMS.setdefault(g, [])
+    if source not in sources:
+        sources.append(source)
+
+
+def vm_discover():
+    # The VMs are looked up via the globals and the threads once per stop.
+    def build():
+        found = []
+        for name in MAIN_L_GLOBALS:
+            found.append((BACKEND.lookup_global(name), 'symbol ' + name))
+        for thread, value in BACKEND.thread_variables(THREAD_STATE_VAR,
+                                                      THREAD_FRAMES):
+            found.append((value, 'thread {}'.format(thread)))
+        for expr in TLS_ANCHORS:
+            for thread, value in BACKEND.thread_evaluate(expr):
+                found.append((value, '{} in thread {}'.format(expr, thread)))
+        return [(vm_of(addr), source) for addr, source in found if addr]
+
+    for g, source in stop_cached('vm_discover', build):
+        if g is not None:
+            vm_add(g, source)
+
+
+def vm_scan(stats):
+    # Scan the readable memory for the GG_State, i.e. the main coroutine
+    # followed by the global_State referring each other.
+    regions = BACKEND.memory_regions()
+    if regions is None:
+        raise Error('lj-vm: memory regions of the process are unknown')
+    gctofs = offsetof('GChead', 'gct')
+    gofs = offsetof('GG_State', 'g')
+    # The GC header of the lua_State (gct is ~LJ_TTHREAD) is followed by
+    # dummy_ffid (FF_C).
+    signature = struct.pack('BB', ~LJ_T['THREAD'] & 0xff, FF_C)
+    try:
+        for start, end in regions:
+            for window in range(start, end, VMSCAN_WINDOW):
+                if BACKEND.interrupted():
+                    raise KeyboardInterrupt
+                size = min(VMSCAN_WINDOW + len(signature) - 1, end - window)
+                try:
+                    buf = BACKEND.read_memory(window, size)
+                except MemoryReadError:
+                    continue
+                stats['bytes'] += size
+                pos = buf.find(signature)
+                while pos >= 0:
+                    gg = window + pos - gctofs
+                    # GG_State is allocated with at least 8-byte alignment.
+                    if gg % 8 == 0 and vm_valid(gg + gofs):
+                        vm_add(gg + gofs, 'scan')
+                    pos = buf.find(signature, pos + 1)
+    except KeyboardInterrupt:
+        stats['stopped'] = STOP_INTERRUPTED
+
+
+def vm_list():
+    # Get [(<number>, <global_State *>, [<source>])] of the known VMs. The
+    # ones found in the previous stops are dropped if they are gone.
+    vm_discover()
+    for g in list(KNOWN_VMS):
+        if not vm_valid(g):
+            del KNOWN_VMS[g]
+    return [(i, g, sources)
+            for i, (g, sources) in enumerate(KNOWN_VMS.items())]
+
+
+def vm_resolve(spec):
+    # Get [(<number>, <global_State *>)] by the given VM number, address
+    # (of the global_State or any lua_State), 'all' or 'main' (the one of
+    # the main coroutine found via the globals, i.e. the default one).
+    if spec == 'main':
+        return [(None, None)]
+    vms = vm_list()
+    if spec == 'all':
+        if not vms:
+            raise Error('no VMs are found')
+        return [(i, g) for i, g, _ in vms]
+    if spec.isdigit():
+        if int(spec) >= len(vms):
+            raise Error('VM #{} is not found'.format(spec))
+        return [vms[int(spec)][:2]]
+    g = vm_of(BACKEND.evaluate(spec))
+    if g is None:
+        raise Error('{} is neither lua_State nor global_State'.format(spec))
+    vm_add(g, 'user')
+    return [(list(KNOWN_VMS).index(g), g)]
+
+
+def dump_vm(number, g, sources, selected):
+    return '#{number} global_State @ {g}, main coroutine @ {L}, current ' \
+        '@ {cur}, gc.total: {total} bytes ({sources}){selected}'.format(
+            number=number,
+            g=strx64(g),
+            L=strx64(read_field(g, 'global_State', 'mainthref')),
+            cur=strx64(read_field(g, 'global_State', 'cur_L'))
+            if has_field('global_State', 'cur_L') else '?',
+            total=read_field(gcstate(g), 'GCState', 'total'),
+            sources=', '.join(sources),
+            selected=' [selected]' if selected else '',
+        )
+
+
+def record_vm(number, g, sources, selected):
+    return {
+        'kind': 'vm',
+        'number': number,
+        'g': strx64(g),
+        'L': strx64(read_field(g, 'global_State', 'mainthref')),
+        'cur_L': strx64(read_field(g, 'global_State', 'cur_L'))
+        if has_field('global_State', 'cur_L') else None,
+        'total': read_field(gcstate(g), 'GCState', 'total'),
+        'sources': sources,
+        'selected': selected,
+    }
+
+
+def dump_vms(scan, structured=False):
+    stats = {'bytes': 0, 'stopped': None}
+    if scan:
+        # The known VMs keep their numbers, the found ones are appended.
+        vm_discover()
+        vm_scan(stats)
+    vms = vm_list()
+    try:
+        selected = G(main_L())
+    except Error:
+        selected = None
+    if structured:
+        yield {
+            'kind': 'vms',
+            'count': len(vms),
+            'scanned': stats['bytes'],
+            'stopped': stats['stopped'],
+        }
+    else:
+        yield 'VMs: {} found{}'.format(
+            len(vms),
+            ' ({} bytes scanned{})'.format(
+                stats['bytes'],
+                ', ' + stats['stopped'] if stats['stopped'] else '',
+            ) if scan else '',
+        )
+    for number, g, sources in vms:
+        if structured:
+            yield record_vm(number, g, sources, g == selected)
+        else:
+            yield '\t' + dump_vm(number, g, sources, g == selected)
+
+
+# }}}
+
+
+# Dumpers {{{
+
+
+# The functions below work with the raw 64-bit TValue payloads and the
+# addresses of the GC objects read from the memory.
+
+
+def tvraw_itype(u64):
+    if LJ_GC64:
+        # it64 is signed, so its MSB is propagated by the shift.
+        return (u64 >> 47) | 0xFFFE0000 if u64 >> 63 else u64 >> 47
+    else:
+        return u64 >> 32
+
+
+def tvraw_itypemap(u64):
+    it = tvraw_itype(u64)
+    if it <= LJ_TISNUM:
+        return LJ_T['NUMX']
+    elif LJ_64 and not LJ_GC64 and it >> 15 == 0x1FFFE:
+        return LJ_T['LIGHTUD']
+    return it
+
+
+def tvraw_gcval(u64):
+    return u64 & LJ_GCVMASK if LJ_GC64 else u64 & 0xFFFFFFFF
+
+
+def tvraw_num(u64):
+    return struct.unpack('=d', struct.pack('=Q', u64))[0]
+
+
+def tvraw_int(u64):
+    i = u64 & 0xFFFFFFFF
+    return i - (1 << 32) if i >> 31 else i
+
+
+def read_tv(addr):
+    return read_uint(addr, 8)
+
+
+class LightudSegmap(object):
+    # The lightuserdata segment map of the VM. The map is allocated on the
+    # first light userdata creation only (see lj_lightud_intern), so it is
+    # read lazily on the first lookup, and the missing map is empty.
+
+    def __init__(self, g):
+        self.g = g
+        self.segs = None
+
+    def read(self):
+        if not has_field('GCState', 'lightudseg'):
+            return ()
+        gc = gcstate(self.g)
+        addr = read_field(gc, 'GCState', 'lightudseg')
+        if addr == 0:
+            return ()
+        # The whole map is read at once.
+        nsegs = read_field(gc, 'GCState', 'lightudnum') + 1
+        return struct.unpack('{}{}I'.format(ENDIAN, nsegs),
+                             read_memory(addr, 4 * nsegs))
+
+    def __getitem__(self, seg):
+        if self.segs is None:
+            self.segs = self.read()
+        if seg >= len(self.segs):
+            raise Error('lightuserdata segment {} is not allocated'.format(
+                seg
+            ))
+        return self.segs[seg]
+
+
+def lightud_segmap(g):
+    # Nothing is read until the light userdata is decoded.
+    return LightudSegmap(g) if LJ_64 else None
+
+
+def tvraw_lightudV(u64, segmap):
+    if LJ_64:
+        # The segment map is required only for the light userdata, so it
+        # is read for the main VM on demand.
+        if segmap is None:
+            segmap = lightud_segmap(G(main_L()))
+        # lightudseg and lightudlo macros expanded.
+        seg = (u64 >> LJ_LIGHTUD_BITS_LO) & LIGHTUD_SEG_MASK
+        return (segmap[seg] << 32) | (u64 & LIGHTUD_LO_MASK)
+    else:
+        return u64 & 0xFFFFFFFF
+
+
+# Maximum number of the string payload bytes to be rendered.
+STRDATA_LIMIT = 1024
+
+STRDATA_ESCAPES = {
+    ord('"'):  '\\"',
+    ord('\\'): '\\\\',
+    ord('\n'): '\\n',
+    ord('\r'): '\\r',
+    ord('\t'): '\\t',
+}
+
+
+def strescape(payload):
+    # Non-printable characters are escaped the same way as C does.
+    return ''.join(
+        STRDATA_ESCAPES.get(c) or
+        (chr(c) if 0x20 <= c < 0x7f else '\\{:03o}'.format(c))
+        for c in bytearray(payload)
+    )
+
+
+def strpayload(gcstr):
+    length = read_field(gcstr, 'GCstr', 'len')
+    limit = min(length, STRDATA_LIMIT)
+    payload = read_memory(gcstr + sizeof('GCstr'), limit) if limit else b''
+    return payload, length
+
+
+def strdata(gcstr):
+    payload, length = strpayload(gcstr)
+    return '"{}"{}'.format(
+        strescape(payload),
+        '...' if length > STRDATA_LIMIT else '',
+    )
+
+
+def funcproto(func):
+    return read_field(func, 'GCfuncC', 'pc') - sizeof('GCproto')
+
+
+def dump_lj_tstr(gcstr):
+    return 'string {body} @ {address}'.format(
+        body=strdata(gcstr),
+        address=strx64(gcstr)
+    )
+
+
+def dump_lj_tfunc(func):
+    ffid = read_field(func, 'GCfuncC', 'ffid')
+
+    if ffid == 0:
+        pt = funcproto(func)
+        return 'Lua function @ {addr}, {nups} upvalues, {chunk}:{line}'.format(
+            addr=strx64(func),
+            nups=read_field(func, 'GCfuncC', 'nupvalues'),
+            chunk=strdata(read_field(pt, 'GCproto', 'chunkname')),
+            line=read_field(pt, 'GCproto', 'firstline', signed=True)
+        )
+    elif ffid == 1:
+        return 'C function @ {}'.format(strx64(read_field(func, 'GCfuncC',
+                                                          'f')))
+    else:
+        return 'fast function #{}'.format(ffid)
+
+
+def dump_lj_ttrace(trace):
+    return 'trace {traceno} @ {addr}'.format(
+        traceno=strx64(read_field(trace, 'GCtrace', 'traceno')),
+        addr=strx64(trace)
+    )
+
+
+def dump_lj_ttab(table):
+    return 'table @ {gcr} (asize: {asize}, hmask: {hmask})'.format(
+        gcr=strx64(table),
+        asize=read_field(table, 'GCtab', 'asize'),
+        hmask=strx64(read_field(table, 'GCtab', 'hmask')),
+    )
+
+
+def dump_gcobj(fmt):
+    return lambda gcobj: fmt.format(strx64(gcobj))
+
+
+# The dumpers of the values referring to GC objects receive the address of
+# the object.
+gcdumpers = {
+    'LJ_TSTR':    dump_lj_tstr,
+    'LJ_TUPVAL':  dump_gcobj('upvalue @ {}'),
+    'LJ_TTHREAD': dump_gcobj('thread @ {}'),
+    'LJ_TPROTO':  dump_gcobj('proto @ {}'),
+    'LJ_TFUNC':   dump_lj_tfunc,
+    'LJ_TTRACE':  dump_lj_ttrace,
+    'LJ_TCDATA':  dump_gcobj('cdata @ {}'),
+    'LJ_TTAB':    dump_lj_ttab,
+    'LJ_TUDATA':  dump_gcobj('userdata @ {}'),
+}
+
+
+def dump_lj_tlightud(u64, segmap):
+    return 'light userdata @ {}'.format(
+        strx64(tvraw_lightudV(u64, segmap))
+    )
+
+
+def dump_lj_tnumx(u64, segmap):
+    if LJ_DUALNUM and tvraw_itype(u64) == LJ_TISNUM:
+        return 'integer {}'.format(tvraw_int(u64))
+    else:
+        return 'number {:.17g}'.format(tvraw_num(u64))
+
+
+def dump_const(text):
+    return lambda u64, segmap: text
+
+
+def dump_lj_invalid(u64, segmap):
+    return 'not valid type @ {}'.format(strx64(tvraw_gcval(u64)))
+
+
+dumpers = {
+    'LJ_TNIL':     dump_const('nil'),
+    'LJ_TFALSE':   dump_const('false'),
+    'LJ_TTRUE':    dump_const('true'),
+    'LJ_TLIGHTUD': dump_lj_tlightud,
+    'LJ_TNUMX':    dump_lj_tnumx,
+}
+
+
+def dump_tvalue(u64, segmap=None):
+    # <segmap> is the lightuserdata segment map (see lightud_segmap) to be
+    # used for the bulk dumps; it's read on demand otherwise.
+    itype = typenames(tvraw_itypemap(u64))
+    if itype in gcdumpers:
+        return gcdumpers[itype](tvraw_gcval(u64))
+    return dumpers.get(itype, dump_lj_invalid)(u64, segmap)
+
+
+# The functions below build the records, i.e. the structured counterparts
+# of the dumps above emitted in the NDJSON mode (see run). The addresses
+# are hex strings to not lose the precision in the tools treating all the
+# numbers as doubles (e.g. jq).
+
+
+def strtext(payload):
+    return payload.decode('utf-8', 'replace')
+
+
+def jsonnum(value):
+    # NaN and infinities are not valid JSON numbers.
+    return value if not math.isinf(value) and not math.isnan(value) \
+        else repr(value)
+
+
+def record_lj_tstr(gcstr):
+    payload, length = strpayload(gcstr)
+    return {
+        'type': 'string',
+        'addr': strx64(gcstr),
+        'len': length,
+        'value': strtext(payload),
+        'truncated': length > STRDATA_LIMIT,
+    }
+
+
+def record_lj_tfunc(func):
+    ffid = read_field(func, 'GCfuncC', 'ffid')
+    record = {'type': 'function', 'addr': strx64(func)}
+    if ffid == 0:
+        pt = funcproto(func)
+        payload, _ = strpayload(read_field(pt, 'GCproto', 'chunkname'))
+        record.update({
+            'ftype': 'lua',
+            'nupvalues': read_field(func, 'GCfuncC', 'nupvalues'),
+            'chunkname': strtext(payload),
+            'firstline': read_field(pt, 'GCproto', 'firstline',
+                                    signed=True),
+        })
+    elif ffid == 1:
+        record.update({
+            'ftype': 'c',
+            'cfunc': strx64(read_field(func, 'GCfuncC', 'f')),
+        })
+    else:
+        record.update({'ftype': 'fast', 'ffid': ffid})
+    return record
+
+
+def record_lj_ttrace(trace):
+    return {
+        'type': 'trace',
+        'addr': strx64(trace),
+        'traceno': read_field(trace, 'GCtrace', 'traceno'),
+    }
+
+
+def record_lj_ttab(table):
+    return {
+        'type': 'table',
+        'addr': strx64(table),
+        'asize': read_field(table, 'GCtab', 'asize'),
+        'hmask': read_field(table, 'GCtab', 'hmask'),
+    }
+
+
+def record_gcobj(typename):
+    return lambda gcobj: {'type': typename, 'addr': strx64(gcobj)}
+
+
+gcrecorders = {
+    'LJ_TSTR':    record_lj_tstr,
+    'LJ_TUPVAL':  record_gcobj('upvalue'),
+    'LJ_TTHREAD': record_gcobj('thread'),
+    'LJ_TPROTO':  record_gcobj('proto'),
+    'LJ_TFUNC':   record_lj_tfunc,
+    'LJ_TTRACE':  record_lj_ttrace,
+    'LJ_TCDATA':  record_gcobj('cdata'),
+    'LJ_TTAB':    record_lj_ttab,
+    'LJ_TUDATA':  record_gcobj('userdata'),
+}
+
+
+def record_lj_tlightud(u64, segmap):
+    return {
+        'type': 'lightuserdata',
+        'addr': strx64(tvraw_lightudV(u64, segmap)),
+    }
+
+
+def record_lj_tnumx(u64, segmap):
+    if LJ_DUALNUM and tvraw_itype(u64) == LJ_TISNUM:
+        return {'type': 'integer', 'value': tvraw_int(u64)}
+    else:
+        return {'type': 'number', 'value': jsonnum(tvraw_num(u64))}
+
+
+def record_const(record):
+    return lambda u64, segmap: record
+
+
+def record_lj_invalid(u64, segmap):
+    return {'type': 'invalid', 'addr': strx64(tvraw_gcval(u64))}
+
+
+recorders = {
+    'LJ_TNIL':     record_const({'type': 'nil'}),
+    'LJ_TFALSE':   record_const({'type': 'boolean', 'value': False}),
+    'LJ_TTRUE':    record_const({'type': 'boolean', 'value': True}),
+    'LJ_TLIGHTUD': record_lj_tlightud,
+    'LJ_TNUMX':    record_lj_tnumx,
+}
+
+
+def record_tvalue(u64, segmap=None):
+    itype = typenames(tvraw_itypemap(u64))
+    if itype in gcrecorders:
+        return gcrecorders[itype](tvraw_gcval(u64))
+    return recorders.get(itype, record_lj_invalid)(u64, segmap)
+
+
+# }}}
+
+
+# Stack decoding {{{
+
+
+# The guest stack is read with a single memory read (see read_stack) and
+# both values and framelinks are decoded from the raw 64-bit slots. The
+# slots are addressed by their index relative to L->stack below.
+
+
+def read_stack(L):
+    # The red zone follows the last slot (i.e. L->maxstack) and is still
+    # within the stack allocated for the coroutine.
+    stack = read_field(L, 'lua_State', 'stack')
+    maxstack = read_field(L, 'lua_State', 'maxstack')
+    nslots = ((maxstack - stack) >> 3) + 1 + 5 + 2 * LJ_FR2
+    buf = read_memory(stack, nslots * 8)
+    return stack, struct.unpack('{}{}Q'.format(ENDIAN, nslots), buf)
+
+
+def frameraw_ftsz(slots, framelink):
+    u64 = slots[framelink]
+    if LJ_FR2:
+        return u64 - (1 << 64) if u64 >> 63 else u64
+    # The upper half of the framelink is occupied by the ftsz/pcr union.
+    ftsz = u64 >> 32
+    return ftsz - (1 << 32) if ftsz >> 31 else ftsz
+
+
+def frameraw_func(slots, framelink):
+    # GCfunc is stored in the slot below the framelink in case of LJ_FR2
+    # and in the lower half of the framelink otherwise.
+    return tvraw_gcval(slots[framelink - 1]) if LJ_FR2 \
+        else slots[framelink] & 0xFFFFFFFF
+
+
+def frameraw_islua(ftsz):
+    return frametypes(ftsz & FRAME_TYPE) == 'L' and ftsz > 0
+
+
+def frameraw_prev(slots, framelink, ftsz, bcache):
+    if not frameraw_islua(ftsz):
+        return framelink - ((ftsz & ~FRAME_TYPEP) >> 3)
+    # The frame PC is the ftsz for Lua frames, so the A operand of the
+    # call instruction (i.e. pc[-1]) is read once for every call site.
+    pc = ftsz
+    if pc not in bcache:
+        bcache[pc] = bc_a(read_uint(pc - 4, 4))
+    return framelink - (1 + LJ_FR2 + bcache[pc])
+
+
+# The generator that implements raw frame iterator.
+# Every frame is represented as a tuple of framelink, frametop, ftsz and
+# previous framelink slot indices (None for the sentinel frame).
+def frames_raw(L, stack, slots):
+    bcache = {}
+    frametop = (read_field(L, 'lua_State', 'top') - stack) >> 3
+    framelink = ((read_field(L, 'lua_State', 'base') - stack) >> 3) - 1
+    while True:
+        ftsz = frameraw_ftsz(slots, framelink)
+        # The sentinel framelink is the bottom one (i.e. L->stack + LJ_FR2).
+        if framelink <= LJ_FR2:
+            yield framelink, frametop, ftsz, None
+            break
+        prev = frameraw_prev(slots, framelink, ftsz, bcache)
+        yield framelink, frametop, ftsz, prev
+        # Do not follow the framelink out of the stack if it's broken.
+        if not 0 <= prev < framelink:
+            break
+        frametop = framelink - (1 + LJ_FR2)
+        framelink = prev
+
+
+def dump_framelink_slot_address(fr):
+    return '{}:{}'.format(strx64(fr - 8), strx64(fr)) if LJ_FR2 \
+        else strx64(fr) + PADDING
+
+
+def dump_frametype(ftsz):
+    if (ftsz & FRAME['PCALL']) == FRAME['PCALL']:
+        return 'PP'
+    return '{frname}{p}'.format(
+        frname=frametypes(ftsz & FRAME_TYPE),
+        p='P' if ftsz & FRAME_P else ''
+    )
+
+
+def dump_framelink(fr, ftsz, delta, func):
+    if delta is None:
+        return '{addr} [S   ] FRAME: dummy L'.format(
+            addr=dump_framelink_slot_address(fr),
+        )
+    return '{addr} [    ] FRAME: [{pp}] delta={d}, {f}'.format(
+        addr=dump_framelink_slot_address(fr),
+        pp=dump_frametype(ftsz),
+        d=delta,
+        f=func,
+    )
+
+
+def record_framelink(fr, ftsz, delta, func):
+    if delta is None:
+        return {'kind': 'frame', 'addr': strx64(fr), 'type': 'dummy'}
+    return {
+        'kind': 'frame',
+        'addr': strx64(fr),
+        'type': dump_frametype(ftsz),
+        'delta': delta,
+        'func': func,
+    }
+
+
+def dump_stack_slot(slot, marks, value):
+    return '{addr}{padding} [ {B}{T}{M}] VALUE: {value}'.format(
+        addr=strx64(slot),
+        padding=PADDING,
+        B='B' if 'B' in marks else ' ',
+        T='T' if 'T' in marks else ' ',
+        M='M' if 'M' in marks else ' ',
+        value=value,
+    )
+
+
+def dump_stack(L, structured=False):
+    stack, slots = read_stack(L)
+    base = (read_field(L, 'lua_State', 'base') - stack) >> 3
+    top = (read_field(L, 'lua_State', 'top') - stack) >> 3
+    maxstack = (read_field(L, 'lua_State', 'maxstack') - stack) >> 3
+    red = 5 + 2 * LJ_FR2
+    segmap = lightud_segmap(G(L))
+    tvalue = record_tvalue if structured else dump_tvalue
+    tfunc = record_lj_tfunc if structured else dump_lj_tfunc
+    framelink = record_framelink if structured else dump_framelink
+
+    # The GC objects referenced from the stack are resolved only once,
+    # since the same values (e.g. functions of the recursive calls) are
+    # likely to be met several times.
+    values = {}
+    funcs = {}
+
+    def slot(index):
+        u64 = slots[index]
+        if u64 not in values:
+            values[u64] = tvalue(u64, segmap)
+        marks = ''.join([
+            'B' if index == base else '',
+            'T' if index == top else '',
+            'M' if index == maxstack else '',
+        ])
+        if structured:
+            return {
+                'kind': 'slot',
+                'addr': strx64(stack + index * 8),
+                'marks': marks,
+                'value': values[u64],
+            }
+        return dump_stack_slot(stack + index * 8, marks, values[u64])
+
+    def func(index):
+        gcfunc = frameraw_func(slots, index)
+        if gcfunc not in funcs:
+            funcs[gcfunc] = tfunc(gcfunc)
+        return funcs[gcfunc]
+
+    if structured:
+        yield {'kind': 'redzone', 'slots': red}
+    else:
+        yield '{padding} Red zone: {nredslots: >2} slots {padding}'.format(
+            padding='-' * len(PADDING),
+            nredslots=red,
+        )
+    for offset in range(red, 0, -1):
+        yield slot(maxstack + offset)
+    if structured:
+        yield {'kind': 'stack', 'L': strx64(L), 'slots': maxstack}
+    else:
+        yield '{padding} Stack: {nstackslots: >5} slots {padding}'.format(
+            padding='-' * len(PADDING),
+            nstackslots=maxstack,
+        )
+    yield slot(maxstack)
+    free = {
+        'kind': 'free',
+        'start': strx64(stack + (top + 1) * 8),
+        'end': strx64(stack + (maxstack - 1) * 8),
+        'slots': maxstack - top - 1,
+    }
+    if structured:
+        yield free
+    else:
+        yield '{start}:{end} [    ] {slots} slots: Free stack slots'.format(
+            **free
+        )
+
+    for link, frametop, ftsz, prev in frames_raw(L, stack, slots):
+        # Dump all data slots in the (framelink, top) interval.
+        for offset in range(frametop - link, 0, -1):
+            yield slot(link + offset)
+        # Dump frame slot (2 slots in case of GC64).
+        yield framelink(
+            stack + link * 8, ftsz,
+            None if prev is None else link - prev,
+            None if prev is None else func(link),
+        )
+
+
+# }}}
+
+
+# Backtrace {{{
+
+
+# Names of the internal variables (see VARNAMEDEF in lj_debug.h) by their
+# codes in varinfo.
+VARNAMES = ('(for index)', '(for limit)', '(for step)', '(for generator)',
+            '(for state)', '(for control)')
+
+# The decoded debug info of the prototypes (see proto_debuginfo). The
+# prototype is immutable, so its debug info is kept for the whole session
+# (the key includes the prototype header to not mix up the prototypes
+# allocated at the same address).
+PROTO_DEBUGINFO = {}
+
+
+def uleb128(buf, pos):
+    value = buf[pos]
+    pos += 1
+    if value >= 0x80:
+        value &= 0x7f
+        shift = 0
+        while True:
+            shift += 7
+            value |= (buf[pos] & 0x7f) << shift
+            pos += 1
+            if buf[pos - 1] < 0x80:
+                break
+    return value, pos
+
+
+def proto_lineinfo(buf, offset, sizebc, numline):
+    # The line deltas are stored for each instruction but the function
+    # header in 1, 2 or 4 bytes depending on the number of lines.
+    size = 1 if numline < 256 else 2 if numline < 65536 else 4
+    return struct.unpack(
+        '{}{}{}'.format(ENDIAN, sizebc - 1, 'BHI'[size >> 1]),
+        bytes(buf[offset:offset + (sizebc - 1) * size])
+    )
+
+
+def proto_varinfo(buf, offset):
+    # Every variable is encoded as its name (or the code of the internal
+    # one) followed by the ULEB128 start PC delta and the extent.
+    variables = []
+    lastpc = 0
+    pos = offset
+    while pos < len(buf):
+        code = buf[pos]
+        if code == 0:
+            break
+        if code <= len(VARNAMES):
+            name = VARNAMES[code - 1]
+            pos += 1
+        else:
+            end = buf.index(b'\0', pos)
+            name = strtext(bytes(buf[pos:end]))
+            pos = end + 1
+        delta, pos = uleb128(buf, pos)
+        lastpc += delta
+        extent, pos = uleb128(buf, pos)
+        variables.append((name, lastpc, lastpc + extent))
+    return variables
+
+
+def proto_debuginfo(pt):
+    # Get (<chunk name>, <first line>, <line numbers by the bytecode
+    # position> or None if stripped, [(<name>, <start PC>, <end PC>)])
+    # for the given prototype.
+    sizept, chunkname, firstline, sizebc, numline, lineinfo, varinfo = \
+        read_fields(pt, 'GCproto', ['sizept', 'chunkname', '-firstline',
+                                    'sizebc', 'numline', 'lineinfo',
+                                    'varinfo'])
+    key = (pt, sizept, chunkname, firstline)
+    if key in PROTO_DEBUGINFO:
+        return PROTO_DEBUGINFO[key]
+    # The debug info is located within the prototype, so the whole one is
+    # read at once.
+    buf = bytearray(read_memory(pt, sizept))
+    lines = None
+    if lineinfo and sizebc:
+        deltas = proto_lineinfo(buf, lineinfo - pt, sizebc, numline)
+        lines = [firstline] + [firstline + delta for delta in deltas] + \
+            [firstline + numline]
+    variables = proto_varinfo(buf, varinfo - pt) if varinfo else []
+    payload, _ = strpayload(chunkname)
+    info = (strtext(payload), firstline, lines, variables)
+    PROTO_DEBUGINFO[key] = info
+    return info
+
+
+def frameraw_pc(slots, nextframe):
+    # Get the PC the frame is suspended at from the frame it calls or None
+    # if the PC is unknown (e.g. for the topmost frame or the one called
+    # from C).
+    if nextframe is None:
+        return None
+    ftsz = frameraw_ftsz(slots, nextframe)
+    if frameraw_islua(ftsz):
+        return ftsz
+    if ftsz & FRAME_TYPE == FRAME['CONT']:
+        # The continuation PC is stored in the slot below the framelink.
+        return frameraw_ftsz(slots, nextframe - 1 - LJ_FR2)
+    return None
+
+
+def proto_locals(variables, pos):
+    # The variables alive at the given position occupy the frame slots in
+    # the order they are defined.
+    return [name for name, startpc, endpc in variables
+            if startpc <= pos < endpc]
+
+
+def backtrace_frames(L, stack, slots):
+    level = 0
+    nextframe = None
+    raw = frames_raw(L, stack, slots)
+    for link, _, ftsz, prev in raw:
+        if prev is None:
+            break
+        callee, nextframe = nextframe, link
+        func = frameraw_func(slots, link)
+        # The dummy frames (e.g. the ones of lua_cpcall) refer the
+        # coroutine instead of the function.
+        if func == L:
+            continue
+        frametype = dump_frametype(ftsz)
+        if frametype == 'V':
+            # The original frame of the vararg function below is shown as
+            # the vararg one.
+            original = next(raw, None)
+            if original is not None:
+                nextframe = original[0]
+                frametype = dump_frametype(original[2])
+        chunk = line = None
+        variables = []
+        if read_field(func, 'GCfuncC', 'ffid') == 0:
+            pt = funcproto(func)
+            chunk, _, lines, info = proto_debuginfo(pt)
+            pc = frameraw_pc(slots, callee)
+            pos = None if pc is None else \
+                (pc - pt - sizeof('GCproto')) // 4 - 1
+            # The PC is out of the prototype bytecode in case of the trace
+            # exit, so it is not decoded (as well as the stripped one).
+            if pos is not None and lines is not None \
+                    and 0 <= pos < len(lines) - 1:
+                line = lines[pos]
+                for slot, name in enumerate(proto_locals(info, pos)):
+                    index = link + 1 + slot
+                    if index < len(slots):
+                        variables.append(
+                            (name, stack + index * 8, slots[index])
+                        )
+        yield level, link, frametype, func, chunk, line, variables
+        level += 1
+
+
+def backtrace(L):
+    # Get the stack address and the generator yielding (<level>,
+    # <framelink slot>, <frame type>, <GCfunc>, <chunk>, <line or None>,
+    # [(<name>, <slot address>, <slot>)]) for the frames of the given
+    # coroutine from the top one. The frames are decoded lazily, so the
+    # top ones are got cheaply.
+    stack, slots = read_stack(L)
+    return stack, backtrace_frames(L, stack, slots)
+
+
+def dump_backtrace(L, structured=False):
+    segmap = lightud_segmap(G(L))
+    tvalue = record_tvalue if structured else dump_tvalue
+    tfunc = record_lj_tfunc if structured else dump_lj_tfunc
+    stack, frames = backtrace(L)
+    for level, link, frametype, func, chunk, line, variables in frames:
+        if structured:
+            yield {
+                'kind': 'frame',
+                'level': level,
+                'addr': strx64(stack + link * 8),
+                'type': frametype,
+                'func': tfunc(func),
+                'chunk': chunk,
+                'line': line,
+            }
+        elif chunk is None:
+            yield '#{:<3} [{:<2}] {}'.format(level, frametype, tfunc(func))
+        else:
+            yield '#{:<3} [{:<2}] {}:{} in {}'.format(
+                level, frametype, chunk, '?' if line is None else line,
+                tfunc(func),
+            )
+        for name, addr, u64 in variables:
+            if structured:
+                yield {
+                    'kind': 'local',
+                    'level': level,
+                    'name': name,
+                    'addr': strx64(addr),
+                    'value': tvalue(u64, segmap),
+                }
+            else:
+                yield '{:<10}{} {} = {}'.format(
+                    '', strx64(addr), name, tvalue(u64, segmap)
+                )
+
+
+# }}}
+
+
+# Mixed backtrace {{{
+
+
+# The native frames the VM code is executed in are named after the symbol
+# of the VM code being executed (e.g. lj_BC_FUNCC for the C function call)
+# rather than the VM entry (lj_vm_call, lj_vm_pcall or lj_vm_cpcall), so
+# all the VM code symbols are considered.
+VM_FRAME_PREFIXES = ('lj_BC_', 'lj_cont_', 'lj_ff_', 'lj_fff_', 'lj_vm_',
+                     'lj_vmeta_')
+# The VM functions called with their own native frame: the FFI call and
+# the helpers called from C, the traces or the VM code (see lj_vm.h and
+# lj_vmmath.c).
+VM_NATIVE_FUNCTIONS = (
+    'lj_vm_ffi_call', 'lj_vm_cachesync', 'lj_vm_cpuid', 'lj_vm_errno',
+    'lj_vm_foldarith', 'lj_vm_foldfpm', 'lj_vm_log2', 'lj_vm_modi',
+    'lj_vm_tobit', 'lj_vm_floor', 'lj_vm_ceil', 'lj_vm_trunc',
+    'lj_vm_floor_sf', 'lj_vm_ceil_sf', 'lj_vm_trunc_sf', 'lj_vm_floor_sse',
+    'lj_vm_ceil_sse', 'lj_vm_trunc_sse',
+)
+# The frames the VM is entered with from C (see lua_call and lua_pcall).
+VM_ENTRY_FRAMES = ('C', 'CP')
+
+
+def is_vm_frame(function):
+    # The function is None (or its address) if the frame has no symbol.
+    if not hasattr(function, 'startswith'):
+        return False
+    name = function.split('(')[0].strip()
+    return name.startswith(VM_FRAME_PREFIXES) and \
+        name not in VM_NATIVE_FUNCTIONS
+
+
+def current_L(g=None):
+    # Get the coroutine currently run by the given VM (the selected one by
+    # default).
+    mainthread = main_L() if g is None \
+        else read_field(g, 'global_State', 'mainthref')
+    cur = read_field(G(mainthread), 'global_State', 'cur_L') \
+        if has_field('global_State', 'cur_L') else 0
+    return cur or mainthread
+
+
+# See CFRAME_RAWMASK in lj_frame.h.
+CFRAME_RAWMASK = ~3
+
+
+def vm_entry_L(sp, older_sp=None):
+    # Get the coroutine run by the VM entry with the native frame at <sp>
+    # (the frame ends at <older_sp>) or None if it's not run by any of the
+    # selected and the known VMs. The VM keeps the address of its native
+    # frame in L->cframe, so the threads of the different VMs are not
+    # mixed up. The VMs are not discovered here, since it switches the
+    # threads (see vm_discover).
+    candidates = [None] + list(KNOWN_VMS)
+    for g in candidates:
+        try:
+            cur = current_L(g)
+            cframe = read_field(cur, 'lua_State', 'cframe') & CFRAME_RAWMASK
+        except Error:
+            continue
+        if cframe == sp or older_sp is not None and sp <= cframe < older_sp:
+            return cur
+    return None
+
+
+def vm_frames(L):
+    # Get the Lua frames of the given coroutine grouped by the VM entries
+    # they are executed in, from the top one: [[(<function>, <chunk>,
+    # <line>, [(<local name>, <slot address>)])]]. The C functions are
+    # omitted, since they have the native frames.
+    def build():
+        _, frames = backtrace(L)
+        segments = [[]]
+        for _, _, frametype, func, chunk, line, variables in frames:
+            ffid = read_field(func, 'GCfuncC', 'ffid')
+            if ffid == 0:
+                _, firstline, _, _ = proto_debuginfo(funcproto(func))
+                function = 'Lua function <{}:{}>'.format(chunk, firstline)
+                segments[-1].append((
+                    function, chunk, line,
+                    [(name, addr) for name, addr, _ in variables],
+                ))
+            elif ffid > 1:
+                segments[-1].append((dump_lj_tfunc(func), None, None, []))
+            if frametype in VM_ENTRY_FRAMES:
+                segments.append([])
+        return segments
+
+    return stop_cached(('vm_frames', L), build)
+
+
+def dump_vm_function(frame):
+    return '[Lua] {}'.format(frame[0])
+
+
+def dump_vm_frame(frame):
+    _, chunk, line, _ = frame
+    if chunk is None:
+        return dump_vm_function(frame)
+    return '{} at {}:{}'.format(
+        dump_vm_function(frame), chunk, '?' if line is None else line
+    )
+
+
+# }}}
+
+
+# Tables {{{
+
+
+def node_format():
+    # struct module format of the Node decoded as (<val>, <key>, <next>).
+    nextofs, nextsize = fieldof('Node', 'next')
+    return struct_format(sizeof('Node'), [
+        (offsetof('Node', 'val'), 'Q'),
+        (offsetof('Node', 'key'), 'Q'),
+        (nextofs, UINT_FORMAT[nextsize]),
+    ])
+
+
+def table_slots(t, part, start=0):
+    # The generator yields (<part>, <address>, <index>, <raw key>, <raw
+    # value>, <next node>) for the slots of the given part of the table
+    # ('apart' or 'hpart') starting from <start>. The raw key and the next
+    # node are None for the array part. The slots are read by chunks, so
+    # the huge table is read only as far as the slots are consumed.
+    if part == 'apart':
+        size = read_field(t, 'GCtab', 'asize')
+        base = read_field(t, 'GCtab', 'array')
+        slotsize, fmt = sizeof('TValue'), 'Q'
+    else:
+        hmask = read_field(t, 'GCtab', 'hmask')
+        size = hmask + 1 if hmask > 0 else 0
+        base = read_field(t, 'GCtab', 'node')
+        slotsize, fmt = sizeof('Node'), node_format()
+    for first in range(start, size, CHUNK_SIZE):
+        count = min(CHUNK_SIZE, size - first)
+        buf = read_memory(base + first * slotsize, count * slotsize)
+        for i, record in enumerate(unpack_records(buf, fmt, count)):
+            if part == 'apart':
+                val, key, nextnode = record[0], None, None
+            else:
+                val, key, nextnode = record
+            yield (part, base + (first + i) * slotsize, first + i, key,
+                   val, nextnode)
+
+
+def dump_tabslot(slot, structured, segmap):
+    part, addr, index, key, val, nextnode = slot
+    tvalue = record_tvalue if structured else dump_tvalue
+    if part == 'apart':
+        record = {
+            'kind': 'array',
+            'addr': strx64(addr),
+            'index': index,
+            'value': tvalue(val, segmap),
+        }
+        return record if structured \
+            else '{addr}: [{index}]: {value}'.format(**record)
+    record = {
+        'kind': 'node',
+        'addr': strx64(addr),
+        'key': tvalue(key, segmap),
+        'value': tvalue(val, segmap),
+        'next': strx64(nextnode),
+    }
+    return record if structured else '{addr}: {{ {key} }} => ' \
+        '{{ {value} }}; next = {next}'.format(**record)
+
+
+def slot_matcher(keytype=None, valtype=None, pattern=None, nonnil=False):
+    # Build the predicate of the slots yielded by table_slots to be dumped
+    # or None if all of them are. The types are the ones of TVALUE_TYPES,
+    # the keys of the array part are numbers and only the string keys
+    # match the <pattern>. The parts of the table that may contain such
+    # slots are returned as well.
+    parts = ('hpart',) if pattern is not None \
+        or keytype not in (None, 'number') else ('apart', 'hpart')
+    if keytype is None and valtype is None and pattern is None \
+            and not nonnil:
+        return None, parts
+    nil = LJ_T['NIL']
+
+    def typename(u64):
+        return TVALUE_TYPES.get(typenames(tvraw_itypemap(u64)), 'invalid')
+
+    def match(slot):
+        part, _, _, key, val, _ = slot
+        if nonnil and tvraw_itypemap(val) == nil:
+            return False
+        if valtype is not None and typename(val) != valtype:
+            return False
+        ktype = 'number' if part == 'apart' else typename(key)
+        if keytype is not None and ktype != keytype:
+            return False
+        if pattern is not None:
+            return ktype == 'string' and pattern.search(
+                strpayload(tvraw_gcval(key))[0]
+            ) is not None
+        return True
+
+    return match, parts
+
+
+def dump_table(t, structured=False, offset=0, limit=None, match=None,
+               parts=('apart', 'hpart')):
+    mt = read_field(t, 'GCtab', 'metatable')
+    hmask = read_field(t, 'GCtab', 'hmask')
+    capacity = {
+        'apart': read_field(t, 'GCtab', 'asize'),
+        'hpart': hmask + 1 if hmask > 0 else 0
+    }
+
+    if structured:
+        yield {
+            'kind': 'table',
+            'addr': strx64(t),
+            'metatable': strx64(mt) if mt != 0 else None,
+            'asize': capacity['apart'],
+            'hsize': capacity['hpart'],
+        }
+    elif mt != 0:
+        yield 'Metatable detected: {}'.format(strx64(mt))
+
+    # The lightuserdata segments are read once for all the slots.
+    segmap = lightud_segmap(G(main_L()))
+
+    # The slots are skipped with no reads unless they are filtered.
+    starts = {'apart': 0, 'hpart': 0}
+    skip = offset
+    if match is None:
+        for part in ('apart', 'hpart'):
+            starts[part] = min(skip, capacity[part])
+            skip -= starts[part]
+
+    shown = 0
+    for part, title in (('apart', 'Array part: {} slots'),
+                        ('hpart', 'Hash part: {} nodes')):
+        if not structured:
+            yield title.format(capacity[part])
+        if part not in parts:
+            continue
+        for slot in table_slots(t, part, starts[part]):
+            if match is not None and not match(slot):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            if limit is not None and shown == limit:
+                # The next slot to be dumped is found, so the page is
+                # not the last one.
+                if structured:
+                    yield {'kind': 'page', 'next': offset + shown}
+                else:
+                    yield 'Next page: --offset {}'.format(offset + shown)
+                return
+            shown += 1
+            yield dump_tabslot(slot, structured, segmap)
+
+
+def table_lookup(t, key):
+    # Find the slot of the table with the given key the same way as
+    # lj_tab_get does and return it as table_slots does, or None. The key
+    # is either ('string', <payload>), ('number', <float>) or ('boolean',
+    # <bool>).
+    ktype, kval = key
+    asize = read_field(t, 'GCtab', 'asize')
+    if ktype == 'number' and not math.isinf(kval) and kval == int(kval) \
+            and -2 ** 31 <= kval < 2 ** 31:
+        if 0 <= kval < asize:
+            return next(table_slots(t, 'apart', int(kval)))
+        # The integer keys are hashed as doubles (see lj_tab_getinth);
+        # -0 is normalized to 0.
+        kval = float(int(kval))
+
+    if ktype == 'string':
+        # The string keys are compared by their hashes and payloads, so the
+        # string table of the VM the table belongs to isn't involved.
+        hashes = str_hashes(kval)
+        itype = LJ_T['STR']
+
+        def equal(u64):
+            gcstr = tvraw_gcval(u64)
+            return read_field(gcstr, 'GCstr', 'hash') in hashes \
+                and read_field(gcstr, 'GCstr', 'len') == len(kval) \
+                and read_memory(gcstr + sizeof('GCstr'), len(kval)) == kval
+    elif ktype == 'number':
+        u64 = struct.unpack('=Q', struct.pack('=d', kval))[0]
+        # The target the VM is built for isn't recorded in the layout, so
+        # both variants of the number hash are tried.
+        hashes = [hashrot(u64 & U32_MASK, (u64 >> 32) << 1 & U32_MASK, x86)
+                  for x86 in (True, False)]
+        itype = LJ_T['NUMX']
+
+        def equal(u64):
+            if LJ_DUALNUM and tvraw_itype(u64) == LJ_TISNUM:
+                return tvraw_int(u64) == kval
+            return tvraw_num(u64) == kval
+    else:
+        # See boolV in lj_obj.h.
+        hashes = [int(kval)]
+        itype = LJ_T['TRUE' if kval else 'FALSE']
+
+        def equal(u64):
+            return True
+
+    hmask = read_field(t, 'GCtab', 'hmask')
+    nodes = read_field(t, 'GCtab', 'node')
+    nodesize = sizeof('Node')
+    fmt = node_format()
+    for index in sorted(set(h & hmask for h in hashes)):
+        # The chain length is limited for the case of the corrupted one.
+        for _ in range(hmask + 1):
+            addr = nodes + index * nodesize
+            val, k, nextnode = struct.unpack(
+                ENDIAN + fmt, read_memory(addr, nodesize)
+            )
+            if tvraw_itypemap(k) == itype and equal(k):
+                return 'hpart', addr, index, k, val, nextnode
+            if not nextnode:
+                break
+            index = (nextnode - nodes) // nodesize
+    return None
+
+
+def dump_tablookup(t, key, text, structured=False):
+    slot = table_lookup(t, key)
+    if slot is not None:
+        yield dump_tabslot(slot, structured, lightud_segmap(G(main_L())))
+    elif structured:
+        yield {'kind': 'missing', 'addr': strx64(t), 'key': text}
+    else:
+        yield 'Key {} is not found'.format(text)
+
+
+def table_strkeys(t):
+    # Get {<string key payload>: <raw value>} for the non-nil slots of the
+    # hash part of the given table with the string keys.
+    hmask = read_field(t, 'GCtab', 'hmask')
+    if hmask <= 0:
+        return {}
+    nodesize = sizeof('Node')
+    fmt = struct_format(nodesize, [
+        (offsetof('Node', 'val'), 'Q'),
+        (offsetof('Node', 'key'), 'Q'),
+    ])
+    buf = read_memory(read_field(t, 'GCtab', 'node'), (hmask + 1) * nodesize)
+    keys = {}
+    for val, key in unpack_records(buf, fmt, hmask + 1):
+        if typenames(tvraw_itypemap(key)) == 'LJ_TSTR' \
+                and typenames(tvraw_itypemap(val)) != 'LJ_TNIL':
+            keys[strpayload(tvraw_gcval(key))[0]] = val
+    return keys
+
+
+# }}}
+
+
+# Walk budget {{{
+
+
+STOP_TIME = 'time budget exhausted'
+STOP_OBJECTS = 'object budget exhausted'
+STOP_INTERRUPTED = 'interrupted'
+
+# z-score for the 95% confidence intervals of the estimates.
+CONFIDENCE_Z = 1.96
+
+# The relative error of the estimate that has no statistical bound (e.g.
+# the one extrapolated from the biased sample).
+NO_BOUND = float('inf')
+
+
+class WalkBudget(object):
+    # The clock is checked once per the given number of objects.
+    CLOCK_PERIOD = 256
+
+    def __init__(self, seconds=None, objects=None):
+        self.deadline = None if seconds is None else time.time() + seconds
+        self.objects = objects
+        self.visited = 0
+        self.stopped = None
+
+    def share(self, fraction):
+        # Budget for the nested walk limited by the given fraction of the
+        # remaining budget.
+        seconds = None if self.deadline is None \
+            else max(0, self.deadline - time.time()) * fraction
+        objects = None if self.objects is None \
+            else int((self.objects - self.visited) * fraction)
+        return WalkBudget(seconds, objects)
+
+    def charge(self, nested):
+        self.visited += nested.visited
+        if nested.stopped == STOP_INTERRUPTED:
+            self.stopped = STOP_INTERRUPTED
+
+    def step(self):
+        # Check whether the next object can be visited. The check is done
+        # before the object is taken, so no object beyond the budget is
+        # read from the memory.
+        if self.stopped is not None:
+            return False
+        if self.objects is not None and self.visited >= self.objects:
+            self.stopped = STOP_OBJECTS
+        elif self.visited % self.CLOCK_PERIOD == 0:
+            # Some backends (e.g. LLDB) don't raise KeyboardInterrupt
+            # within the script, so the interrupt request is polled with
+            # the clock.
+            if BACKEND.interrupted():
+                self.stopped = STOP_INTERRUPTED
+            elif self.deadline is not None and time.time() >= self.deadline:
+                self.stopped = STOP_TIME
+        return self.stopped is None
+
+    def walk(self, walker):
+        # The generator yields the items of the given <walker> until the
+        # budget is exhausted. Ctrl-C (i.e. KeyboardInterrupt) is expected
+        # to be handled by the caller by setting self.stopped.
+        walker = iter(walker)
+        while self.step():
+            try:
+                item = next(walker)
+            except StopIteration:
+                return
+            self.visited += 1
+            yield item
+
+
+class SizeSample(object):
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.sumsq = 0
+
+    def add(self, size):
+        self.count += 1
+        self.bytes += size
+        self.sumsq += size * size
+
+    def rse(self, population):
+        # Relative standard error of the mean size (with the finite
+        # population correction), i.e. the relative error of the sizes
+        # extrapolated from this sample.
+        if self.count < 2 or not self.bytes:
+            return 1.0
+        mean = self.bytes / float(self.count)
+        variance = max(0.0, self.sumsq / float(self.count) - mean * mean) \
+            * self.count / (self.count - 1)
+        fpc = max(0.0, 1.0 - self.count / float(population)) \
+            if population else 1.0
+        return math.sqrt(variance / self.count * fpc) / mean
+
+
+def dump_estimate(value, error):
+    # <error> is the relative error of the estimated value, NO_BOUND if
+    # the value is estimated with no error bound or None if the value is
+    # exact.
+    if error is None:
+        return '{}'.format(int(value))
+    if error == NO_BOUND:
+        return '~{:.0f}'.format(value)
+    return '~{:.0f} (+/-{:.1%})'.format(value, min(error, 1.0))
+
+
+def record_error(error):
+    # NO_BOUND is not a valid JSON number, so the values estimated with
+    # no error bound are reported with the null error and the estimated
+    # flag set.
+    return None if error == NO_BOUND else error
+
+
+def max_error(a, b):
+    # None stands for the exact value.
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, b)
+
+
+def dump_count(count, error, stopped):
+    # Lower bound is reported if the walk is stopped and the count can't
+    # be extrapolated.
+    if stopped is not None and error is None:
+        return '>= {} ({})'.format(count, stopped)
+    return dump_estimate(count, error)
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    # argparse terminates the whole process on error by default.
+    def error(self, message):
+        raise Error('{}: {}'.format(self.prog, message))
+
+
+def parse_budget(command, arg):
+    parser = ArgumentParser(prog=command, add_help=False)
+    parser.add_argument('--time', type=float, metavar='SECONDS')
+    parser.add_argument('--objects', type=int, metavar='N')
+    args = parser.parse_args(shlex.split(arg or ''))
+    if args.time is not None and args.time <= 0 \
+            or args.objects is not None and args.objects <= 0:
+        raise Error('{}: budget must be positive'.format(command))
+    return WalkBudget(args.time, args.objects)
+
+
+# }}}
+
+
+# Heap census {{{
+
+
+HEAP_TYPES = {
+    'LJ_TSTR':    'string',
+    'LJ_TUPVAL':  'upvalue',
+    'LJ_TTHREAD': 'thread',
+    'LJ_TPROTO':  'proto',
+    'LJ_TFUNC':   'function',
+    'LJ_TTRACE':  'trace',
+    'LJ_TCDATA':  'cdata',
+    'LJ_TTAB':    'table',
+    'LJ_TUDATA':  'userdata',
+}
+
+# The fields required to compute the size of the GC object of the
+# particular type. Signed fields are prefixed with '-'.
+HEAP_FIELDS = {
+    'LJ_TSTR':    ('GCstr', ['len']),
+    'LJ_TUPVAL':  ('GCupval', ['closed']),
+    'LJ_TTHREAD': ('lua_State', ['stacksize']),
+    'LJ_TPROTO':  ('GCproto', ['sizept']),
+    'LJ_TFUNC':   ('GCfuncC', ['ffid', 'nupvalues']),
+    'LJ_TTRACE':  ('GCtrace', ['nins', 'nk', 'nsnap', 'nsnapmap']),
+    'LJ_TCDATA':  ('GCcdata', ['ctypeid']),
+    'LJ_TTAB':    ('GCtab', ['-colo', 'asize', 'hmask']),
+    'LJ_TUDATA':  ('GCudata', ['len']),
+}
+
+# See CTInfo layout and CT_* in lj_ctype.h.
+CTSHIFT_NUM = 28
+CT_HASSIZE = 5
+CT_ATTRIB = 8
+CTMASK_CID = 0xffff
+
+
+def field_decoder(typestr, field):
+    signed = field.startswith('-')
+    offset, size = fieldof(typestr, field.lstrip('-'))
+    return offset, ENDIAN + (INT_FORMAT if signed else UINT_FORMAT)[size]
+
+
+def heap_layout():
+    # Compile the field decoders for the GC object header and all the
+    # fields listed in HEAP_FIELDS, and find the minimal window to be read
+    # to decode any object at once.
+    layout = {
+        'nextgc': field_decoder('GChead', 'nextgc'),
+        'marked': field_decoder('GChead', 'marked'),
+        'gct':    field_decoder('GChead', 'gct'),
+        'types':  {},
+    }
+    window = max(offset + struct.calcsize(fmt) for offset, fmt in [
+        layout['nextgc'], layout['marked'], layout['gct']
+    ])
+    for gct, (typestr, fields) in HEAP_FIELDS.items():
+        # The types absent in this build (e.g. GCtrace with no JIT) can't
+        # be met in the heap.
+        if LAYOUT['types'].get(typestr, {}) is None:
+            continue
+        decoders = [(f.lstrip('-'), field_decoder(typestr, f))
+                    for f in fields]
+        layout['types'][gct] = decoders
+        for _, (offset, fmt) in decoders:
+            window = max(window, offset + struct.calcsize(fmt))
+    layout['window'] = window
+    return layout
+
+
+def heap_unpack(buf, decoder):
+    offset, fmt = decoder
+    return struct.unpack_from(fmt, buf, offset)[0]
+
+
+def read_gcobj(addr, layout):
+    try:
+        return read_memory(addr, layout['window'])
+    except MemoryReadError:
+        # The object is too close to the end of the mapped region, so
+        # read only the header and the type specific part.
+        header = read_memory(addr, sizeof('GChead'))
+        gct = typenames(i2notu32(heap_unpack(header, layout['gct'])))
+        typestr = HEAP_FIELDS.get(gct, ('GChead', None))[0]
+        return read_memory(addr, sizeof(typestr))
+
+
+def ctype_size(g, ctypeid, cache):
+    # Get the size of the raw C type (see ctype_raw in lj_ctype.h and
+    # lj_cdata_free in lj_cdata.c).
+    if ctypeid in cache:
+        return cache[ctypeid]
+    cts = read_field(g, 'global_State', 'ctype_state')
+    tab = read_field(cts, 'CTState', 'tab')
+    infodec = field_decoder('CType', 'info')
+    sizedec = field_decoder('CType', 'size')
+    ctsize = sizeof('CType')
+    cid = ctypeid
+    while True:
+        ct = read_memory(tab + cid * ctsize, ctsize)
+        info = heap_unpack(ct, infodec)
+        if info >> CTSHIFT_NUM != CT_ATTRIB:
+            break
+        cid = info & CTMASK_CID
+    size = heap_unpack(ct, sizedec) if info >> CTSHIFT_NUM <= CT_HASSIZE \
+        else (8 if LJ_64 else 4)
+    cache[ctypeid] = size
+    return size
+
+
+def gcobj_size(g, gct, addr, fields, ctcache):
+    # The rules below follow the ones used by the VM to free the objects
+    # (see lj_*_free functions).
+    if gct == 'LJ_TSTR':
+        return sizeof('GCstr') + fields['len'] + 1
+    elif gct == 'LJ_TUPVAL':
+        return sizeof('GCupval')
+    elif gct == 'LJ_TTHREAD':
+        return sizeof('lua_State') + fields['stacksize'] * sizeof('TValue')
+    elif gct == 'LJ_TPROTO':
+        return fields['sizept']
+    elif gct == 'LJ_TFUNC':
+        # FF_LUA is 0 (see lj_obj.h).
+        if fields['ffid'] == 0:
+            return sizeof('GCfuncL') - sizeof('GCRef') \
+                + sizeof('GCRef') * fields['nupvalues']
+        return sizeof('GCfuncC') - sizeof('TValue') \
+            + sizeof('TValue') * fields['nupvalues']
+    elif gct == 'LJ_TTRACE':
+        return ((sizeof('GCtrace') + 7) & ~7) \
+            + (fields['nins'] - fields['nk']) * sizeof('IRIns') \
+            + fields['nsnap'] * sizeof('SnapShot') \
+            + fields['nsnapmap'] * sizeof('SnapEntry')
+    elif gct == 'LJ_TCDATA':
+        if fields['marked'] & 0x80:
+            # Variable length cdata (see cdataisv in lj_obj.h).
+            varsize = sizeof('GCcdataVar')
+            var = read_memory(addr - varsize, varsize)
+            return heap_unpack(var, field_decoder('GCcdataVar', 'len')) \
+                + heap_unpack(var, field_decoder('GCcdataVar', 'extra'))
+        return sizeof('GCcdata') + ctype_size(g, fields['ctypeid'], ctcache)
+    elif gct == 'LJ_TTAB':
+        size = sizeof('GCtab')
+        if fields['hmask'] > 0:
+            size += (fields['hmask'] + 1) * sizeof('Node')
+        if fields['asize'] > 0 and fields['colo'] <= 0:
+            size += fields['asize'] * sizeof('TValue')
+        if fields['colo']:
+            # The colocated array part (see sizetabcolo in lj_obj.h).
+            size += (fields['colo'] & 0x7f) * sizeof('TValue')
+        return size
+    elif gct == 'LJ_TUDATA':
+        return sizeof('GCudata') + fields['len']
+    return 0
+
+
+def gclist_walk(addr, layout, end=0):
+    # The generator yields (<address>, <raw object>) pairs for every
+    # object in the list linked via nextgc.
+    while addr != end:
+        obj = read_gcobj(addr, layout)
+        yield addr, obj
+        addr = heap_unpack(obj, layout['nextgc'])
+
+
+def gcring_walk(last, layout):
+    # The same as above but for the ring list (see gc.mmudata): <last>
+    # is the tail of the ring, so the walk starts from its successor.
+    if not last:
+        return
+    addr = heap_unpack(read_gcobj(last, layout), layout['nextgc'])
+    while True:
+        obj = read_gcobj(addr, layout)
+        yield addr, obj
+        if addr == last:
+            return
+        addr = heap_unpack(obj, layout['nextgc'])
+
+
+def strhash_walk(g, layout, shuffle=True):
+    # Strings are not linked to gc.root, but to the string hash chains.
+    # The chunks of chains are visited in random order (unless <shuffle>
+    # is false), so the partial walk gives a fair sample of strings.
+    refsize = sizeof('GCRef')
+    anchors = read_field(g, 'global_State', 'strhash')
+    nanchors = read_field(g, 'global_State', 'strmask') + 1
+    fmt = UINT_FORMAT[refsize]
+    starts = list(range(0, nanchors, CHUNK_SIZE))
+    if shuffle:
+        random.shuffle(starts)
+    for start in starts:
+        count = min(CHUNK_SIZE, nanchors - start)
+        buf = read_memory(anchors + start * refsize, count * refsize)
+        for (chain,) in unpack_records(buf, fmt, count):
+            for addr, obj in gclist_walk(chain, layout):
+                yield addr, obj
+
+
+def root_walk(root, layout):
+    # The open upvalues are linked to the coroutines rather than to
+    # gc.root, so they are walked right after the gc.root list.
+    threads = []
+    thread = i2notu32(LJ_T['THREAD'])
+    for addr, obj in gclist_walk(root, layout):
+        if heap_unpack(obj, layout['gct']) == thread:
+            threads.append(addr)
+        yield addr, obj
+    for thread in threads:
+        uv = read_field(thread, 'lua_State', 'openupval')
+        for item in gclist_walk(uv, layout):
+            yield item
+
+
+def heap_walk(g, layout, strings=True):
+    # The generator yields (<address>, <raw object>) pairs for all the GC
+    # objects in the heap: strings (unless omitted), gc.mmudata, gc.root
+    # and the open upvalues.
+    gc = gcstate(g)
+    for walker in (
+        strhash_walk(g, layout) if strings else [],
+        gcring_walk(read_field(gc, 'GCState', 'mmudata'), layout),
+        root_walk(read_field(gc, 'GCState', 'root'), layout),
+    ):
+        for item in walker:
+            yield item
+
+
+def heap_decode(obj, layout):
+    # Decode the type of the raw object and the fields listed in
+    # HEAP_FIELDS for it.
+    gct = typenames(i2notu32(heap_unpack(obj, layout['gct'])))
+    fields = {'marked': heap_unpack(obj, layout['marked'])}
+    for field, decoder in layout['types'].get(gct, []):
+        fields[field] = heap_unpack(obj, decoder)
+    return gct, fields
+
+
+def heap_census(g, budget):
+    layout = heap_layout()
+    ctcache = {}
+    gc = gcstate(g)
+    # The main coroutine is allocated within GG_State.
+    mainthread = read_field(g, 'global_State', 'mainthref')
+    # Size samples per object type for strings, gc.mmudata and gc.root
+    # (with the open upvalues).
+    samples = {'strings': {}, 'mmudata': {}, 'root': {}}
+    totals = {}
+    # The open upvalues are not linked to gc.root, so they are not
+    # counted as its length.
+    openupvals = []
+
+    def visit(walker, kind, walk_budget):
+        totals[kind] = SizeSample()
+        try:
+            for addr, obj in walk_budget.walk(walker):
+                gct, fields = heap_decode(obj, layout)
+                size = gcobj_size(g, gct, addr, fields, ctcache)
+                if addr == mainthread:
+                    size += sizeof('GG_State') - sizeof('lua_State')
+                if gct == 'LJ_TUPVAL' and not fields['closed']:
+                    openupvals.append(addr)
+                name = HEAP_TYPES.get(gct, 'invalid')
+                samples[kind].setdefault(name, SizeSample()).add(size)
+                totals[kind].add(size)
+        except KeyboardInterrupt:
+            walk_budget.stopped = STOP_INTERRUPTED
+        return walk_budget.stopped is None
+
+    # Strings are sampled at first with the half of the budget. The short
+    # gc.mmudata list goes next to be counted exactly and the rest of the
+    # budget is spent on gc.root.
+    strbudget = budget.share(0.5)
+    strdone = visit(strhash_walk(g, layout), 'strings', strbudget)
+    budget.charge(strbudget)
+    mmudata = read_field(gc, 'GCState', 'mmudata')
+    visit(gcring_walk(mmudata, layout), 'mmudata', budget)
+    root = read_field(gc, 'GCState', 'root')
+    rootdone = visit(root_walk(root, layout), 'root', budget)
+
+    strhash = (read_field(g, 'global_State', 'strmask') + 1) \
+        * sizeof('GCRef')
+    total = read_field(gc, 'GCState', 'total')
+    census = {}
+
+    def account(name, count, nbytes, count_error, bytes_error):
+        stat = census.setdefault(name, [0, 0, None, None])
+        stat[0] += count
+        stat[1] += nbytes
+        # Keep the largest relative error for simplicity.
+        stat[2] = max_error(stat[2], count_error)
+        stat[3] = max_error(stat[3], bytes_error)
+
+    # The number of strings is known, so only their sizes are estimated.
+    strings = totals['strings']
+    strnum = read_field(g, 'global_State', 'strnum') if not strdone \
+        else strings.count
+    strscale = strnum / float(strings.count) if strings.count else 1.0
+    strerror = None if strdone else CONFIDENCE_Z * strings.rse(strnum)
+    for name, sample in samples['strings'].items():
+        account(name, sample.count * strscale, sample.bytes * strscale,
+                None, strerror)
+
+    for name, sample in samples['mmudata'].items():
+        account(name, sample.count, sample.bytes, None, None)
+
+    # The rest of the heap (i.e. gc.total without the objects above) is
+    # considered to be the objects from gc.root with the same size
+    # distribution as the walked ones. gc.root is ordered from the newest
+    # objects to the oldest, so the walked ones are not a random sample
+    # and the extrapolated values have no statistical error bound.
+    walked = totals['root']
+    rootnum = walked.count
+    if not rootdone and walked.bytes:
+        rest = total - strhash - strings.bytes * strscale \
+            - totals['mmudata'].bytes
+        rootnum = walked.count * max(rest, walked.bytes) \
+            / float(walked.bytes)
+    rooterror = None if rootdone or not walked.bytes else NO_BOUND
+    rootscale = rootnum / float(walked.count) if walked.count else 1.0
+    for name, sample in samples['root'].items():
+        account(name, sample.count * rootscale, sample.bytes * rootscale,
+                rooterror, rooterror)
+
+    return {
+        'types': census,
+        'strhash': strhash,
+        'total': total,
+        'walked': budget.visited,
+        'stopped': budget.stopped if not rootdone or not strdone else None,
+        'root': (rootnum - len(openupvals), rooterror,
+                 None if rootdone else budget.stopped),
+    }
+
+
+def dump_heap(g, budget, structured=False):
+    census = heap_census(g, budget)
+    types = census['types']
+    estimated = census['stopped'] is not None
+    nobjects = sum(stat[0] for stat in types.values())
+    nbytes = sum(stat[1] for stat in types.values())
+    approx = '~' if estimated else ''
+    ordered = sorted(types.items(), key=lambda item: -item[1][1])
+    other = max(0, census['total'] - nbytes - census['strhash'])
+
+    if structured:
+        yield {
+            'kind': 'heap',
+            'objects': int(nobjects),
+            'bytes': int(nbytes),
+            'total': census['total'],
+            'strhash': census['strhash'],
+            'other': int(other),
+            'walked': census['walked'],
+            'stopped': census['stopped'],
+        }
+        for key, (count, size, count_error, bytes_error) in ordered:
+            yield {
+                'kind': 'heap_type',
+                'type': key,
+                'count': int(count),
+                'bytes': int(size),
+                'count_error': record_error(count_error),
+                'bytes_error': record_error(bytes_error),
+                'estimated': (count_error is not None or
+                              bytes_error is not None),
+            }
+        return
+
+    stats = ['{key}: {count} objects, {size} bytes'.format(
+        key=key,
+        count=dump_estimate(count, count_error),
+        size=dump_estimate(size, bytes_error),
+    ) for key, (count, size, count_error, bytes_error) in ordered]
+    stats += [
+        'string hash: {} bytes'.format(census['strhash']),
+        'other: {}{:.0f} bytes'.format(approx, other),
+    ]
+    if estimated:
+        stats += [
+            'estimated from {walked} objects ({stopped}): the strings are '
+            'sampled at random (the error bounds are 95% confidence '
+            'intervals), gc.root is extrapolated from its newest objects '
+            '(no error bound)'.format(**census),
+        ]
+    yield 'Heap census: {approx}{nobjects:.0f} objects, ' \
+        '{approx}{nbytes:.0f} bytes (gc.total: {total} bytes)'.format(
+            approx=approx,
+            nobjects=nobjects,
+            nbytes=nbytes,
+            total=census['total'],
+        )
+    for stat in stats:
+        yield '\t' + stat
+
+
+# }}}
+
+
+# Table stats {{{
+
+
+# The names of the key types (see table_stats).
+TVALUE_TYPES = dict(HEAP_TYPES, **{
+    'LJ_TNIL':     'nil',
+    'LJ_TFALSE':   'false',
+    'LJ_TTRUE':    'true',
+    'LJ_TLIGHTUD': 'light userdata',
+    'LJ_TNUMX':    'number',
+})
+
+
+def table_freetop(t, nodes):
+    # The top of the free nodes is stored in the table for GC64 and in
+    # the first node otherwise (see getfreetop in lj_obj.h).
+    if has_field('GCtab', 'freetop'):
+        return read_field(t, 'GCtab', 'freetop')
+    if has_field('Node', 'freetop'):
+        return read_field(nodes, 'Node', 'freetop')
+    return None
+
+
+def table_stats(t):
+    # Get the occupancy of the array and the hash parts of the table,
+    # the lengths of its hash chains and the types of its keys.
+    asize = read_field(t, 'GCtab', 'asize')
+    hmask = read_field(t, 'GCtab', 'hmask')
+    hsize = hmask + 1 if hmask > 0 else 0
+    nil = LJ_T['NIL']
+    stats = {
+        'asize': asize,
+        'hsize': hsize,
+        'array': 0,
+        'nodes': 0,
+        'dead': 0,
+        'free': None,
+        'keys': collections.Counter(),
+        'chains': collections.Counter(),
+        'longest': 0,
+    }
+
+    if asize:
+        buf = read_memory(read_field(t, 'GCtab', 'array'),
+                          asize * sizeof('TValue'))
+        stats['array'] = sum(1 for (u64,) in unpack_records(buf, 'Q', asize)
+                             if tvraw_itypemap(u64) != nil)
+
+    if hsize:
+        nodes = read_field(t, 'GCtab', 'node')
+        nodesize = sizeof('Node')
+        buf = read_memory(nodes, hsize * nodesize)
+        keyset = bytearray(hsize)
+        succ = [-1] * hsize
+        linked = bytearray(hsize)
+        for i, (val, key, nextnode) in enumerate(
+            unpack_records(buf, node_format(), hsize)
+        ):
+            ktype = tvraw_itypemap(key)
+            if ktype == nil:
+                continue
+            keyset[i] = 1
+            if tvraw_itypemap(val) == nil:
+                # The key is kept in the chain when the slot is cleared.
+                stats['dead'] += 1
+            else:
+                stats['nodes'] += 1
+                stats['keys'][TVALUE_TYPES.get(typenames(ktype),
+                                               'invalid')] += 1
+            if nextnode:
+                succ[i] = (nextnode - nodes) // nodesize
+                if 0 <= succ[i] < hsize:
+                    linked[succ[i]] = 1
+        # Every chain starts at the main position of its keys, i.e. at
+        # the node no other node is linked to.
+        for i in range(hsize):
+            if not keyset[i] or linked[i]:
+                continue
+            length, node = 0, i
+            # The length is limited for the case of the corrupted chains.
+            while 0 <= node < hsize and length < hsize:
+                length += 1
+                node = succ[node]
+            stats['chains'][length] += 1
+            stats['longest'] = max(stats['longest'], length)
+        # The free nodes are searched downwards from freetop, the table
+        # is rehashed when none is left (see lj_tab_newkey in lj_tab.c).
+        freetop = table_freetop(t, nodes)
+        if freetop is not None:
+            top = max(0, min(hsize, (freetop - nodes) // nodesize))
+            stats['free'] = top - sum(keyset[:top])
+
+    stats['wasted'] = (asize - stats['array']) * sizeof('TValue') \
+        + (hsize - stats['nodes']) * sizeof('Node')
+    return stats
+
+
+def dump_ratio(used, total):
+    return '{}/{} ({:.1%})'.format(used, total,
+                                   used / float(total) if total else 0)
+
+
+def dump_chains(chains, structured):
+    # The chain lengths are bucketed the same way as by lj-strtab.
+    buckets = {}
+    for length, count in chains.items():
+        bucket = buckets.setdefault(chain_buckets(length), [0, 0])
+        bucket[0] += count
+        bucket[1] += length * count
+    for (lo, hi), (count, nodes) in sorted(buckets.items()):
+        if structured:
+            yield {'kind': 'chains', 'min': lo, 'max': hi,
+                   'chains': count, 'nodes': nodes}
+        else:
+            yield '\t{}: {} chains, {} nodes'.format(
+                lo if lo == hi else '{}-{}'.format(lo, hi), count, nodes
+            )
+
+
+def dump_keytypes(keys, structured):
+    for name, count in sorted(keys.items(), key=lambda item: -item[1]):
+        if structured:
+            yield {'kind': 'keys', 'type': name, 'count': count}
+        else:
+            yield '\t{}: {}'.format(name, count)
+
+
+def record_tabstats(t, stats):
+    return {
+        'addr': strx64(t),
+        'asize': stats['asize'],
+        'array': stats['array'],
+        'hsize': stats['hsize'],
+        'nodes': stats['nodes'],
+        'dead': stats['dead'],
+        'free': stats['free'],
+        'longest': stats['longest'],
+        'wasted': stats['wasted'],
+    }
+
+
+def dump_tabstats(t, structured=False):
+    stats = table_stats(t)
+    if structured:
+        record = {'kind': 'tabstats'}
+        record.update(record_tabstats(t, stats))
+        yield record
+    else:
+        hsize = stats['hsize']
+        yield 'Table: {}'.format(dump_lj_ttab(t))
+        yield '\tarray part: {} slots used'.format(
+            dump_ratio(stats['array'], stats['asize'])
+        )
+        yield '\thash part: {} nodes used, load factor {:.2f}'.format(
+            dump_ratio(stats['nodes'], hsize),
+            stats['nodes'] / float(hsize) if hsize else 0,
+        )
+        yield '\tdead keys: {}'.format(stats['dead'])
+        if stats['free'] is not None:
+            yield '\tfree nodes before rehash: {}'.format(stats['free'])
+        yield '\tlongest chain: {}'.format(stats['longest'])
+        yield '\twasted: {} bytes'.format(stats['wasted'])
+        yield 'Chain lengths:'
+    for line in dump_chains(stats['chains'], structured):
+        yield line
+    if not structured:
+        yield 'Key types:'
+    for line in dump_keytypes(stats['keys'], structured):
+        yield line
+
+
+def dump_tables(g, count, worst, structured=False):
+    layout = heap_layout()
+    budget = WalkBudget()
+    totals = collections.Counter()
+    chains = collections.Counter()
+    keys = collections.Counter()
+    # The top tables by the wasted bytes and by the longest chain.
+    rankings = {'wasted': [], 'longest': []}
+    try:
+        for addr, obj in budget.walk(heap_walk(g, layout, strings=False)):
+            if heap_decode(obj, layout)[0] != 'LJ_TTAB':
+                continue
+            stats = table_stats(addr)
+            totals['tables'] += 1
+            for field in ('asize', 'array', 'hsize', 'nodes', 'dead',
+                          'wasted'):
+                totals[field] += stats[field]
+            chains.update(stats['chains'])
+            keys.update(stats['keys'])
+            for key, top in rankings.items():
+                item = (stats[key], addr, stats)
+                if len(top) < count:
+                    heapq.heappush(top, item)
+                elif item[:2] > top[0][:2]:
+                    heapq.heapreplace(top, item)
+    except KeyboardInterrupt:
+        budget.stopped = STOP_INTERRUPTED
+
+    if structured:
+        record = {'kind': 'tables', 'stopped': budget.stopped}
+        record.update((field, totals[field]) for field in (
+            'tables', 'asize', 'array', 'hsize', 'nodes', 'dead', 'wasted'
+        ))
+        yield record
+    else:
+        yield 'Tables: {} tables, {} bytes wasted{}'.format(
+            totals['tables'], totals['wasted'],
+            ' ({})'.format(budget.stopped) if budget.stopped else '',
+        )
+        yield '\tarray part: {} slots used'.format(
+            dump_ratio(totals['array'], totals['asize'])
+        )
+        yield '\thash part: {} nodes used'.format(
+            dump_ratio(totals['nodes'], totals['hsize'])
+        )
+        yield '\tdead keys: {}'.format(totals['dead'])
+        yield 'Chain lengths:'
+    for line in dump_chains(chains, structured):
+        yield line
+    if not structured:
+        yield 'Key types:'
+    for line in dump_keytypes(keys, structured):
+        yield line
+    if not worst:
+        return
+
+    for key, title in (('wasted', 'Most wasteful tables:'),
+                       ('longest', 'Longest chains:')):
+        if not structured:
+            yield title
+        for _, addr, stats in sorted(rankings[key], key=lambda item:
+                                     item[:2], reverse=True):
+            if structured:
+                record = {'kind': 'table_' + key}
+                record.update(record_tabstats(addr, stats))
+                yield record
+            else:
+                yield '\t{} bytes wasted, longest chain {}: {}, ' \
+                    'array {}, hash {}'.format(
+                        stats['wasted'], stats['longest'],
+                        dump_lj_ttab(addr),
+                        dump_ratio(stats['array'], stats['asize']),
+                        dump_ratio(stats['nodes'], stats['hsize']),
+                    )
+
+
+# }}}
+
+
+# Coroutines {{{
+
+
+# See lua.h.
+LUA_OK = 0
+LUA_YIELD = 1
+
+
+def coroutine_status(co, current, status, stack, base, top):
+    # The same as coroutine.status reports (see lib_base.c).
+    if co == current:
+        return 'running'
+    if status == LUA_YIELD:
+        return 'suspended'
+    if status != LUA_OK:
+        return 'dead'
+    if base > stack + (1 + LJ_FR2) * 8:
+        return 'normal'
+    if top == base:
+        return 'dead'
+    return 'suspended'
+
+
+def coroutine_location(co):
+    # Get (<chunk>, <line or None>) of the top Lua frame of the given
+    # coroutine or None if there is no Lua frames.
+    try:
+        _, frames = backtrace(co)
+    except MemoryReadError:
+        return None
+    for _, _, _, _, chunk, line, _ in frames:
+        if chunk is not None:
+            return chunk, line
+    return None
+
+
+def coroutine_stats(co, mainthread, current):
+    status, stack, base, top, stacksize = read_fields(
+        co, 'lua_State', ['status', 'stack', 'base', 'top', 'stacksize']
+    )
+    return {
+        'main': co == mainthread,
+        'current': co == current,
+        'status': coroutine_status(co, current, status, stack, base, top),
+        'slots': stacksize,
+        'bytes': stacksize * sizeof('TValue'),
+        'used': (top - stack) >> 3,
+        'location': coroutine_location(co),
+    }
+
+
+def record_coroutine(co, stats):
+    record = {'kind': 'coroutine', 'addr': strx64(co)}
+    record.update(stats)
+    location = stats['location']
+    record['location'] = None if location is None else {
+        'chunk': location[0], 'line': location[1],
+    }
+    return record
+
+
+def dump_coroutine(co, stats):
+    marks = [mark for mark in ('main', 'current') if stats[mark]]
+    location = stats['location']
+    return '{addr} {status}{marks}: {slots} slots ({bytes} bytes), ' \
+        '{used} used, {location}'.format(
+            addr=strx64(co),
+            status=stats['status'],
+            marks=' ({})'.format(', '.join(marks)) if marks else '',
+            slots=stats['slots'],
+            bytes=stats['bytes'],
+            used=stats['used'],
+            location='no Lua frames' if location is None else
+            'at {}:{}'.format(
+                location[0], '?' if location[1] is None else location[1]
+            ),
+        )
+
+
+def dump_coroutines(g, stacks, structured=False):
+    layout = heap_layout()
+    budget = WalkBudget()
+    mainthread = read_field(g, 'global_State', 'mainthref')
+    current = read_field(g, 'global_State', 'cur_L') \
+        if has_field('global_State', 'cur_L') else 0
+    coroutines = []
+    try:
+        # The main coroutine is linked to gc.root as well.
+        for addr, obj in budget.walk(heap_walk(g, layout, strings=False)):
+            if heap_decode(obj, layout)[0] == 'LJ_TTHREAD':
+                coroutines.append(
+                    (addr, coroutine_stats(addr, mainthread, current))
+                )
+    except KeyboardInterrupt:
+        budget.stopped = STOP_INTERRUPTED
+    coroutines.sort(key=lambda item: (-item[1]['bytes'], item[0]))
+
+    total = sum(stats['bytes'] for _, stats in coroutines)
+    if structured:
+        yield {
+            'kind': 'coroutines',
+            'count': len(coroutines),
+            'bytes': total,
+            'stopped': budget.stopped,
+        }
+    else:
+        yield 'Coroutines: {} coroutines, {} bytes of stacks{}'.format(
+            len(coroutines), total,
+            ' ({})'.format(budget.stopped) if budget.stopped else '',
+        )
+    for co, stats in coroutines:
+        yield record_coroutine(co, stats) if structured \
+            else '\t' + dump_coroutine(co, stats)
+    if not stacks:
+        return
+
+    # The coroutines found above are dumped with no heap walk, their
+    # stacks are likely to be cached already.
+    for co, stats in coroutines:
+        if not structured:
+            yield ''
+            yield 'Coroutine {}'.format(dump_coroutine(co, stats))
+        try:
+            for line in dump_stack(co, structured):
+                yield line
+        except MemoryReadError as e:
+            if structured:
+                yield {'kind': 'error', 'L': strx64(co), 'error': str(e)}
+            else:
+                yield 'Failed to dump the stack: {}'.format(e)
+
+
+# }}}
+
+
+# Traces {{{
+
+
+# See REF_* in lj_ir.h: the constants grow downwards from REF_BIAS and
+# the instructions grow upwards from it. REF_BIAS itself is the IR_BASE
+# pseudo instruction, so the first one is REF_FIRST.
+REF_BIAS = 0x8000
+REF_FIRST = REF_BIAS + 1
+# See IRT_* in lj_ir.h.
+IRT_TYPE = 0x1f
+IRT_ISPHI = 0x40
+IRT_GUARD = 0x80
+# See IRSLOAD_* in lj_ir.h, the flags by their bits.
+IRSLOAD_FLAGS = 'PFTCRI'
+# See IRCONV_* in lj_ir.h.
+IRCONV_SRCMASK = 0x001f
+IRCONV_DSH = 5
+IRCONV_SEXT = 0x0800
+# See SNAP_* in lj_jit.h.
+SNAP_FRAME = 0x010000
+SNAP_SOFTFPNUM = 0x080000
+SNAPCOUNT_DONE = 255
+
+# The enums the names of the IR opcodes, types and literals are taken
+# from: the prefix stripped from the enumerators and whether the names are
+# lowercased (as jit.dump does).
+IR_ENUMS = {
+    'IROp':       ('IR_', False),
+    'IRType':     ('IRT_', True),
+    'IRCallID':   ('IRCALL_', False),
+    'IRFPMathOp': ('IRFPM_', True),
+    'TraceLink':  ('LJ_TRLINK_', True),
+}
+
+# The name tables built from the enums above (see ir_names). The enums
+# are not changed within the session, so the tables are built once.
+IR_NAMES = {}
+
+# The modes of the IR instruction operands (see IRDEF in lj_ir.h):
+# 'ref' is the IR reference, 'lit' is the literal, 'cst' is the constant
+# value. The opcodes missing here refer two IR instructions.
+IR_OPERANDS = {
+    op: modes for modes, ops in (
+        ((None, None), 'NOP GCSTEP LOOP PROF KPRI LREF XBAR'),
+        (('lit', 'lit'), 'BASE SLOAD TNEW'),
+        (('lit', None), 'PVAL'),
+        (('ref', None), 'USE BNOT BSWAP ALOAD HLOAD ULOAD VLOAD TDUP TBAR '
+                        'STRTO'),
+        (('ref', 'lit'), 'RENAME KSLOT FPMATH UREFO UREFC FREF FLOAD '
+                         'XLOAD BUFHDR CONV TOSTR CALLN CALLA CALLL CALLS'),
+        (('cst', None), 'KINT KGC KPTR KKPTR KNULL KNUM KINT64'),
+    ) for op in ops.split()
+}
+
+TRACE_FIELDS = ['traceno', 'nins', 'nk', 'nsnap', 'nsnapmap', 'ir', 'snap',
+                'snapmap', 'startpt', 'startpc', 'mcode', 'szmcode',
+                'mcloop', 'link', 'root', 'linktype']
+SNAPSHOT_FIELDS = ['mapofs', 'ref', 'mcofs', 'nslots', 'topslot', 'nent',
+                   'count']
+
+
+def ir_names(typestr):
+    # Get {<value>: <name>} of the given enum (see IR_ENUMS). The first
+    # enumerator wins for the aliases (e.g. IRT_PTR for IRT_P64).
+    if typestr not in IR_NAMES:
+        prefix, lower = IR_ENUMS[typestr]
+        names = {}
+        for name, value in enum_layout(typestr):
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+            names.setdefault(value, name.lower() if lower else name)
+        IR_NAMES[typestr] = names
+    return IR_NAMES[typestr]
+
+
+def ir_name(typestr, value):
+    # The optional enums (e.g. IRCallID) are absent in some builds, so the
+    # literals are shown as is then.
+    try:
+        return ir_names(typestr).get(value, str(value))
+    except Error:
+        return str(value)
+
+
+def trace_by_number(g, traceno):
+    j = J(g)
+    sizetrace = read_field(j, 'jit_State', 'sizetrace')
+    trace = read_refs(read_field(j, 'jit_State', 'trace') +
+                      traceno * sizeof('GCRef'), 1)[0] \
+        if 0 < traceno < sizetrace else 0
+    if not trace:
+        raise Error('lj-trace: trace #{} is not found'.format(traceno))
+    return trace
+
+
+def read_trace(trace):
+    gct = typenames(i2notu32(read_field(trace, 'GChead', 'gct')))
+    if gct != 'LJ_TTRACE':
+        raise Error('lj-trace: {} is not a trace'.format(strx64(trace)))
+    return dict(zip(TRACE_FIELDS,
+                    read_fields(trace, 'GCtrace', TRACE_FIELDS)))
+
+
+def trace_location(fields):
+    # Get <chunk>:<line> the trace is started at.
+    chunk, _, lines, _ = proto_debuginfo(fields['startpt'])
+    pos = (fields['startpc'] - fields['startpt'] - sizeof('GCproto')) // 4
+    if lines is None or not 0 <= pos < len(lines) - 1:
+        return '{}:?'.format(chunk)
+    return '{}:{}'.format(chunk, lines[pos])
+
+
+def ir_constant(op, irt, buf, offset):
+    # Format the constant at the given <offset> of the IR <buf> by its
+    # opcode. The 64-bit constants are stored in the next slot (see
+    # ir_isk64 in lj_ir.h).
+    def unpack(field, code):
+        fieldofs = sizeof('IRIns') if field is None \
+            else offsetof('IRIns', field)
+        return struct.unpack_from(ENDIAN + code, buf, offset + fieldofs)[0]
+
+    if op == 'KPRI':
+        return ir_names('IRType').get(irt & IRT_TYPE, '?')
+    elif op == 'KINT':
+        return '{:+d}'.format(unpack('i', 'i'))
+    elif op == 'KNUM':
+        return '{:+.14g}'.format(tvraw_num(unpack(None, 'Q')))
+    elif op == 'KINT64':
+        return '{}LL'.format(unpack(None, 'q'))
+    elif op == 'KNULL':
+        return 'NULL'
+    ref = unpack(None, 'Q') if LJ_GC64 else unpack('gcr', 'I')
+    if op != 'KGC':
+        return '[{}]'.format(strx64(ref))
+    try:
+        gct = typenames(i2notu32(read_field(ref, 'GChead', 'gct')))
+        if gct == 'LJ_TSTR':
+            return strdata(ref)
+        return gcdumpers.get(gct, dump_gcobj('object @ {}'))(ref)
+    except MemoryReadError:
+        return '[{}]'.format(strx64(ref))
+
+
+def ir_ref(constants, ref):
+    if ref < REF_BIAS:
+        return constants.get(ref, 'K{:03d}'.format(REF_BIAS - ref))
+    return '{:04d}'.format(ref - REF_BIAS)
+
+
+def ir_literal(op, n, value):
+    # Format the literal operand (the first one if <n> is 1) by the opcode.
+    if op == 'SLOAD':
+        if n == 1:
+            return '#{}'.format(value)
+        return ''.join(flag for bit, flag in enumerate(IRSLOAD_FLAGS)
+                       if value >> bit & 1)
+    elif op == 'KSLOT':
+        return '@{}'.format(value)
+    elif op == 'FPMATH':
+        return ir_name('IRFPMathOp', value)
+    elif op == 'CONV':
+        return '{}.{}{}'.format(
+            ir_name('IRType', value >> IRCONV_DSH & IRT_TYPE),
+            ir_name('IRType', value & IRCONV_SRCMASK),
+            ' sext' if value & IRCONV_SEXT else '',
+        )
+    elif op == 'BUFHDR' and value < 2:
+        return ('RESET', 'APPEND')[value]
+    elif op.startswith('CALL') and n == 2:
+        return ir_name('IRCallID', value)
+    return str(value)
+
+
+def trace_ir(fields):
+    # Get ({<constant ref>: <value>}, [(<ref>, <opcode>, <IRIns.t>,
+    # <operands>)]) with the constants and the instructions of the trace.
+    # The whole IR is read at once.
+    nk, nins = fields['nk'], fields['nins']
+    insize = sizeof('IRIns')
+    buf = read_memory(fields['ir'] + nk * insize, (nins - nk) * insize)
+    fmt = struct_format(insize, [
+        (offsetof('IRIns', field), code)
+        for field, code in (('op1', 'H'), ('op2', 'H'), ('t', 'B'),
+                            ('o', 'B'))
+    ])
+    records = list(unpack_records(buf, fmt, nins - nk))
+    opnames = ir_names('IROp')
+
+    constants = {}
+    kslots = []
+    ref = nk
+    while ref < REF_BIAS:
+        op1, op2, irt, o = records[ref - nk]
+        op = opnames.get(o, str(o))
+        if op == 'KSLOT':
+            # The key constant of the slot reference is not decoded yet.
+            kslots.append((ref, op1, op2))
+        else:
+            constants[ref] = ir_constant(op, irt, buf, (ref - nk) * insize)
+        # The 64-bit constants occupy the next slot as well.
+        if op in ('KNUM', 'KINT64') or \
+                LJ_GC64 and op in ('KGC', 'KPTR', 'KKPTR'):
+            ref += 1
+        ref += 1
+    for ref, key, slot in kslots:
+        constants[ref] = '{} @{}'.format(ir_ref(constants, key), slot)
+
+    instructions = []
+    # The constants are listed from REF_NIL downwards.
+    for ref in sorted(constants, reverse=True) + \
+            list(range(REF_FIRST, nins)):
+        op1, op2, irt, o = records[ref - nk]
+        op = opnames.get(o, str(o))
+        operands = []
+        for n, (mode, value) in enumerate(zip(
+                IR_OPERANDS.get(op, ('ref', 'ref')), (op1, op2)), 1):
+            if mode == 'ref':
+                operands.append(ir_ref(constants, value))
+            elif mode == 'lit':
+                operands.append(ir_literal(op, n, value))
+            elif mode == 'cst':
+                operands.append(constants[ref])
+        instructions.append((ref, op, irt, operands))
+    return constants, instructions
+
+
+def trace_snapshots(fields):
+    # Get [{<SnapShot field>: <value>, 'entries': [(<slot>, <ref>, <SnapEntry
+    # flags>)], 'pc': <BCIns *>}] for the snapshots of the trace.
+    nsnap, nsnapmap = fields['nsnap'], fields['nsnapmap']
+    snapsize = sizeof('SnapShot')
+    buf = read_memory(fields['snap'], nsnap * snapsize)
+    decoders = [field_decoder('SnapShot', field)
+                for field in SNAPSHOT_FIELDS]
+    snapmap = read_memory(fields['snapmap'], nsnapmap * 4)
+    snapshots = []
+    for n in range(nsnap):
+        snapshot = dict(zip(SNAPSHOT_FIELDS, [
+            struct.unpack_from(fmt, buf, n * snapsize + offset)[0]
+            for offset, fmt in decoders
+        ]))
+        mapofs, nent = snapshot['mapofs'], snapshot['nent']
+        entries = struct.unpack_from(
+            '{}{}I'.format(ENDIAN, nent), snapmap, mapofs * 4
+        )
+        snapshot['entries'] = [(sn >> 24, sn & 0xffff, sn & 0xff0000)
+                               for sn in entries]
+        # The PC (and the frame links) follow the entries (see snap_pc in
+        # lj_jit.h).
+        if LJ_FR2:
+            pc = struct.unpack_from(ENDIAN + 'Q', snapmap,
+                                    (mapofs + nent) * 4)[0] >> 8
+        else:
+            pc = struct.unpack_from(ENDIAN + 'I', snapmap,
+                                    (mapofs + nent) * 4)[0]
+        snapshot['pc'] = pc
+        snapshot['mcode'] = fields['mcode'] + \
+            snapshot['mcofs'] * sizeof('MCode')
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def snapshot_entry(constants, ref, flags):
+    # The soft-float number is split into two instructions.
+    if ref >= REF_BIAS and flags & SNAP_SOFTFPNUM:
+        return '{:04d}/{:04d}'.format(ref - REF_BIAS, ref - REF_BIAS + 1)
+    return ir_ref(constants, ref)
+
+
+def snapshot_slots(constants, snapshot):
+    # The slots missing in the snapshot are not modified by the trace.
+    entries = dict((slot, (ref, flags))
+                   for slot, ref, flags in snapshot['entries'])
+    slots = []
+    for slot in range(snapshot['nslots']):
+        if slot not in entries:
+            slots.append('----')
+            continue
+        ref, flags = entries[slot]
+        slots.append(snapshot_entry(constants, ref, flags) +
+                     ('|' if flags & SNAP_FRAME else ''))
+    return slots
+
+
+def dump_snapshot(n, constants, snapshot):
+    return '....{:10}SNAP   #{:<3} [ {} ] pc: {}, mcofs: {} ({}), ' \
+        'exits: {}'.format(
+            '', n, ' '.join(snapshot_slots(constants, snapshot)),
+            strx64(snapshot['pc']), snapshot['mcofs'],
+            strx64(snapshot['mcode']),
+            'linked' if snapshot['count'] == SNAPCOUNT_DONE
+            else snapshot['count'],
+        )
+
+
+def record_snapshot(n, constants, snapshot):
+    return {
+        'kind': 'snapshot',
+        'number': n,
+        'ref': ir_ref(constants, snapshot['ref']),
+        'slots': snapshot_slots(constants, snapshot),
+        'topslot': snapshot['topslot'],
+        'pc': strx64(snapshot['pc']),
+        'mcofs': snapshot['mcofs'],
+        'mcode': strx64(snapshot['mcode']),
+        'count': snapshot['count'],
+    }
+
+
+def dump_ir(ref, op, irt, operands):
+    return '{ref} {guard}{phi} {type:<7} {op:<6} {operands}'.format(
+        ref=ir_ref({}, ref),
+        guard='>' if irt & IRT_GUARD else ' ',
+        phi='+' if irt & IRT_ISPHI else ' ',
+        type=ir_names('IRType').get(irt & IRT_TYPE, '?'),
+        op=op,
+        operands=' '.join('{:<5}'.format(o) for o in operands),
+    ).rstrip()
+
+
+def record_ir(ref, op, irt, operands):
+    return {
+        'kind': 'ir',
+        'ref': ir_ref({}, ref),
+        'op': op,
+        'type': ir_names('IRType').get(irt & IRT_TYPE, '?'),
+        'guard': bool(irt & IRT_GUARD),
+        'phi': bool(irt & IRT_ISPHI),
+        'operands': operands,
+    }
+
+
+def trace_link(fields):
+    link = ir_name('TraceLink', fields['linktype'])
+    if fields['link'] and fields['link'] != fields['traceno']:
+        link += ' #{}'.format(fields['link'])
+    return link
+
+
+def dump_trace_header(trace, fields):
+    return 'TRACE #{traceno} @ {addr}: {location}, {nins} IR ' \
+        'instructions, {nsnap} snapshots, link: {link}{root}'.format(
+            traceno=fields['traceno'],
+            addr=strx64(trace),
+            location=trace_location(fields),
+            nins=fields['nins'] - REF_FIRST,
+            nsnap=fields['nsnap'],
+            link=trace_link(fields),
+            root=', root: #{}'.format(fields['root'])
+            if fields['root'] else '',
+        )
+
+
+def record_trace(trace, fields):
+    return {
+        'kind': 'trace',
+        'traceno': fields['traceno'],
+        'addr': strx64(trace),
+        'location': trace_location(fields),
+        'nins': fields['nins'] - REF_FIRST,
+        'nsnap': fields['nsnap'],
+        'link': fields['link'],
+        'linktype': ir_name('TraceLink', fields['linktype']),
+        'root': fields['root'],
+        'mcode': strx64(fields['mcode']),
+        'szmcode': fields['szmcode'],
+        'mcloop': fields['mcloop'],
+    }
+
+
+def dump_trace(trace, structured=False):
+    fields = read_trace(trace)
+    constants, instructions = trace_ir(fields)
+    snapshots = trace_snapshots(fields)
+    if structured:
+        yield record_trace(trace, fields)
+    else:
+        yield dump_trace_header(trace, fields)
+        yield 'mcode @ {}, {} bytes{}'.format(
+            strx64(fields['mcode']), fields['szmcode'],
+            ', loop @ {}'.format(strx64(fields['mcode'] + fields['mcloop']))
+            if fields['mcloop'] else '',
+        )
+    # The snapshots are shown before the instruction they are taken at
+    # (as jit.dump does).
+    n = 0
+    for ref, op, irt, operands in instructions:
+        while ref >= REF_FIRST and n < len(snapshots) and \
+                snapshots[n]['ref'] <= ref:
+            yield record_snapshot(n, constants, snapshots[n]) \
+                if structured else dump_snapshot(n, constants, snapshots[n])
+            n += 1
+        yield record_ir(ref, op, irt, operands) if structured \
+            else dump_ir(ref, op, irt, operands)
+    for n in range(n, len(snapshots)):
+        yield record_snapshot(n, constants, snapshots[n]) \
+            if structured else dump_snapshot(n, constants, snapshots[n])
+
+
+def dump_traces(g, structured=False):
+    j = J(g)
+    traces = read_refs(read_field(j, 'jit_State', 'trace'),
+                       read_field(j, 'jit_State', 'sizetrace'))
+    traces = [trace for trace in traces if trace]
+    if structured:
+        yield {'kind': 'traces', 'count': len(traces)}
+    else:
+        yield 'Traces: {}'.format(len(traces))
+    for trace in traces:
+        fields = read_trace(trace)
+        yield record_trace(trace, fields) if structured \
+            else '\t' + dump_trace_header(trace, fields)
+
+
+# }}}
+
+
+# Minidump {{{
+
+
+# The minidump is the sparse image of the process memory holding only the
+# Lua heap (i.e. all the GC objects with their out-of-line parts), the
+# guest stacks, GG_State (with global_State and jit_State), the string hash
+# table and the machine code of the traces. It is orders of magnitude
+# smaller than the whole core file and is read by luajit-core.py in place
+# of it. The file layout is the following:
+#
+#   <MINIDUMP_MAGIC> <header offset: u64> <header size: u64>
+#   <compressed block>...
+#   <header>
+#
+# The integers are little-endian and the header is JSON:
+# {
+#   'version': MINIDUMP_VERSION,
+#   'build_id': <GNU build-id of the LuaJIT objfile or null>,
+#   'layout': LAYOUT,
+#   'endian': ENDIAN,
+#   'globals': {<symbol>: <value>},
+#   'blocks': [[<address>, <size>, <file offset>, <compressed size>]],
+# }
+#
+# Every block is a run of the consecutive pages compressed with zlib on its
+# own, so the reader decompresses only the blocks being touched. The
+# globals are the ones of MAIN_L_GLOBALS found in the process.
+MINIDUMP_MAGIC = b'LJMDUMP\0'
+MINIDUMP_VERSION = 1
+MINIDUMP_HEADER = '<8sQQ'
+MINIDUMP_PAGE_SIZE = 4096
+# The maximum number of pages in a single block (i.e. 256Kb).
+MINIDUMP_BLOCK_PAGES = 64
+
+
+def gcobj_regions(g, gct, addr, fields, ctcache):
+    # The generator yields (<address>, <size>) for the memory allocated
+    # for the given GC object (see gcobj_size).
+    size = gcobj_size(g, gct, addr, fields, ctcache)
+    if gct == 'LJ_TCDATA' and fields['marked'] & 0x80:
+        # The variable length cdata is allocated before GCcdataVar.
+        var = addr - sizeof('GCcdataVar')
+        addr -= read_field(var, 'GCcdataVar', 'offset')
+    elif gct == 'LJ_TTHREAD':
+        size = sizeof('lua_State')
+        yield read_field(addr, 'lua_State', 'stack'), \
+            fields['stacksize'] * sizeof('TValue')
+    elif gct == 'LJ_TTAB':
+        size = sizeof('GCtab')
+        if fields['colo']:
+            size += (fields['colo'] & 0x7f) * sizeof('TValue')
+        elif fields['asize'] > 0:
+            yield read_field(addr, 'GCtab', 'array'), \
+                fields['asize'] * sizeof('TValue')
+        if fields['hmask'] > 0:
+            yield read_field(addr, 'GCtab', 'node'), \
+                (fields['hmask'] + 1) * sizeof('Node')
+    elif gct == 'LJ_TTRACE':
+        yield read_field(addr, 'GCtrace', 'mcode'), \
+            read_field(addr, 'GCtrace', 'szmcode')
+    yield addr, size
+
+
+def vm_regions(g):
+    # The generator yields (<address>, <size>) for the VM structures that
+    # are not GC objects.
+    gg = g - offsetof('GG_State', 'g')
+    yield gg, sizeof('GG_State')
+    yield read_field(g, 'global_State', 'strhash'), \
+        (read_field(g, 'global_State', 'strmask') + 1) * sizeof('GCRef')
+    gc = gcstate(g)
+    # The segment map is allocated on the first light userdata creation.
+    if LJ_64 and has_field('GCState', 'lightudseg') and \
+            read_field(gc, 'GCState', 'lightudseg') != 0:
+        yield read_field(gc, 'GCState', 'lightudseg'), \
+            4 * (read_field(gc, 'GCState', 'lightudnum') + 1)
+    if has_field('GG_State', 'J'):
+        j = J(g)
+        yield read_field(j, 'jit_State', 'trace'), \
+            read_field(j, 'jit_State', 'sizetrace') * sizeof('GCRef')
+    if has_field('global_State', 'ctype_state'):
+        cts = read_field(g, 'global_State', 'ctype_state')
+        if cts:
+            yield cts, sizeof('CTState')
+            yield read_field(cts, 'CTState', 'tab'), \
+                read_field(cts, 'CTState', 'sizetab') * sizeof('CType')
+
+
+def minidump_pages(g, budget):
+    # Collect the numbers of all the pages to be dumped.
+    layout = heap_layout()
+    ctcache = {}
+    pages = set()
+
+    def add(addr, size):
+        if addr and size > 0:
+            pages.update(range(addr // MINIDUMP_PAGE_SIZE,
+                               (addr + size - 1) // MINIDUMP_PAGE_SIZE + 1))
+
+    for addr, size in vm_regions(g):
+        add(addr, size)
+    for addr, obj in budget.walk(heap_walk(g, layout)):
+        gct, fields = heap_decode(obj, layout)
+        for region in gcobj_regions(g, gct, addr, fields, ctcache):
+            add(*region)
+    if budget.stopped is not None:
+        raise Error('lj-minidump: {}'.format(budget.stopped))
+    return sorted(pages)
+
+
+def page_runs(pages):
+    # The generator yields (<address>, <size>) for every run of the
+    # consecutive pages not longer than MINIDUMP_BLOCK_PAGES.
+    start = prev = None
+    for page in pages:
+        if start is not None and page == prev + 1 \
+                and page - start < MINIDUMP_BLOCK_PAGES:
+            prev = page
+            continue
+        if start is not None:
+            yield start * MINIDUMP_PAGE_SIZE, \
+                (prev - start + 1) * MINIDUMP_PAGE_SIZE
+        start = prev = page
+    if start is not None:
+        yield start * MINIDUMP_PAGE_SIZE, \
+            (prev - start + 1) * MINIDUMP_PAGE_SIZE
+
+
+def read_run(addr, size):
+    # The generator yields (<address>, <data>) for the readable parts of
+    # the given run. The memory is read as is bypassing the memory cache to
+    # not flush it.
+    try:
+        yield addr, BACKEND.read_memory(addr, size)
+        return
+    except MemoryReadError:
+        pass
+    # Some pages are not readable (e.g. the ones of the truncated core
+    # file), so the rest of them are read one by one.
+    for page in range(addr, addr + size, MINIDUMP_PAGE_SIZE):
+        try:
+            yield page, BACKEND.read_memory(page, MINIDUMP_PAGE_SIZE)
+        except MemoryReadError:
+            pass
+
+
+def write_minidump(path, g, budget):
+    pages = minidump_pages(g, budget)
+    globals_ = {}
+    for name in MAIN_L_GLOBALS:
+        value = BACKEND.lookup_global(name)
+        if value is not None:
+            globals_[name] = value
+    header = {
+        'version': MINIDUMP_VERSION,
+        'build_id': BUILD_ID,
+        'layout': LAYOUT,
+        'endian': ENDIAN,
+        'globals': globals_,
+        'blocks': [],
+    }
+    stats = {'bytes': 0}
+    try:
+        with open(path, 'wb') as dump:
+            offset = struct.calcsize(MINIDUMP_HEADER)
+            dump.write(b'\0' * offset)
+            for addr, size in page_runs(pages):
+                for start, data in read_run(addr, size):
+                    block = zlib.compress(data)
+                    dump.write(block)
+                    header['blocks'].append(
+                        [start, len(data), offset, len(block)]
+                    )
+                    offset += len(block)
+                    stats['bytes'] += len(data)
+                if BACKEND.interrupted():
+                    raise Error('lj-minidump: {}'.format(STOP_INTERRUPTED))
+            encoded = json.dumps(header, sort_keys=True).encode('ascii')
+            dump.write(encoded)
+            dump.seek(0)
+            dump.write(struct.pack(MINIDUMP_HEADER, MINIDUMP_MAGIC, offset,
+                                   len(encoded)))
+            stats['size'] = offset + len(encoded)
+    except (IOError, OSError) as e:
+        raise Error('lj-minidump: {}'.format(e))
+    except BaseException:
+        # Don't leave the partially written minidump (e.g. on Ctrl-C).
+        os.remove(path)
+        raise
+    stats['blocks'] = len(header['blocks'])
+    return stats
+
+
+# }}}
+
+
+# Dominator tree {{{
+
+
+# The object graph is stored in the compact integer arrays (i.e. the
+# compressed sparse rows): the objects are numbered in the order of their
+# addresses, and the objects referenced by the object <i> are the ones
+# from edges[offsets[i]] to edges[offsets[i + 1]]. The virtual root
+# referring to all the GC roots is numbered right after the objects.
+# array module has no 64-bit type codes in Python 2, so the ones of the
+# native word are used.
+ADDR_ARRAY = 'L'
+INDEX_ARRAY = 'l'
+
+# See lj_gc.h.
+LJ_GC_WEAKKEY = 0x08
+LJ_GC_WEAKVAL = 0x10
+LJ_GC_FIXED = 0x20
+
+
+def tvraw_gcref(u64):
+    # Get the address of the GC object referenced by the TValue or 0.
+    itype = tvraw_itypemap(u64)
+    return tvraw_gcval(u64) if LJ_T['UDATA'] <= itype <= LJ_T['STR'] \
+        else 0
+
+
+def read_refs(addr, count):
+    refsize = sizeof('GCRef')
+    if count <= 0:
+        return []
+    buf = read_memory(addr, count * refsize)
+    return [ref for (ref,) in unpack_records(buf, UINT_FORMAT[refsize],
+                                             count)]
+
+
+def read_tvrefs(addr, count):
+    if count <= 0:
+        return []
+    buf = read_memory(addr, count * sizeof('TValue'))
+    return [tvraw_gcref(u64) for (u64,) in unpack_records(buf, 'Q', count)]
+
+
+def gcobj_edges(gct, addr, fields):
+    # The generator yields (<edge type>, <name>, <address>) triplets for
+    # the GC objects referenced by the given one (see gc_traverse_* in
+    # lj_gc.c). The edge types are the following:
+    # * 'element': the array slot or the stack slot with the given index
+    # * 'property': the table slot with the given raw key TValue
+    # * 'context': the upvalue of the function with the given label
+    # * 'internal': the reference with the given label
+    # The weak references are skipped following the weak marks of the
+    # table set by the last GC traversal. The constants of the trace IR
+    # are not considered.
+    if gct == 'LJ_TTAB':
+        mt = read_field(addr, 'GCtab', 'metatable')
+        if mt:
+            yield 'internal', 'metatable', mt
+        weakkey = fields['marked'] & LJ_GC_WEAKKEY
+        weakval = fields['marked'] & LJ_GC_WEAKVAL
+        if fields['asize'] > 0 and not weakval:
+            slots = read_tvrefs(read_field(addr, 'GCtab', 'array'),
+                                fields['asize'])
+            for i, ref in enumerate(slots):
+                if ref:
+                    yield 'element', i, ref
+        if fields['hmask'] > 0 and not (weakkey and weakval):
+            nodesize = sizeof('Node')
+            nnodes = fields['hmask'] + 1
+            fmt = struct_format(nodesize, [
+                (offsetof('Node', 'val'), 'Q'),
+                (offsetof('Node', 'key'), 'Q'),
+            ])
+            buf = read_memory(read_field(addr, 'GCtab', 'node'),
+                              nnodes * nodesize)
+            for val, key in unpack_records(buf, fmt, nnodes):
+                ref = tvraw_gcref(val)
+                if ref and not weakval:
+                    yield 'property', key, ref
+                ref = tvraw_gcref(key)
+                if ref and not weakkey:
+                    yield 'internal', 'key', ref
+    elif gct == 'LJ_TFUNC':
+        yield 'internal', 'environment', read_field(addr, 'GCfuncC', 'env')
+        if fields['ffid'] == 0:
+            yield 'internal', 'prototype', funcproto(addr)
+            upvalues = read_refs(addr + offsetof('GCfuncL', 'uvptr'),
+                                 fields['nupvalues'])
+        else:
+            upvalues = read_tvrefs(addr + offsetof('GCfuncC', 'upvalue'),
+                                   fields['nupvalues'])
+        for i, ref in enumerate(upvalues):
+            if ref:
+                yield 'context', 'upvalue #{}'.format(i + 1), ref
+    elif gct == 'LJ_TUPVAL':
+        # The value of the open upvalue is retained by the stack.
+        if read_field(addr, 'GCupval', 'closed'):
+            ref = tvraw_gcref(read_tv(addr + offsetof('GCupval', 'tv')))
+            if ref:
+                yield 'internal', 'value', ref
+    elif gct == 'LJ_TPROTO':
+        yield 'internal', 'chunkname', \
+            read_field(addr, 'GCproto', 'chunkname')
+        # GC constants precede the numeric ones and are indexed backwards
+        # (see proto_kgc in lj_obj.h).
+        nkgc = read_field(addr, 'GCproto', 'sizekgc')
+        kgc = read_field(addr, 'GCproto', 'k') - nkgc * sizeof('GCRef')
+        for i, ref in enumerate(read_refs(kgc, nkgc)):
+            if ref:
+                yield 'internal', 'constant #{}'.format(nkgc - 1 - i), ref
+    elif gct == 'LJ_TTHREAD':
+        stack = read_field(addr, 'lua_State', 'stack')
+        top = read_field(addr, 'lua_State', 'top')
+        yield 'internal', 'environment', read_field(addr, 'lua_State', 'env')
+        slots = read_tvrefs(stack, (top - stack) // sizeof('TValue'))
+        for i, ref in enumerate(slots):
+            if ref:
+                yield 'element', i, ref
+        uv = read_field(addr, 'lua_State', 'openupval')
+        while uv:
+            yield 'internal', 'open upvalue', uv
+            uv = read_field(uv, 'GChead', 'nextgc')
+    elif gct == 'LJ_TUDATA':
+        mt = read_field(addr, 'GCudata', 'metatable')
+        if mt:
+            yield 'internal', 'metatable', mt
+        yield 'internal', 'environment', read_field(addr, 'GCudata', 'env')
+    elif gct == 'LJ_TTRACE':
+        yield 'internal', 'start prototype', \
+            read_field(addr, 'GCtrace', 'startpt')
+
+
+def gcobj_refs(gct, addr, fields):
+    # Get the addresses of the objects referenced by the given one.
+    return [ref for _, _, ref in gcobj_edges(gct, addr, fields)]
+
+
+# The types of the base metatables in gcroot[] (see GCROOT_BASEMT in
+# lj_obj.h) indexed by ~itype.
+BASEMT_TYPES = (
+    'nil', 'false', 'true', 'lightuserdata', 'string', 'upvalue', 'thread',
+    'proto', 'function', 'trace', 'cdata', 'table', 'userdata', 'number',
+)
+
+
+def gcroot_name(index, nroots):
+    # See GCROOT_* in lj_obj.h: the metamethod names are followed by the
+    # base metatables and the default I/O files.
+    nmmnames = nroots - len(BASEMT_TYPES) - 2
+    if index < nmmnames:
+        return 'metamethod name #{}'.format(index)
+    elif index < nroots - 2:
+        return 'base metatable of {}'.format(
+            BASEMT_TYPES[index - nmmnames]
+        )
+    return 'default I/O {}'.format(
+        'input' if index == nroots - 2 else 'output'
+    )
+
+
+def gc_roots(g, layout):
+    # Get (<label>, <address>) pairs for the objects the GC marks at first
+    # (see gc_mark_start in lj_gc.c) and the ones to be finalized.
+    roots = [
+        ('main coroutine', read_field(g, 'global_State', 'mainthref')),
+        ('registry', tvraw_gcref(read_tv(g + offsetof('global_State',
+                                                      'registrytv')))),
+    ]
+    offset, size = fieldof('global_State', 'gcroot')
+    gcroot = read_refs(g + offset, size // sizeof('GCRef'))
+    roots += [(gcroot_name(i, len(gcroot)), ref)
+              for i, ref in enumerate(gcroot)]
+    if has_field('GG_State', 'J'):
+        j = J(g)
+        traces = read_refs(read_field(j, 'jit_State', 'trace'),
+                           read_field(j, 'jit_State', 'sizetrace'))
+        roots += [('trace #{}'.format(i), ref)
+                  for i, ref in enumerate(traces)]
+    if has_field('global_State', 'ctype_state'):
+        cts = read_field(g, 'global_State', 'ctype_state')
+        if cts:
+            roots.append(('cdata finalizers',
+                          read_field(cts, 'CTState', 'finalizer')))
+    mmudata = read_field(gcstate(g), 'GCState', 'mmudata')
+    roots += [('pending finalizer', addr)
+              for addr, _ in gcring_walk(mmudata, layout)]
+    return roots
+
+
+class HeapGraph(object):
+
+    def __init__(self, g, budget):
+        layout = heap_layout()
+        ctcache = {}
+        mainthread = read_field(g, 'global_State', 'mainthref')
+        # The objects and their references in the walk order at first.
+        walked = array.array(ADDR_ARRAY)
+        sizes = array.array(ADDR_ARRAY)
+        types = bytearray()
+        offsets = array.array(ADDR_ARRAY, [0])
+        targets = array.array(ADDR_ARRAY)
+        for addr, obj in budget.walk(heap_walk(g, layout)):
+            gct, fields = heap_decode(obj, layout)
+            size = gcobj_size(g, gct, addr, fields, ctcache)
+            if addr == mainthread:
+                size += sizeof('GG_State') - sizeof('lua_State')
+            walked.append(addr)
+            sizes.append(size)
+            types.append(heap_unpack(obj, layout['gct']))
+            targets.extend(ref for ref in gcobj_refs(gct, addr, fields)
+                           if ref)
+            offsets.append(len(targets))
+        if budget.stopped is not None:
+            raise Error('the heap walk is {}'.format(budget.stopped))
+
+        # Renumber the objects in the order of their addresses, so the
+        # references are resolved via bisection.
+        n = len(walked)
+        self.count = n
+        self.root = n
+        self.addrs = array.array(ADDR_ARRAY, sorted(walked))
+        order = array.array(INDEX_ARRAY, [0]) * n
+        for position, addr in enumerate(walked):
+            order[self.index(addr)] = position
+        self.sizes = array.array(ADDR_ARRAY, (sizes[p] for p in order))
+        self.types = bytearray(types[p] for p in order)
+        self.offsets = array.array(ADDR_ARRAY, [0])
+        self.edges = array.array(INDEX_ARRAY)
+        for position in order:
+            self.add_edges(targets[offsets[position]:
+                                   offsets[position + 1]])
+        self.add_edges(ref for _, ref in gc_roots(g, layout))
+        self.reversed = None
+
+    def index(self, addr):
+        i = bisect.bisect_left(self.addrs, addr)
+        return i if i < self.count and self.addrs[i] == addr else -1
+
+    def add_edges(self, refs):
+        # The references to the objects that are not walked (e.g. the
+        # static strings of the VM) are dropped.
+        for ref in refs:
+            i = self.index(ref)
+            if i >= 0:
+                self.edges.append(i)
+        self.offsets.append(len(self.edges))
+
+    def postorder(self):
+        # Iterative DFS from the root; the unreachable objects are omitted.
+        order = array.array(INDEX_ARRAY)
+        visited = bytearray(self.count + 1)
+        nodes = array.array(INDEX_ARRAY, [self.root])
+        cursors = array.array(ADDR_ARRAY, [self.offsets[self.root]])
+        visited[self.root] = 1
+        while nodes:
+            v, e = nodes[-1], cursors[-1]
+            if e < self.offsets[v + 1]:
+                cursors[-1] = e + 1
+                w = self.edges[e]
+                if not visited[w]:
+                    visited[w] = 1
+                    nodes.append(w)
+                    cursors.append(self.offsets[w])
+            else:
+                nodes.pop()
+                cursors.pop()
+                order.append(v)
+        return order
+
+    def referrers(self):
+        # The reversed edges in the same layout, i.e. the objects referring
+        # to the object <i> are the ones from preds[offsets[i]] to
+        # preds[offsets[i + 1]]. They are built once on demand.
+        if self.reversed is not None:
+            return self.reversed
+        total = self.count + 1
+        offsets = array.array(ADDR_ARRAY, [0]) * (total + 1)
+        for w in self.edges:
+            offsets[w + 1] += 1
+        for i in range(total):
+            offsets[i + 1] += offsets[i]
+        preds = array.array(INDEX_ARRAY, [0]) * offsets[total]
+        cursors = array.array(ADDR_ARRAY, offsets)
+        for v in range(total):
+            for e in range(self.offsets[v], self.offsets[v + 1]):
+                w = self.edges[e]
+                preds[cursors[w]] = v
+                cursors[w] += 1
+        self.reversed = offsets, preds
+        return self.reversed
+
+    def dominators(self):
+        # Cooper, Harvey and Kennedy "A Simple, Fast Dominance Algorithm".
+        # Returns the immediate dominators (-1 for the unreachable objects)
+        # and the postorder the retained sizes are accumulated in.
+        order = self.postorder()
+        number = array.array(INDEX_ARRAY, [-1]) * (self.count + 1)
+        for i, v in enumerate(order):
+            number[v] = i
+        # The unreachable referrers have no dominator and are skipped.
+        offsets, preds = self.referrers()
+        idom = array.array(INDEX_ARRAY, [-1]) * (self.count + 1)
+        idom[self.root] = self.root
+        changed = True
+        while changed:
+            changed = False
+            # Reverse postorder with the root (i.e. the last one) omitted.
+            for i in range(len(order) - 2, -1, -1):
+                v = order[i]
+                new = -1
+                for e in range(offsets[v], offsets[v + 1]):
+                    p = preds[e]
+                    if idom[p] < 0:
+                        continue
+                    if new < 0:
+                        new = p
+                        continue
+                    while p != new:
+                        while number[p] < number[new]:
+                            p = idom[p]
+                        while number[new] < number[p]:
+                            new = idom[new]
+                if idom[v] != new:
+                    idom[v] = new
+                    changed = True
+        return idom, order
+
+    def retained(self):
+        # The object retains all the objects it dominates.
+        idom, order = self.dominators()
+        retained = array.array(ADDR_ARRAY, self.sizes)
+        retained.append(0)
+        for v in order:
+            if v != self.root:
+                retained[idom[v]] += retained[v]
+        return idom, retained, order
+
+
+def dump_gcobj_addr(addr, raw, structured):
+    gct = typenames(i2notu32(raw))
+    if structured:
+        return gcrecorders.get(gct, record_gcobj('invalid'))(addr)
+    return gcdumpers.get(gct, dump_gcobj('not valid type @ {}'))(addr)
+
+
+def heap_graph(g):
+    # The heap is walked in whole once per stop, but the walk can be
+    # interrupted via Ctrl-C. The graph is shared by the commands.
+    return stop_cached(('heap graph', g),
+                       lambda: HeapGraph(g, WalkBudget()))
+
+
+def dump_retained(g, count, structured=False):
+    graph = heap_graph(g)
+    idom, retained, order = graph.retained()
+    reachable = len(order) - 1
+    unreachable = graph.count - reachable
+    garbage = sum(graph.sizes) - retained[graph.root]
+    top = heapq.nlargest(count, (v for v in order if v != graph.root),
+                         key=lambda v: retained[v])
+
+    if structured:
+        yield {
+            'kind': 'retained_total',
+            'objects': reachable,
+            'bytes': retained[graph.root],
+            'unreachable_objects': unreachable,
+            'unreachable_bytes': garbage,
+        }
+    else:
+        yield 'Retained sizes: {} reachable objects, {} bytes ' \
+            '(unreachable: {} objects, {} bytes)'.format(
+                reachable, retained[graph.root], unreachable, garbage
+            )
+    for v in top:
+        dominator = None if idom[v] == graph.root \
+            else strx64(graph.addrs[idom[v]])
+        obj = dump_gcobj_addr(graph.addrs[v], graph.types[v], structured)
+        if structured:
+            yield {
+                'kind': 'retained',
+                'addr': strx64(graph.addrs[v]),
+                'retained': retained[v],
+                'self': graph.sizes[v],
+                'idom': dominator,
+                'object': obj,
+            }
+        else:
+            yield '\t{retained} bytes ({self} self), idom {idom}: ' \
+                '{obj}'.format(
+                    retained=retained[v],
+                    self=graph.sizes[v],
+                    idom=dominator or 'GC roots',
+                    obj=obj,
+                )
+
+
+# }}}
+
+
+# Reference paths {{{
+
+
+def dump_tabkey(u64):
+    # Render the table key the same way as the Lua code indexes the table.
+    itype = typenames(tvraw_itypemap(u64))
+    if itype == 'LJ_TSTR':
+        return strdata(tvraw_gcval(u64))
+    elif itype == 'LJ_TNUMX':
+        return dump_lj_tnumx(u64, None).split()[1]
+    elif itype in HEAP_TYPES:
+        return '{} @ {}'.format(HEAP_TYPES[itype],
+                                strx64(tvraw_gcval(u64)))
+    return dump_tvalue(u64)
+
+
+def edge_label(gct, etype, name):
+    # Render the edge yielded by gcobj_edges for the object of <gct> type.
+    if etype == 'element':
+        fmt = 'stack slot #{}' if gct == 'LJ_TTHREAD' else '[{}]'
+        return fmt.format(name)
+    elif etype == 'property':
+        return '[{}]'.format(dump_tabkey(name))
+    return name
+
+
+def gcobj_edge(gct, addr, fields, ref):
+    # Get the label of the reference to <ref> from the given object.
+    for etype, name, target in gcobj_edges(gct, addr, fields):
+        if target == ref:
+            return edge_label(gct, etype, name)
+    return 'reference'
+
+
+def reference_path(graph, target):
+    # Get the shortest path from the GC roots to the object <target>, i.e.
+    # the objects from the one referenced by a GC root to the <target>, or
+    # None if the object is not reachable. The referrers are walked
+    # breadth-first starting from the object, so only the objects closer
+    # to it than the roots are visited.
+    offsets, preds = graph.referrers()
+    succ = array.array(INDEX_ARRAY, [-1]) * (graph.count + 1)
+    succ[target] = target
+    frontier = [target]
+    while frontier and succ[graph.root] < 0:
+        following = []
+        for w in frontier:
+            for e in range(offsets[w], offsets[w + 1]):
+                v = preds[e]
+                if succ[v] < 0:
+                    succ[v] = w
+                    following.append(v)
+        frontier = following
+    if succ[graph.root] < 0:
+        return None
+    path = [succ[graph.root]]
+    while path[-1] != target:
+        path.append(succ[path[-1]])
+    return path
+
+
+def dump_whyalive(g, addr, structured=False):
+    graph = heap_graph(g)
+    target = graph.index(addr)
+    if target < 0:
+        raise Error('{} is not a GC object of the Lua heap'.format(
+            strx64(addr)
+        ))
+    obj = dump_gcobj_addr(addr, graph.types[target], structured)
+    path = reference_path(graph, target)
+    # The fixed objects (e.g. the reserved words) are never swept.
+    fixed = bool(read_field(addr, 'GChead', 'marked') & LJ_GC_FIXED)
+
+    labels = []
+    if path is not None:
+        layout = heap_layout()
+        first = graph.addrs[path[0]]
+        labels.append(next(label for label, ref in gc_roots(g, layout)
+                           if ref == first))
+        for v, w in zip(path, path[1:]):
+            gct, fields = heap_decode(read_gcobj(graph.addrs[v], layout),
+                                      layout)
+            labels.append(gcobj_edge(gct, graph.addrs[v], fields,
+                                     graph.addrs[w]))
+
+    if structured:
+        yield {
+            'kind': 'whyalive',
+            'object': obj,
+            'reachable': path is not None,
+            'fixed': fixed,
+            'path': labels,
+        }
+    elif path is None:
+        yield '{} is not reachable from GC roots{}'.format(
+            obj, ' (fixed)' if fixed else ''
+        )
+        return
+    else:
+        yield 'Shortest path from GC roots to {}:'.format(obj)
+        yield '\t' + ' -> '.join(labels)
+    for label, v in zip(labels, path or []):
+        step = dump_gcobj_addr(graph.addrs[v], graph.types[v], structured)
+        if structured:
+            yield {'kind': 'reference', 'edge': label, 'object': step}
+        else:
+            yield '\t{}: {}'.format(label, step)
+
+
+# }}}
+
+
+# Classes {{{
+
+
+# The limits of the breadth-first search of the paths to the tables from
+# the globals and the registry (see table_paths): the maximum depth of
+# the path, the maximum number of the tables found and the maximum
+# number of the hash slots of the table to be searched through.
+TABLE_PATH_DEPTH = 4
+TABLE_PATH_LIMIT = 10000
+TABLE_PATH_HSIZE = 4096
+
+# The maximum number of the keys listed in the label of the metatable.
+METATABLE_KEYS_LIMIT = 8
+
+
+def dump_pathkey(payload):
+    # Render the string key the same way as the Lua code indexes tables.
+    key = strtext(payload)
+    if re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', key):
+        return '.' + key
+    return '["{}"]'.format(strescape(payload))
+
+
+def table_paths(g):
+    # Get {<table address>: <path>} for the tables reachable from the
+    # globals (_G) and the registry via the string keys. The shortest path
+    # is found for every table within the limits above.
+    mainthread = read_field(g, 'global_State', 'mainthref')
+    registry = tvraw_gcref(read_tv(g + offsetof('global_State',
+                                                'registrytv')))
+    paths = {}
+    frontier = []
+    for path, table in [
+        ('_G', read_field(mainthread, 'lua_State', 'env')),
+        ('registry', registry),
+    ]:
+        if table and table not in paths:
+            paths[table] = path
+            frontier.append(table)
+    for depth in range(TABLE_PATH_DEPTH):
+        following = []
+        for table in frontier:
+            # The huge tables (e.g. the caches) are not the namespaces, so
+            # only the roots are searched regardless of their size.
+            hsize = read_field(table, 'GCtab', 'hmask') + 1
+            if depth > 0 and hsize > TABLE_PATH_HSIZE:
+                continue
+            for payload, val in sorted(table_strkeys(table).items()):
+                child = tvraw_gcval(val)
+                if typenames(tvraw_itypemap(val)) != 'LJ_TTAB' \
+                        or child in paths:
+                    continue
+                paths[child] = paths[table] + dump_pathkey(payload)
+                following.append(child)
+                if len(paths) >= TABLE_PATH_LIMIT:
+                    return paths
+        frontier = following
+    return paths
+
+
+class MetatableNames(object):
+    # The metatable is named by its __name, by the path to it from the
+    # globals or the registry (see table_paths), by the path to its
+    # __index table, or by the list of its string keys, in that order.
+    # The names don't depend on the addresses, so they're the same for
+    # the different processes of the same application.
+
+    def __init__(self, g):
+        self.g = g
+        self.paths = None
+        self.names = {}
+
+    def path(self, table):
+        if self.paths is None:
+            self.paths = table_paths(self.g)
+        return self.paths.get(table)
+
+    def resolve(self, mt):
+        keys = table_strkeys(mt)
+        name = keys.get(b'__name')
+        if name is not None and typenames(tvraw_itypemap(name)) == 'LJ_TSTR':
+            return strtext(strpayload(tvraw_gcval(name))[0])
+        path = self.path(mt)
+        if path is not None:
+            return path
+        index = keys.get(b'__index')
+        if index is not None and typenames(tvraw_itypemap(index)) == 'LJ_TTAB':
+            path = self.path(tvraw_gcval(index))
+            if path is not None:
+                return '{} (__index)'.format(path)
+        names = sorted(strtext(key) for key in keys)
+        if len(names) > METATABLE_KEYS_LIMIT:
+            names = names[:METATABLE_KEYS_LIMIT] + ['...']
+        return '{' + ', '.join(names) + '}'
+
+    def name(self, mt):
+        if mt not in self.names:
+            self.names[mt] = self.resolve(mt)
+        return self.names[mt]
+
+
+def heap_classes(g):
+    # Get {(<type>, <metatable>): [<count>, <bytes>]} for the tables and
+    # the userdata with the metatable. Strings are not walked at all.
+    layout = heap_layout()
+    budget = WalkBudget()
+    classes = {}
+    for addr, obj in budget.walk(heap_walk(g, layout, strings=False)):
+        gct, fields = heap_decode(obj, layout)
+        if gct not in ('LJ_TTAB', 'LJ_TUDATA'):
+            continue
+        mt = read_field(addr, 'GCtab' if gct == 'LJ_TTAB' else 'GCudata',
+                        'metatable')
+        if not mt:
+            continue
+        stat = classes.setdefault((HEAP_TYPES[gct], mt), [0, 0])
+        stat[0] += 1
+        stat[1] += gcobj_size(g, gct, addr, fields, {})
+    if budget.stopped is not None:
+        raise Error('the heap walk is {}'.format(budget.stopped))
+    return classes
+
+
+def dump_classes(g, count, structured=False):
+    classes = stop_cached(('classes', g), lambda: heap_classes(g))
+    names = MetatableNames(g)
+    top = heapq.nlargest(count, classes.items(),
+                         key=lambda item: (item[1][1], item[1][0]))
+
+    if structured:
+        yield {
+            'kind': 'classes',
+            'classes': len(classes),
+            'objects': sum(stat[0] for stat in classes.values()),
+            'bytes': sum(stat[1] for stat in classes.values()),
+        }
+    else:
+        yield 'Classes: {} metatables, {} objects, {} bytes'.format(
+            len(classes),
+            sum(stat[0] for stat in classes.values()),
+            sum(stat[1] for stat in classes.values()),
+        )
+    for (typename, mt), (objects, nbytes) in top:
+        if structured:
+            yield {
+                'kind': 'class',
+                'name': names.name(mt),
+                'metatable': strx64(mt),
+                'type': typename,
+                'objects': objects,
+                'bytes': nbytes,
+            }
+        else:
+            yield '\t{} objects, {} bytes: {} ({}, metatable @ {})'.format(
+                objects, nbytes, names.name(mt), typename, strx64(mt)
+            )
+
+
+# }}}
+
+
+# Heap snapshots {{{
+
+
+# The heap snapshot is the summary of the heap with the objects grouped
+# by their type, metatable and defining prototype, so the snapshots of
+# the same application taken from the different processes (e.g. two core
+# files taken hours apart) can be compared. The file is the zlib
+# compressed JSON with the groups stored by columns:
+# {
+#   'version': SNAPSHOT_VERSION,
+#   'build_id': <GNU build-id of the LuaJIT objfile or null>,
+#   'objects': <number of objects>,
+#   'bytes': <size of objects>,
+#   'labels': [<metatable or prototype label>],
+#   'columns': {
+#     'type': [<object type>],
+#     'metatable': [<index of the label or -1>],
+#     'proto': [<index of the label or -1>],
+#     'count': [<number of objects in the group>],
+#     'bytes': [<size of objects in the group>],
+#   },
+# }
+SNAPSHOT_MAGIC = b'LJHSNAP\0'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COLUMNS = ('type', 'metatable', 'proto', 'count', 'bytes')
+
+
+def proto_label(pt, cache):
+    if pt not in cache:
+        payload, _ = strpayload(read_field(pt, 'GCproto', 'chunkname'))
+        cache[pt] = '{}:{}'.format(
+            strtext(payload),
+            read_field(pt, 'GCproto', 'firstline', signed=True),
+        )
+    return cache[pt]
+
+
+def heap_snapshot(g):
+    # Get {(<type>, <metatable label>, <prototype label>): [<count>,
+    # <bytes>]} for all the objects in the heap. The functions and the
+    # prototypes are grouped by the prototype, the tables referenced by
+    # the upvalues are grouped by the prototype of the function as well.
+    layout = heap_layout()
+    ctcache = {}
+    names = MetatableNames(g)
+    ptcache = {}
+    mainthread = read_field(g, 'global_State', 'mainthref')
+    budget = WalkBudget()
+    groups = {}
+    # Upvalues of Lua functions and the tables held by the upvalues.
+    uvprotos = {}
+    uvtables = {}
+
+    def account(key, count, size):
+        group = groups.setdefault(key, [0, 0])
+        group[0] += count
+        group[1] += size
+
+    def table_key(addr, gct, proto):
+        mt = read_field(addr, 'GCtab' if gct == 'LJ_TTAB' else 'GCudata',
+                        'metatable')
+        return (HEAP_TYPES[gct], names.name(mt) if mt else None, proto)
+
+    for addr, obj in budget.walk(heap_walk(g, layout)):
+        gct, fields = heap_decode(obj, layout)
+        size = gcobj_size(g, gct, addr, fields, ctcache)
+        if addr == mainthread:
+            size += sizeof('GG_State') - sizeof('lua_State')
+        proto = None
+        if gct in ('LJ_TTAB', 'LJ_TUDATA'):
+            account(table_key(addr, gct, None), 1, size)
+            continue
+        elif gct == 'LJ_TFUNC' and fields['ffid'] == 0:
+            proto = proto_label(funcproto(addr), ptcache)
+            for uv in read_refs(addr + offsetof('GCfuncL', 'uvptr'),
+                                fields['nupvalues']):
+                uvprotos.setdefault(uv, proto)
+        elif gct == 'LJ_TPROTO':
+            proto = proto_label(addr, ptcache)
+        elif gct == 'LJ_TUPVAL' and read_field(addr, 'GCupval', 'closed'):
+            u64 = read_tv(addr + offsetof('GCupval', 'tv'))
+            if typenames(tvraw_itypemap(u64)) == 'LJ_TTAB':
+                uvtables[addr] = tvraw_gcval(u64)
+        account((HEAP_TYPES.get(gct, 'invalid'), None, proto), 1, size)
+    if budget.stopped is not None:
+        raise Error('the heap walk is {}'.format(budget.stopped))
+
+    # The tables held by the upvalues are moved to the groups of the
+    # prototypes when the whole heap is walked.
+    held = {}
+    for uv, table in uvtables.items():
+        if uv in uvprotos:
+            held.setdefault(table, uvprotos[uv])
+    for table, proto in held.items():
+        gct, fields = heap_decode(read_gcobj(table, layout), layout)
+        size = gcobj_size(g, gct, table, fields, ctcache)
+        account(table_key(table, gct, None), -1, -size)
+        account(table_key(table, gct, proto), 1, size)
+    return groups
+
+
+def current_snapshot(g):
+    return stop_cached(('heap snapshot', g), lambda: heap_snapshot(g))
+
+
+def write_snapshot(path, groups):
+    labels = []
+    indices = {None: -1}
+
+    def label_index(label):
+        if label not in indices:
+            indices[label] = len(labels)
+            labels.append(label)
+        return indices[label]
+
+    columns = dict((name, []) for name in SNAPSHOT_COLUMNS)
+    for (gct, mt, proto), (count, size) in sorted(
+        groups.items(), key=lambda item: [key or '' for key in item[0]]
+    ):
+        columns['type'].append(gct)
+        columns['metatable'].append(label_index(mt))
+        columns['proto'].append(label_index(proto))
+        columns['count'].append(count)
+        columns['bytes'].append(size)
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'build_id': BUILD_ID,
+        'objects': sum(columns['count']),
+        'bytes': sum(columns['bytes']),
+        'labels': labels,
+        'columns': columns,
+    }
+    encoded = zlib.compress(json.dumps(snapshot).encode('ascii'))
+    try:
+        with open(path, 'wb') as dump:
+            dump.write(SNAPSHOT_MAGIC)
+            dump.write(encoded)
+    except (IOError, OSError) as e:
+        raise Error('lj-snapshot: {}'.format(e))
+    return {
+        'groups': len(groups),
+        'objects': snapshot['objects'],
+        'bytes': snapshot['bytes'],
+        'size': len(SNAPSHOT_MAGIC) + len(encoded),
+    }
+
+
+def read_snapshot(path):
+    try:
+        with open(path, 'rb') as dump:
+            data = dump.read()
+    except (IOError, OSError) as e:
+        raise Error('lj-snapdiff: {}'.format(e))
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise Error('lj-snapdiff: {} is not a heap snapshot'.format(path))
+    try:
+        snapshot = json.loads(zlib.decompress(
+            data[len(SNAPSHOT_MAGIC):]
+        ).decode('utf-8'))
+    except (zlib.error, ValueError) as e:
+        raise Error('lj-snapdiff: {}: {}'.format(path, e))
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise Error('lj-snapdiff: {}: unsupported version {}'.format(
+            path, snapshot.get('version')
+        ))
+    labels = snapshot['labels']
+    columns = snapshot['columns']
+    groups = {}
+    for gct, mt, proto, count, size in zip(
+        *[columns[name] for name in SNAPSHOT_COLUMNS]
+    ):
+        groups[(gct, labels[mt] if mt >= 0 else None,
+                labels[proto] if proto >= 0 else None)] = [count, size]
+    return groups
+
+
+def dump_group(key):
+    gct, mt, proto = key
+    return gct + ''.join(', {} {}'.format(name, label) for name, label in [
+        ('metatable', mt), ('proto', proto)
+    ] if label is not None)
+
+
+def dump_snapdiff(old, new, count, structured=False):
+    # Only the groups grown either in count or in size are reported.
+    totals = [[sum(group[i] for group in snapshot.values())
+               for i in (0, 1)] for snapshot in (old, new)]
+    grown = []
+    for key, (newcount, newsize) in new.items():
+        oldcount, oldsize = old.get(key, (0, 0))
+        if newcount > oldcount or newsize > oldsize:
+            grown.append((newsize - oldsize, newcount - oldcount,
+                          newcount, newsize, key))
+    grown.sort(key=lambda diff: (diff[0], diff[1]), reverse=True)
+
+    if structured:
+        yield {
+            'kind': 'snapdiff',
+            'old': {'objects': totals[0][0], 'bytes': totals[0][1]},
+            'new': {'objects': totals[1][0], 'bytes': totals[1][1]},
+            'grown': len(grown),
+        }
+    else:
+        yield 'Heap diff: {} groups grown'.format(len(grown))
+        yield '\tobjects: {} -> {} ({:+d})'.format(
+            totals[0][0], totals[1][0], totals[1][0] - totals[0][0]
+        )
+        yield '\tbytes: {} -> {} ({:+d})'.format(
+            totals[0][1], totals[1][1], totals[1][1] - totals[0][1]
+        )
+    for dbytes, dcount, newcount, newsize, key in grown[:count]:
+        if structured:
+            yield {
+                'kind': 'group',
+                'type': key[0],
+                'metatable': key[1],
+                'proto': key[2],
+                'objects': newcount,
+                'bytes': newsize,
+                'objects_diff': dcount,
+                'bytes_diff': dbytes,
+            }
+        else:
+            yield '\t{:+d} bytes, {:+d} objects ({} objects, {} bytes): ' \
+                '{}'.format(dbytes, dcount, newcount, newsize,
+                            dump_group(key))
+
+
+# }}}
+
+
+# Heap export {{{
+
+
+# The heap is exported in the heap snapshot format of Chrome DevTools
+# (i.e. .heapsnapshot file), so it can be inspected by the tools made for
+# JavaScript heaps. The GC objects are the nodes and the references (see
+# gcobj_edges) are the edges; the synthetic root node refers to the GC
+# roots. Both nodes and edges are flat arrays of integers in the file,
+# and the node refers to its edges implicitly via their count, so the
+# nodes are written in the order of their addresses and the node index is
+# found by bisection. The nodes, the edges and the strings are streamed
+# to the temporary files at first, since the file header holds the number
+# of nodes and edges.
+DEVTOOLS_META = {
+    'node_fields': ['type', 'name', 'id', 'self_size', 'edge_count',
+                    'trace_node_id'],
+    'node_types': [['hidden', 'array', 'string', 'object', 'code',
+                    'closure', 'regexp', 'number', 'native', 'synthetic',
+                    'concatenated string', 'sliced string', 'symbol',
+                    'bigint'],
+                   'string', 'number', 'number', 'number', 'number'],
+    'edge_fields': ['type', 'name_or_index', 'to_node'],
+    'edge_types': [['context', 'element', 'property', 'internal', 'hidden',
+                    'shortcut', 'weak'],
+                   'string_or_number', 'node'],
+    'trace_function_info_fields': ['function_id', 'name', 'script_name',
+                                   'script_id', 'line', 'column'],
+    'trace_node_fields': ['id', 'function_info_index', 'count', 'size',
+                          'children'],
+    'sample_fields': ['timestamp_us', 'last_assigned_id'],
+    'location_fields': ['object_index', 'script_id', 'line', 'column'],
+}
+
+# DevTools node types of the GC objects.
+DEVTOOLS_NODE_TYPES = {
+    'LJ_TSTR':    'string',
+    'LJ_TUPVAL':  'object',
+    'LJ_TTHREAD': 'object',
+    'LJ_TPROTO':  'code',
+    'LJ_TFUNC':   'closure',
+    'LJ_TTRACE':  'code',
+    'LJ_TCDATA':  'native',
+    'LJ_TTAB':    'object',
+    'LJ_TUDATA':  'native',
+}
+
+# The maximum number of the string payload bytes used as the node name.
+DEVTOOLS_NAME_LIMIT = 128
+
+
+class DevtoolsStrings(object):
+    # The string table of the snapshot streamed to the temporary file. The
+    # labels are deduplicated, but the contents of the Lua strings are
+    # not, since they are interned by the VM anyway.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.indices = {}
+        self.count = 0
+
+    def append(self, text):
+        self.stream.write('{}{}'.format(',\n' if self.count else '',
+                                        json.dumps(text)))
+        self.count += 1
+        return self.count - 1
+
+    def index(self, label):
+        if label not in self.indices:
+            self.indices[label] = self.append(label)
+        return self.indices[label]
+
+
+def devtools_name(gct, addr, fields, names, protos):
+    if gct == 'LJ_TSTR':
+        payload = read_memory(addr + sizeof('GCstr'),
+                              min(fields['len'], DEVTOOLS_NAME_LIMIT))
+        return strtext(payload), False
+    elif gct == 'LJ_TTAB' or gct == 'LJ_TUDATA':
+        mt = read_field(addr, 'GCtab' if gct == 'LJ_TTAB' else 'GCudata',
+                        'metatable')
+        return names.name(mt) if mt else HEAP_TYPES[gct], True
+    elif gct == 'LJ_TFUNC' and fields['ffid'] == 0:
+        return proto_label(funcproto(addr), protos), True
+    elif gct == 'LJ_TFUNC':
+        return 'C function' if fields['ffid'] == 1 else \
+            'fast function #{}'.format(fields['ffid']), True
+    elif gct == 'LJ_TPROTO':
+        return proto_label(addr, protos), True
+    elif gct == 'LJ_TTRACE':
+        return 'trace #{}'.format(read_field(addr, 'GCtrace', 'traceno')), \
+            True
+    return HEAP_TYPES.get(gct, 'invalid'), True
+
+
+def devtools_key(u64):
+    # The string keys are the property names as is.
+    if typenames(tvraw_itypemap(u64)) == 'LJ_TSTR':
+        return strtext(strpayload(tvraw_gcval(u64))[0])
+    return dump_tabkey(u64)
+
+
+def write_devtools(path, g):
+    layout = heap_layout()
+    ctcache = {}
+    names = MetatableNames(g)
+    protos = {}
+    mainthread = read_field(g, 'global_State', 'mainthref')
+    budget = WalkBudget()
+    addrs = array.array(ADDR_ARRAY,
+                        sorted(addr for addr, _ in
+                               budget.walk(heap_walk(g, layout))))
+    if budget.stopped is not None:
+        raise Error('lj-export: the heap walk is {}'.format(budget.stopped))
+    nfields = len(DEVTOOLS_META['node_fields'])
+    node_types = DEVTOOLS_META['node_types'][0]
+    edge_types = DEVTOOLS_META['edge_types'][0]
+    count = len(addrs)
+
+    def node_index(ref):
+        i = bisect.bisect_left(addrs, ref)
+        return i + 1 if i < count and addrs[i] == ref else None
+
+    nodes = tempfile.TemporaryFile('w+')
+    edges = tempfile.TemporaryFile('w+')
+    strings = DevtoolsStrings(tempfile.TemporaryFile('w+'))
+    stats = {'nodes': 0, 'edges': 0}
+
+    def write_node(ntype, name, nid, size, targets):
+        nedges = 0
+        for etype, ename, ref in targets:
+            index = node_index(ref)
+            if index is None:
+                # The objects that are not walked (e.g. the static strings
+                # of the VM) are dropped.
+                continue
+            edges.write('{}{},{},{}'.format(
+                ',\n' if stats['edges'] else '', edge_types.index(etype),
+                ename, index * nfields,
+            ))
+            stats['edges'] += 1
+            nedges += 1
+        nodes.write('{}{},{},{},{},{},0'.format(
+            ',\n' if stats['nodes'] else '', node_types.index(ntype),
+            name, nid, size, nedges,
+        ))
+        stats['nodes'] += 1
+
+    try:
+        strings.index('')
+        write_node('synthetic', strings.index('(GC roots)'), 1, 0, [
+            ('internal', strings.index(label), ref)
+            for label, ref in gc_roots(g, layout)
+        ])
+        budget = WalkBudget()
+        for addr in budget.walk(iter(addrs)):
+            gct, fields = heap_decode(read_gcobj(addr, layout), layout)
+            size = gcobj_size(g, gct, addr, fields, ctcache)
+            if addr == mainthread:
+                size += sizeof('GG_State') - sizeof('lua_State')
+            name, label = devtools_name(gct, addr, fields, names, protos)
+            targets = []
+            for etype, ename, ref in gcobj_edges(gct, addr, fields):
+                if etype == 'property':
+                    ename = strings.index(devtools_key(ename))
+                elif etype != 'element':
+                    ename = strings.index(ename)
+                targets.append((etype, ename, ref))
+            # Node ids are odd as the ones of the JavaScript objects.
+            write_node(
+                DEVTOOLS_NODE_TYPES.get(gct, 'hidden'),
+                strings.index(name) if label else strings.append(name),
+                2 * (budget.visited + 1) + 1, size, targets,
+            )
+        if budget.stopped is not None:
+            raise Error('lj-export: the heap walk is {}'.format(
+                budget.stopped
+            ))
+
+        with open(path, 'w') as snapshot:
+            snapshot.write('{{"snapshot":{{"meta":{},"node_count":{},'
+                           '"edge_count":{},"trace_function_count":0}},\n'
+                           .format(json.dumps(DEVTOOLS_META),
+                                   stats['nodes'], stats['edges']))
+            for key, stream in [('nodes', nodes), ('edges', edges),
+                                ('strings', strings.stream)]:
+                snapshot.write('"{}":[\n'.format(key))
+                stream.seek(0)
+                shutil.copyfileobj(stream, snapshot)
+                snapshot.write('],\n')
+            snapshot.write('"trace_function_infos":[],"trace_tree":[],'
+                           '"samples":[],"locations":[]}\n')
+            stats['size'] = snapshot.tell()
+    except (IOError, OSError) as e:
+        raise Error('lj-export: {}'.format(e))
+    except BaseException:
+        # Don't leave the partially written snapshot (e.g. on Ctrl-C).
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        nodes.close()
+        edges.close()
+        strings.stream.close()
+    stats['strings'] = strings.count
+    return stats
+
+
+# }}}
+
+
+# GC stats {{{
+
+
+def gcwalklen(walker, budget):
+    count = 0
+    try:
+        for _ in budget.walk(walker):
+            count += 1
+    except KeyboardInterrupt:
+        budget.stopped = STOP_INTERRUPTED
+    return count, None, budget.stopped
+
+
+def gclistlen(g, root, budget):
+    return gcwalklen(gclist_walk(root, heap_layout()), budget)
+
+
+def gcringlen(g, root, budget):
+    # XXX: gc.mmudata is a ring-list.
+    return gcwalklen(gcring_walk(root, heap_layout()), budget)
+
+
+def gcrootlen(g, root, budget):
+    # The length of gc.root is extrapolated via the heap census if the
+    # budget is exhausted (see heap_census).
+    return heap_census(g, budget)['root']
+
+
+gclen = {
+    'root':      gcrootlen,
+    'gray':      gclistlen,
+    'grayagain': gclistlen,
+    'weak':      gclistlen,
+    'mmudata':   gcringlen,
+}
+
+
+def record_count(count, error, stopped):
+    # See dump_count.
+    return {
+        'count': int(count),
+        'error': record_error(error),
+        'estimated': error is not None,
+        'stopped': stopped,
+    }
+
+
+def dump_gc(g, budget, structured=False):
+    gc = gcstate(g)
+    fields = [(f, read_field(gc, 'GCState', f)) for f in (
+        'total', 'threshold', 'debt', 'estimate', 'stepmul', 'pause'
+    )]
+    sweepstr = read_field(gc, 'GCState', 'sweepstr')
+    # String hash mask (size of hash table - 1).
+    strmask = read_field(g, 'global_State', 'strmask') + 1
+    if not structured:
+        yield 'GC stats: {}'.format(gc_state(g))
+
+    # The short lists are walked at first, each with at most the half of
+    # the remaining budget, so the rest is left to extrapolate gc.root.
+    counts = {}
+    for stat in sorted(gclen.keys(), key=lambda stat: stat == 'root'):
+        nested = budget if stat == 'root' else budget.share(0.5)
+        counts[stat] = gclen[stat](g, read_field(gc, 'GCState', stat),
+                                   nested)
+        if nested is not budget:
+            budget.charge(nested)
+
+    if structured:
+        record = {'kind': 'gc', 'state': gc_state(g)}
+        record.update(fields)
+        record.update({'sweepstr': sweepstr, 'strsize': strmask})
+        for stat in gclen.keys():
+            record[stat] = record_count(*counts[stat])
+        yield record
+        return
+
+    stats = ['{key}: {value}'.format(key=f, value=v) for f, v in fields]
+    stats += ['sweepstr: {sweepstr}/{strmask}'.format(
+        sweepstr=sweepstr,
+        strmask=strmask,
+    )]
+    stats += ['{key}: {number} objects'.format(
+        key=stat,
+        number=dump_count(*counts[stat])
+    ) for stat in gclen.keys()]
+
+    for stat in stats:
+        yield '\t' + stat
+
+
+# }}}
+
+
+# String table {{{
+
+
+# The strings rehashed with the full hash function (see strsmart in
+# lj_obj.h) have strflags >= 0xc0.
+STRFLAGS_SMART = 0xc0
+
+
+def chain_buckets(length):
+    # The chains are bucketed by their length: the short ones are counted
+    # exactly and the rest by the powers of two.
+    if length <= 4:
+        return length, length
+    hi = 8
+    while length > hi:
+        hi *= 2
+    return hi // 2 + 1, hi
+
+
+def strbloom_bits(g):
+    # Get [<bits set>] for cur[0], cur[1], next[0] and next[1] bloom
+    # filters of the string table (LUAJIT_SMART_STRINGS only) and the
+    # width of the filter in bits.
+    offset, size = fieldof('global_State', 'strbloom')
+    wordsize = size // 4
+    buf = read_memory(g + offset, size)
+    return [bin(word).count('1') for (word,) in
+            unpack_records(buf, UINT_FORMAT[wordsize], 4)], wordsize * 8
+
+
+U32_MASK = 0xFFFFFFFF
+
+
+def rol32(val, shift):
+    return (val << shift | val >> (32 - shift)) & U32_MASK
+
+
+def getu32(payload, offset):
+    return struct.unpack_from(ENDIAN + 'I', payload, offset)[0]
+
+
+def lua_hash(payload, signedchar=True):
+    # The port of lua_hash (see lj_api.c), i.e. the "sparse" hash of the
+    # string sampling only a few positions of it. The short strings are
+    # hashed by the chars that are signed for some targets (e.g. x86).
+    size = len(payload)
+    if size >= 4:
+        h = size
+        a = getu32(payload, 0)
+        h ^= getu32(payload, size - 4)
+        b = getu32(payload, (size >> 1) - 2)
+        h ^= b
+        h = (h - rol32(b, 14)) & U32_MASK
+        b = (b + getu32(payload, (size >> 2) - 1)) & U32_MASK
+    elif size > 0:
+        chars = bytearray(payload)
+        if signedchar:
+            chars = [c - 0x100 & U32_MASK if c >= 0x80 else c
+                     for c in chars]
+        a = chars[0]
+        h = size ^ chars[size - 1]
+        b = chars[size >> 1]
+        h ^= b
+        h = (h - rol32(b, 14)) & U32_MASK
+    else:
+        return 0
+    a ^= h
+    a = (a - rol32(h, 11)) & U32_MASK
+    b ^= a
+    b = (b - rol32(a, 25)) & U32_MASK
+    h ^= b
+    h = (h - rol32(b, 16)) & U32_MASK
+    return h
+
+
+def lj_fullhash(payload):
+    # The port of lj_fullhash (see lj_str.c), i.e. the full hash of the
+    # strings longer than 12 bytes (LUAJIT_SMART_STRINGS only).
+    a, b = 0, 0
+    c, d = 0xcafedead, 0xdeadbeef
+    size = h = len(payload)
+    v = 0
+    while size > 8:
+        a ^= getu32(payload, v)
+        b ^= getu32(payload, v + 4)
+        c = (c + a) & U32_MASK
+        d = (d + b) & U32_MASK
+        a = (rol32(a, 5) - d) & U32_MASK
+        b = (rol32(b, 7) - c) & U32_MASK
+        c = rol32(c, 24) ^ a
+        d = rol32(d, 1) ^ b
+        size -= 8
+        v += 8
+    a ^= getu32(payload, v + size - 8)
+    b ^= getu32(payload, v + size - 4)
+    c = (c + b - rol32(a, 9)) & U32_MASK
+    d = (d + a - rol32(b, 18)) & U32_MASK
+    h = (h - rol32(a ^ b, 7) + c + rol32(d, 13)) & U32_MASK
+    d ^= c
+    d = (d - rol32(c, 25)) & U32_MASK
+    h ^= d
+    h = (h - rol32(d, 16)) & U32_MASK
+    c ^= h
+    c = (c - rol32(h, 4)) & U32_MASK
+    d ^= c
+    d = (d - rol32(c, 14)) & U32_MASK
+    h ^= d
+    h = (h - rol32(d, 24)) & U32_MASK
+    return h
+
+
+def hashrot(lo, hi, x86=True):
+    # The port of hashrot (see lj_tab.h) scrambling the bits of numbers
+    # and pointers; the variants for x86/x64 and the rest targets differ.
+    if x86:
+        lo ^= hi
+        hi = rol32(hi, 14)
+        lo = (lo - hi) & U32_MASK
+        hi = rol32(hi, 5)
+        hi ^= lo
+        hi = (hi - rol32(lo, 13)) & U32_MASK
+    else:
+        lo ^= hi
+        lo = (lo - rol32(hi, 14)) & U32_MASK
+        hi = lo ^ rol32(hi, 14 + 5)
+        hi = (hi - rol32(lo, 13)) & U32_MASK
+    return hi
+
+
+def str_hashes(payload):
+    # The hashes the string with the given payload may have: the target
+    # the VM is built for isn't recorded in the layout, so both variants
+    # of char signedness are tried, and the strings longer than 12 bytes
+    # may be rehashed with the full hash function.
+    hashes = [lua_hash(payload, signedchar) for signedchar in (True, False)]
+    if has_field('global_State', 'strbloom') and len(payload) > 12:
+        full = lj_fullhash(payload) >> 6
+        hashes += [full | h & 0xFC000000 for h in hashes]
+    return set(hashes)
+
+
+def strtab_walk(g, budget, count):
+    # Walk all the hash chains of the string table in order. The anchors
+    # are read by chunks, and the strings of the chain are decoded from
+    # the raw objects (see heap_layout).
+    layout = heap_layout()
+    hashdec = field_decoder('GCstr', 'hash')
+    flagsdec = field_decoder('GCstr', 'strflags')
+    refsize = sizeof('GCRef')
+    anchors = read_field(g, 'global_State', 'strhash')
+    nanchors = read_field(g, 'global_State', 'strmask') + 1
+    stats = {'strings': 0, 'smart': 0, 'empty': 0, 'collisions': 0}
+    buckets = {}
+    longest = []
+    for start in range(0, nanchors, CHUNK_SIZE):
+        nchunk = min(CHUNK_SIZE, nanchors - start)
+        buf = read_memory(anchors + start * refsize, nchunk * refsize)
+        for i, (chain,) in enumerate(unpack_records(
+            buf, UINT_FORMAT[refsize], nchunk
+        )):
+            hashes = collections.Counter()
+            length = 0
+            smart = 0
+            for _, obj in budget.walk(gclist_walk(chain, layout)):
+                hashes[heap_unpack(obj, hashdec)] += 1
+                if heap_unpack(obj, flagsdec) >= STRFLAGS_SMART:
+                    smart += 1
+                length += 1
+            if budget.stopped is not None:
+                raise Error('the string table walk is {}'.format(
+                    budget.stopped
+                ))
+            stats['strings'] += length
+            stats['smart'] += smart
+            # The strings with the same hash are the hard collisions,
+            # i.e. the whole strings are compared on lookup.
+            stats['collisions'] += length - len(hashes)
+            if not length:
+                stats['empty'] += 1
+            bucket = buckets.setdefault(chain_buckets(length), [0, 0])
+            bucket[0] += 1
+            bucket[1] += length
+            item = (length, -(start + i), chain, len(hashes), smart)
+            if len(longest) < count:
+                heapq.heappush(longest, item)
+            elif item > longest[0]:
+                heapq.heapreplace(longest, item)
+    stats['buckets'] = sorted(buckets.items())
+    stats['longest'] = sorted(longest, reverse=True)
+    stats['chains'] = nanchors
+    return stats
+
+
+def dump_strtab(g, count, structured=False):
+    strnum = read_field(g, 'global_State', 'strnum')
+    strmask = read_field(g, 'global_State', 'strmask')
+    counters = [(f, read_field(g, 'global_State', f)) for f in (
+        'strhash_hit', 'strhash_miss'
+    ) if has_field('global_State', f)]
+    bloom = strbloom_bits(g) if has_field('global_State', 'strbloom') \
+        else None
+    stats = strtab_walk(g, WalkBudget(), count)
+    load = strnum / float(strmask + 1)
+
+    if structured:
+        record = {
+            'kind': 'strtab',
+            'strnum': strnum,
+            'strmask': strmask,
+            'load': load,
+            'strings': stats['strings'],
+            'empty': stats['empty'],
+            'collisions': stats['collisions'],
+        }
+        record.update(counters)
+        if bloom is not None:
+            bits, width = bloom
+            record['strbloom'] = {'cur': bits[:2], 'next': bits[2:],
+                                  'width': width}
+            record['smart'] = stats['smart']
+        yield record
+    else:
+        yield 'String table:'
+        yield '\tstrnum: {} ({} walked)'.format(strnum, stats['strings'])
+        yield '\tstrmask: {}'.format(strx64(strmask))
+        yield '\tload factor: {:.2f}'.format(load)
+        yield '\tempty chains: {}'.format(stats['empty'])
+        yield '\tsame hash collisions: {}'.format(stats['collisions'])
+        for field, value in counters:
+            yield '\t{}: {}'.format(field, value)
+        if bloom is not None:
+            bits, width = bloom
+            yield '\tstrbloom: cur {}/{} {}/{}, next {}/{} {}/{} ' \
+                'bits set'.format(bits[0], width, bits[1], width,
+                                  bits[2], width, bits[3], width)
+            yield '\tfull hash: {} strings'.format(stats['smart'])
+        yield 'Chain lengths:'
+
+    for (lo, hi), (chains, strings) in stats['buckets']:
+        if structured:
+            yield {'kind': 'chains', 'min': lo, 'max': hi,
+                   'chains': chains, 'strings': strings}
+        else:
+            yield '\t{}: {} chains, {} strings'.format(
+                lo if lo == hi else '{}-{}'.format(lo, hi), chains, strings
+            )
+
+    if not structured:
+        yield 'Longest chains:'
+    for length, index, chain, distinct, smart in stats['longest']:
+        if not length:
+            break
+        if structured:
+            yield {
+                'kind': 'chain',
+                'index': -index,
+                'length': length,
+                'hashes': distinct,
+                'smart': smart,
+                'first': record_lj_tstr(chain),
+            }
+        else:
+            yield '\t#{}: {} strings, {} distinct hashes, {} full hash, ' \
+                'first: {}'.format(-index, length, distinct, smart,
+                                   dump_lj_tstr(chain))
+
+
+# }}}
+
+
+# String search {{{
+
+
+# The payloads are read and searched by windows of the given size, so the
+# huge strings are not read into the memory at once. The windows overlap
+# to find the matches spanning their boundaries; the regular expression
+# matches longer than the overlap may be missed in the huge strings.
+STRFIND_WINDOW = 1 << 20
+STRFIND_OVERLAP = 4096
+# The number of payload bytes dumped around the match and the number of
+# the leading bytes dumped for the large strings.
+STRFIND_CONTEXT = 32
+STRPREVIEW_LIMIT = 64
+
+
+def strtab_strings(g, budget):
+    # The generator yields (<address>, <length>) pairs for all the strings
+    # in the string table in the order of the hash chains.
+    layout = heap_layout()
+    lendec = field_decoder('GCstr', 'len')
+    for addr, obj in budget.walk(strhash_walk(g, layout, shuffle=False)):
+        yield addr, heap_unpack(obj, lendec)
+
+
+def strpayload_windows(gcstr, length, overlap):
+    # The generator yields (<offset>, <window>) pairs covering the whole
+    # payload of the string.
+    payload = gcstr + sizeof('GCstr')
+    for offset in range(0, length, STRFIND_WINDOW):
+        size = min(STRFIND_WINDOW + overlap, length - offset)
+        yield offset, read_memory(payload + offset, size)
+
+
+def strslice(gcstr, length, start, end):
+    # Get the payload bytes in [<start>, <end>) with the flags whether the
+    # payload is cut off from the left and from the right.
+    start, end = max(0, start), min(length, end)
+    data = read_memory(gcstr + sizeof('GCstr') + start, end - start) \
+        if end > start else b''
+    return data, start > 0, end < length
+
+
+def dump_strslice(gcstr, length, start, end):
+    data, head, tail = strslice(gcstr, length, start, end)
+    return '{}"{}"{}'.format('...' if head else '', strescape(data),
+                             '...' if tail else '')
+
+
+def strbytes(text):
+    # The arguments are assumed to be UTF-8 (Python 2 has them as bytes).
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def payload_pattern(command, pattern, flags=0):
+    # Compile the pattern to be matched against the raw string payloads.
+    pattern = strbytes(pattern)
+    try:
+        return re.compile(pattern, re.DOTALL | flags)
+    except re.error as e:
+        raise Error('{}: invalid pattern: {}'.format(command, e))
+
+
+def strfind_pattern(pattern, regex, ignorecase):
+    # Get the compiled pattern and the overlap of the payload windows for
+    # it: the substring can't match more bytes than it has.
+    pattern = strbytes(pattern)
+    overlap = STRFIND_OVERLAP if regex else len(pattern) - 1
+    if not regex:
+        pattern = re.escape(pattern)
+    return payload_pattern('lj-strfind', pattern,
+                           re.IGNORECASE if ignorecase else 0), overlap
+
+
+def strfind_match(gcstr, length, pattern, overlap):
+    # Get (<offset>, <length>) of the first match in the payload or None.
+    for offset, window in strpayload_windows(gcstr, length, overlap):
+        match = pattern.search(window)
+        if match:
+            return offset + match.start(), match.end() - match.start()
+    return None
+
+
+def dump_strfind(g, pattern, overlap, limit, structured=False):
+    budget = WalkBudget()
+    found = 0
+    try:
+        for gcstr, length in strtab_strings(g, budget):
+            match = strfind_match(gcstr, length, pattern, overlap)
+            if match is None:
+                continue
+            found += 1
+            if found > limit:
+                continue
+            offset, size = match
+            # Long matches are cut to the context size.
+            start = offset - STRFIND_CONTEXT
+            end = offset + min(size, STRFIND_CONTEXT) + STRFIND_CONTEXT
+            if structured:
+                data, head, tail = strslice(gcstr, length, start, end)
+                yield {
+                    'kind': 'strmatch',
+                    'addr': strx64(gcstr),
+                    'len': length,
+                    'offset': offset,
+                    'context': strtext(data),
+                    'head': head,
+                    'tail': tail,
+                }
+            else:
+                yield '\t{}: {} bytes, match at {}: {}'.format(
+                    strx64(gcstr), length, offset,
+                    dump_strslice(gcstr, length, start, end)
+                )
+    except KeyboardInterrupt:
+        budget.stopped = STOP_INTERRUPTED
+
+    if structured:
+        yield {
+            'kind': 'strfind',
+            'found': found,
+            'strings': budget.visited,
+            'stopped': budget.stopped,
+        }
+    else:
+        yield 'Found: {} strings ({} walked{}){}'.format(
+            found, budget.visited,
+            ', ' + budget.stopped if budget.stopped else '',
+            ', {} shown'.format(limit) if found > limit else '',
+        )
+
+
+def dump_bigstrings(g, count, structured=False):
+    budget = WalkBudget()
+    total = 0
+    top = []
+    try:
+        for gcstr, length in strtab_strings(g, budget):
+            total += length
+            item = (length, gcstr)
+            if len(top) < count:
+                heapq.heappush(top, item)
+            elif item > top[0]:
+                heapq.heapreplace(top, item)
+    except KeyboardInterrupt:
+        budget.stopped = STOP_INTERRUPTED
+    top.sort(reverse=True)
+
+    if structured:
+        yield {
+            'kind': 'strings',
+            'strings': budget.visited,
+            'bytes': total,
+            'stopped': budget.stopped,
+        }
+    else:
+        yield 'Strings: {} strings, {} payload bytes{}'.format(
+            budget.visited, total,
+            ' ({})'.format(budget.stopped) if budget.stopped else '',
+        )
+    for length, gcstr in top:
+        if structured:
+            data, _, tail = strslice(gcstr, length, 0, STRPREVIEW_LIMIT)
+            yield {
+                'kind': 'bigstring',
+                'addr': strx64(gcstr),
+                'len': length,
+                'share': length / float(total) if total else 0,
+                'value': strtext(data),
+                'truncated': tail,
+            }
+        else:
+            yield '\t{} bytes ({:.1%}): string {} @ {}'.format(
+                length, length / float(total) if total else 0,
+                dump_strslice(gcstr, length, 0, STRPREVIEW_LIMIT),
+                strx64(gcstr),
+            )
+
+
+# }}}
+
+
+# Value formatters {{{
+
+
+# The types the value formatters of the debuggers (i.e. the pretty-printers
+# of GDB and the summary and synthetic children providers of LLDB) are
+# provided for, both for the values and the pointers to them.
+FORMATTED_TYPES = ('TValue', 'GCtab', 'GCstr', 'GCproto', 'GCfunc',
+                   'lua_State')
+
+# The types of the GC objects the children of TValue are taken from.
+FORMATTED_GCTYPES = {
+    'LJ_TSTR':    'GCstr',
+    'LJ_TTAB':    'GCtab',
+    'LJ_TFUNC':   'GCfunc',
+    'LJ_TPROTO':  'GCproto',
+    'LJ_TTHREAD': 'lua_State',
+}
+
+
+def value_summary(typestr, addr):
+    # Get the one-line summary of the value of the given type located at
+    # the given address.
+    if typestr == 'TValue':
+        return dump_tvalue(read_tv(addr))
+    elif typestr == 'GCstr':
+        return '{} [{} bytes]'.format(strdata(addr),
+                                      read_field(addr, 'GCstr', 'len'))
+    elif typestr == 'GCtab':
+        return dump_lj_ttab(addr)
+    elif typestr == 'GCfunc':
+        return dump_lj_tfunc(addr)
+    elif typestr == 'GCproto':
+        return 'proto @ {}, {}:{}'.format(
+            strx64(addr),
+            strdata(read_field(addr, 'GCproto', 'chunkname')),
+            read_field(addr, 'GCproto', 'firstline', signed=True),
+        )
+    elif typestr == 'lua_State':
+        stack = read_field(addr, 'lua_State', 'stack')
+        top = read_field(addr, 'lua_State', 'top')
+        return 'thread @ {}, {} slots used of {}'.format(
+            strx64(addr), (top - stack) // sizeof('TValue'),
+            read_field(addr, 'lua_State', 'stacksize'),
+        )
+    raise Error('no formatter for {}'.format(typestr))
+
+
+class ValueChildren(object):
+    # The children of the value of the given type located at the given
+    # address. Their number is known in advance, and every child is
+    # decoded on demand as (<name>, <type>, <address>), so the debugger
+    # fetches only the children being shown (e.g. the page of the huge
+    # table expanded in IDE).
+
+    def __init__(self, typestr, addr):
+        # The children are grouped into the segments of (<number of the
+        # children>, <function decoding the child by its index>).
+        self.segments = []
+        self.count = 0
+        if typestr == 'TValue':
+            # The children of the GC object the value refers to.
+            u64 = read_tv(addr)
+            typestr = FORMATTED_GCTYPES.get(typenames(tvraw_itypemap(u64)))
+            addr = tvraw_gcval(u64)
+        if typestr == 'GCtab':
+            self.table(addr)
+        elif typestr == 'GCfunc':
+            self.function(addr)
+        elif typestr == 'GCproto':
+            self.proto(addr)
+        elif typestr == 'lua_State':
+            self.thread(addr)
+
+    def add(self, count, child):
+        self.segments.append((count, child))
+        self.count += count
+
+    def field(self, name, typestr, addr):
+        if addr:
+            self.add(1, lambda _: (name, typestr, addr))
+
+    def tvalues(self, count, base, name='[{}]'):
+        tvsize = sizeof('TValue')
+        self.add(count, lambda i: (name.format(i), 'TValue',
+                                   base + i * tvsize))
+
+    def table(self, t):
+        self.field('metatable', 'GCtab', read_field(t, 'GCtab', 'metatable'))
+        self.tvalues(read_field(t, 'GCtab', 'asize'),
+                     read_field(t, 'GCtab', 'array'))
+        hmask = read_field(t, 'GCtab', 'hmask')
+        nodes = read_field(t, 'GCtab', 'node')
+        nodesize = sizeof('Node')
+        keyofs = offsetof('Node', 'key')
+
+        def node(i):
+            addr = nodes + i * nodesize
+            key = dump_tabkey(read_tv(addr + keyofs))
+            return '[{}]'.format(key), 'TValue', addr
+
+        self.add(hmask + 1 if hmask > 0 else 0, node)
+
+    def function(self, func):
+        self.field('environment', 'GCtab', read_field(func, 'GCfuncC', 'env'))
+        nupvalues = read_field(func, 'GCfuncC', 'nupvalues')
+        if read_field(func, 'GCfuncC', 'ffid') != 0:
+            self.tvalues(nupvalues, func + offsetof('GCfuncC', 'upvalue'),
+                         'upvalue #{}')
+            return
+        self.field('prototype', 'GCproto', funcproto(func))
+        uvptr = func + offsetof('GCfuncL', 'uvptr')
+        refsize = sizeof('GCRef')
+
+        def upvalue(i):
+            uv = read_uint(uvptr + i * refsize, refsize)
+            # The value is on the stack for the open upvalue.
+            return 'upvalue #{}'.format(i + 1), 'TValue', \
+                read_field(uv, 'GCupval', 'v')
+
+        self.add(nupvalues, upvalue)
+
+    def proto(self, pt):
+        self.field('chunkname', 'GCstr',
+                   read_field(pt, 'GCproto', 'chunkname'))
+        k = read_field(pt, 'GCproto', 'k')
+        refsize = sizeof('GCRef')
+
+        # GC constants are indexed backwards (see proto_kgc in lj_obj.h).
+        def kgc(i):
+            ref = read_uint(k - (i + 1) * refsize, refsize)
+            gct = typenames(i2notu32(read_field(ref, 'GChead', 'gct')))
+            return 'constant #{}'.format(i), \
+                FORMATTED_GCTYPES.get(gct, 'GChead'), ref
+
+        self.add(read_field(pt, 'GCproto', 'sizekgc'), kgc)
+        self.tvalues(read_field(pt, 'GCproto', 'sizekn'), k, 'number #{}')
+
+    def thread(self, L):
+        self.field('environment', 'GCtab', read_field(L, 'lua_State', 'env'))
+        stack = read_field(L, 'lua_State', 'stack')
+        top = read_field(L, 'lua_State', 'top')
+        self.tvalues((top - stack) // sizeof('TValue'), stack)
+
+    def child(self, index):
+        for count, child in self.segments:
+            if index < count:
+                return child(index)
+            index -= count
+        raise IndexError(index)
+
+
+# }}}
+
+
+# Commands {{{
+
+
+# Every command is a generator function receiving the argument string and
+# whether the structured output is requested. It yields either the lines
+# of the output or the records to be emitted as NDJSON, so the output is
+# streamed by the frontend while the memory is decoded. The help of the
+# command is taken from the docstring of the function.
+COMMANDS = collections.OrderedDict()
+
+JSON_HELP = '''
+If --json is given as the first argument, the output is emitted as the
+newline-delimited JSON records (one object per line with the "kind" key)
+instead of the text. Addresses are emitted as hex strings.
+
+If --vm <N|lua_State *|global_State *|main|all> is given in front of the
+arguments, the command is run for the given VM (see lj-vm) or for every
+VM found, one by one.
+'''
+
+
+def command(name):
+    def register(func):
+        func.__doc__ = func.__doc__.rstrip() + '\n' + JSON_HELP
+        COMMANDS[name] = func
+        return func
+    return register
+
+
+def parse_arg(arg):
+    if not arg:
+        return None
+
+    ret = BACKEND.evaluate(arg)
+
+    if not ret:
+        raise Error('table argument empty')
+
+    return ret
+
+
+@command('lj-arch')
+def lj_arch(arg, structured):
+    '''
+lj-arch [--json]
+
+The command requires no args and dumps values of LJ_64 and LJ_GC64
+compile-time flags. These values define the sizes of host and GC
+pointers respectively.
+    '''
+    if structured:
+        yield {
+            'kind': 'arch',
+            'LJ_64': LJ_64,
+            'LJ_GC64': LJ_GC64,
+            'LJ_DUALNUM': LJ_DUALNUM,
+        }
+        return
+    yield 'LJ_64: {LJ_64}, LJ_GC64: {LJ_GC64}, LJ_DUALNUM: {LJ_DUALNUM}' \
+        .format(
+            LJ_64=LJ_64,
+            LJ_GC64=LJ_GC64,
+            LJ_DUALNUM=LJ_DUALNUM
+        )
+
+
+@command('lj-tv')
+def lj_tv(arg, structured):
+    '''
+lj-tv [--json] <TValue *>
+
+The command receives a pointer to <tv> (TValue address) and dumps
+the type and some info related to it.
+
+* LJ_TNIL: nil
+* LJ_TFALSE: false
+* LJ_TTRUE: true
+* LJ_TLIGHTUD: light userdata @ <gcr>
+* LJ_TSTR: string <string payload> @ <gcr>
+* LJ_TUPVAL: upvalue @ <gcr>
+* LJ_TTHREAD: thread @ <gcr>
+* LJ_TPROTO: proto @ <gcr>
+* LJ_TFUNC: <LFUNC|CFUNC|FFUNC>
+  <LFUNC>: Lua function @ <gcr>, <nupvals> upvalues, <chunk:line>
+  <CFUNC>: C function <mcode address>
+  <FFUNC>: fast function #<ffid>
+* LJ_TTRACE: trace <traceno> @ <gcr>
+* LJ_TCDATA: cdata @ <gcr>
+* LJ_TTAB: table @ <gcr> (asize: <asize>, hmask: <hmask>)
+* LJ_TUDATA: userdata @ <gcr>
+* LJ_TNUMX: number <numeric payload>
+
+Whether the type of the given address differs from the listed above, then
+error message occurs.
+    '''
+    tv = parse_arg(arg)
+    if structured:
+        yield {
+            'kind': 'tvalue',
+            'addr': strx64(tv),
+            'value': record_tvalue(read_tv(tv)),
+        }
+    else:
+        yield dump_tvalue(read_tv(tv))
+
+
+@command('lj-str')
+def lj_str(arg, structured):
+    '''
+lj-str [--json] <GCstr *>
+
+The command receives a <gcr> of the corresponding GCstr object and dumps
+the payload, size in bytes and hash.
+
+*Caveat*: The non-printable characters of the payload are escaped and
+only the first 1024 bytes of the payload are dumped.
+    '''
+    string = parse_arg(arg)
+    if structured:
+        record = {'kind': 'string'}
+        record.update(record_lj_tstr(string))
+        record['hash'] = strx64(read_field(string, 'GCstr', 'hash'))
+        yield record
+        return
+    yield 'String: {body} [{len} bytes] with hash {hash}'.format(
+        body=strdata(string),
+        hash=strx64(read_field(string, 'GCstr', 'hash')),
+        len=read_field(string, 'GCstr', 'len'),
+    )
+
+
+@command('lj-strtab')
+def lj_strtab(arg, structured):
+    '''
+lj-strtab [--json] [<N>]
+
+The command walks all the hash chains of the interned string table
+(g->strhash) and dumps its statistics:
+* strnum: <number of strings> (<number of strings walked>)
+* strmask: <string hash mask> (i.e. the number of chains - 1)
+* load factor: <number of strings per chain>
+* empty chains: <number of empty chains>
+* same hash collisions: <number of strings sharing the whole hash value
+  with another string in the chain>
+* strhash_hit: <number of strings found in the table>
+* strhash_miss: <number of strings allocated and put into the table>
+
+With LUAJIT_SMART_STRINGS the following are dumped as well:
+* strbloom: <number of bits set> in the current and the next bloom
+  filters of the hashes that trigger the full hash lookup
+* full hash: <number of strings rehashed with the full hash function>
+
+Then the histogram of chain lengths is dumped (the long ones are
+bucketed by the powers of two) followed by the top <N> (10 by default)
+longest chains with their first string:
+* <length>: <number of chains>, <number of strings in them>
+* #<chain index>: <length> strings, <number of distinct hash values>
+  distinct hashes, <strings rehashed with full hash> full hash,
+  first: <string>
+
+Many strings with few distinct hash values in the chain are the sign
+of the hash flooding (the strings colliding in the sparse hash function
+of LuaJIT). The whole table is walked, but the walk can be interrupted
+via Ctrl-C.
+    '''
+    parser = ArgumentParser(prog='lj-strtab', add_help=False)
+    parser.add_argument('count', type=int, nargs='?', default=10)
+    args = parser.parse_args(shlex.split(arg or ''))
+    if args.count <= 0:
+        raise Error('lj-strtab: the number of chains must be positive')
+    return dump_strtab(G(L(None)), args.count, structured)
+
+
+@command('lj-strfind')
+def lj_strfind(arg, structured):
+    '''
+lj-strfind [--json] [--regex] [--ignore-case] [--limit <N>] <pattern>
+
+The command searches the payloads of all the strings in the interned
+string table for the given substring (or the regular expression if
+--regex is given) and dumps the strings matching it:
+* <GCstr address>: <length> bytes, match at <offset>: <context>
+* Found: <number of strings matched> strings (<number of strings walked>
+  walked)
+
+The <context> is the payload around the first match in the string (up to
+32 bytes before and after it) with the non-printable characters escaped.
+The pattern is matched against the raw bytes of the payload (UTF-8 is
+assumed for the pattern), the escapes like \\x00 may be used with --regex
+to search for the binary data. Only the first <N> (100 by default)
+matches are dumped, but all of them are counted.
+
+The payloads are read by 1Mb windows, so the regular expression matches
+longer than 4Kb may be missed in the huge strings. The whole table is
+walked, but the walk can be interrupted via Ctrl-C. The addresses may be
+passed to lj-str, lj-whyalive, etc.
+    '''
+    parser = ArgumentParser(prog='lj-strfind', add_help=False)
+    parser.add_argument('--regex', action='store_true')
+    parser.add_argument('--ignore-case', action='store_true')
+    parser.add_argument('--limit', type=int, default=100, metavar='N')
+    parser.add_argument('pattern')
+    args = parser.parse_args(shlex.split(arg or ''))
+    if args.limit <= 0:
+        raise Error('lj-strfind: the number of matches must be positive')
+    if not args.pattern:
+        raise Error('lj-strfind: the pattern must not be empty')
+    pattern, overlap = strfind_pattern(args.pattern, args.regex,
+                                       args.ignore_case)
+    return dump_strfind(G(L(None)), pattern, overlap, args.limit,
+                        structured)
+
+
+@command('lj-bigstrings')
+def lj_bigstrings(arg, structured):
+    '''
+lj-bigstrings [--json] [<N>]
+
+The command walks all the strings in the interned string table and dumps
+the top <N> (20 by default) of them by their length:
+* Strings: <number of strings>, <total length of the payloads> bytes
+* <length> bytes (<share of the total length>): string <payload> @ <gcr>
+
+Only the first 64 bytes of the payload are dumped. The whole table is
+walked, but the walk can be interrupted via Ctrl-C. The addresses may be
+passed to lj-str, lj-whyalive (to find out what the string is retained
+by), etc.
+    '''
+    parser = ArgumentParser(prog='lj-bigstrings', add_help=False)
+    parser.add_argument('count', type=int, nargs='?', default=20)
+    args = parser.parse_args(shlex.split(arg or ''))
+    if args.count <= 0:
+        raise Error('lj-bigstrings: the number of strings must be positive')
+    return dump_bigstrings(G(L(None)), args.count, structured)
+
+
+def unquote(token):
+    if len(token) >= 2 and token[0] in '"\'' and token[-1] == token[0]:
+        return token[1:-1]
+    return token
+
+
+def parse_tabkey(token):
+    # The quoted key is a string with the escapes the same as lj-str dumps
+    # (e.g. "\310\n"), the rest are parsed the same way as the Lua
+    # literals with the bare words treated as strings.
+    if token != unquote(token):
+        return 'string', codecs.escape_decode(strbytes(unquote(token)))[0]
+    if token in ('true', 'false'):
+        return 'boolean', token == 'true'
+    if token == 'nil':
+        raise Error('lj-tab: nil is not a valid table key')
+    try:
+        number = float(int(token, 0))
+    except ValueError:
+        try:
+            number = float(token)
+        except ValueError:
+            return 'string', strbytes(token)
+    if math.isnan(number):
+        raise Error('lj-tab: NaN is not a valid table key')
+    return 'number', number
+
+
+@command('lj-tab')
+def lj_tab(arg, structured):
+    '''
+lj-tab [--json] [--stats] [<options>] <GCtab *> [key <key>]
+
+The command receives a GCtab address and dumps the table contents:
+* Metatable address whether the one is set
+* Array part <asize> slots:
+  <aslot ptr>: [<index>]: <tv>
+* Hash part <hsize> nodes:
+  <hnode ptr>: { <tv> } => { <tv> }; next = <next hnode ptr>
+
+The following options select the slots to be dumped:
+* --offset <N>: skip the first <N> slots (of the selected ones)
+* --limit <N>: dump at most <N> slots followed by "Next page: --offset
+  <offset of the next page>" if there are more
+* --nonnil: skip the slots with nil values
+* --key-type <type>, --value-type <type>: dump only the slots with the
+  keys or the values of the given type (nil, false, true, light userdata,
+  string, upvalue, thread, proto, function, trace, cdata, table, userdata
+  or number); the keys of the array part are numbers
+* --key-pattern <regex>: dump only the slots with the string keys
+  matching the given regular expression (the first 1024 bytes of the key
+  are matched)
+
+The slots are read by chunks and decoded lazily, so only the part of the
+table needed for the page is read, and the slots before the offset are
+not read at all unless they are filtered.
+
+If the key is given, the slot with the key is looked up the same way as
+the VM does (the string hash is computed for the string keys) and dumped
+instead: the quoted key is a string, the unquoted one is a number, true,
+false or a string otherwise (e.g. key "42", key 42, key foo). The escapes
+(e.g. \\n or \\310) may be used in the quoted keys.
+
+If --stats is given, the health of the table is dumped instead:
+* array part: <non-nil slots>/<asize> (<fill ratio>) slots used
+* hash part: <non-nil nodes>/<hsize> (<fill ratio>) nodes used, load
+  factor <non-nil nodes per node>
+* dead keys: <number of keys with nil values left in the chains>
+* free nodes before rehash: <number of free nodes left for the new keys>
+* longest chain: <length of the longest hash chain>
+* wasted: <size of the nil slots and nodes in bytes>
+* Chain lengths: <length>: <number of chains>, <nodes in them>
+* Key types: <type>: <number of non-nil nodes with such keys>
+    '''
+    types = sorted(set(TVALUE_TYPES.values()))
+    parser = ArgumentParser(prog='lj-tab', add_help=False)
+    parser.add_argument('--stats', action='store_true')
+    parser.add_argument('--offset', type=int, default=0, metavar='N')
+    parser.add_argument('--limit', type=int, metavar='N')
+    parser.add_argument('--nonnil', action='store_true')
+    parser.add_argument('--key-type', type=unquote, choices=types)
+    parser.add_argument('--value-type', type=unquote, choices=types)
+    parser.add_argument('--key-pattern', type=unquote, metavar='REGEX')
+    # The table expression may contain spaces and quotes, so it's the rest
+    # of the arguments with the quotes kept.
+    parser.add_argument('table', nargs=argparse.REMAINDER)
+    lexer = shlex.shlex(arg or '', posix=False)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    try:
+        args = parser.parse_args(list(lexer))
+    except ValueError as e:
+        raise Error('lj-tab: {}'.format(e))
+    if args.offset < 0 or args.limit is not None and args.limit <= 0:
+        raise Error('lj-tab: the offset must be non-negative and the limit '
+                    'must be positive')
+
+    key = None
+    if 'key' in args.table:
+        index = args.table.index('key')
+        if len(args.table) != index + 2:
+            raise Error('lj-tab: exactly one key is expected')
+        key = args.table[index + 1]
+        args.table = args.table[:index]
+    t = parse_arg(' '.join(args.table))
+    if t is None:
+        raise Error('lj-tab: the table address is required')
+
+    if args.stats:
+        return dump_tabstats(t, structured)
+    if key is not None:
+        return dump_tablookup(t, parse_tabkey(key), key, structured)
+    pattern = payload_pattern('lj-tab', args.key_pattern) \
+        if args.key_pattern is not None else None
+    match, parts = slot_matcher(args.key_type, args.value_type, pattern,
+                                args.nonnil)
+    return dump_table(t, structured, args.offset, args.limit, match, parts)
+
+
+@command('lj-tables')
+def lj_tables(arg, structured):
+    '''
+lj-tables [--json] [--worst] [<N>]
+
+The command walks all the tables in the GC heap and dumps the summary of
+their health (see lj-tab --stats):
+* Tables: <number of tables>, <size of the nil slots and nodes> bytes
+  wasted
+* array part: <non-nil slots>/<total slots> (<fill ratio>) slots used
+* hash part: <non-nil nodes>/<total nodes> (<fill ratio>) nodes used
+* dead keys: <number of keys with nil values left in the chains>
+* Chain lengths: <length>: <number of chains>, <nodes in them>
+* Key types: <type>: <number of non-nil nodes with such keys>
+
+If --worst is given, the top <N> (10 by default) tables by the wasted
+bytes and by the longest hash chain are dumped as well:
+* <wasted> bytes wasted, longest chain <length>: <table>, array <used
+  slots>, hash <used nodes>
+
+The tables that are much larger than their contents (e.g. emptied after
+the peak load) or have the long chains (i.e. the slow lookups due to
+the hash collisions) are the first to be checked. The whole heap is
+walked, but the walk can be interrupted via Ctrl-C.
+    '''
+    parser = ArgumentParser(prog='lj-tables', add_help=False)
+    parser.add_argument('--worst', action='store_true')
+    parser.add_argument('count', type=int, nargs='?', default=10)
+    args = parser.parse_args(shlex.split(arg or ''))
+    if args.count <= 0:
+        raise Error('lj-tables: the number of tables must be positive')
+    return dump_tables(G(L(None)), args.count, args.worst, structured)
+
+
+@command('lj-stack')
+def lj_stack(arg, structured):
+    '''
+lj-stack [--json] [<lua_State *>]
+
+The command receives a lua_State address and dumps the given Lua
+coroutine guest stack:
+
+<slot ptr> [<slot attributes>] <VALUE|FRAME>
+
+* <slot ptr>: guest stack slot address
+* <slot attributes>:
+  - S: Bottom of the stack (the slot L->stack points to)
+  - B: Base of the current guest frame (the slot L->base points to)
+  - T: Top of the current guest frame (the slot L->top points to)
+  - M: Last slot of the stack (the slot L->maxstack points to)
+* <VALUE>: see help lj-tv for more info
+* <FRAME>: framelink slot differs from the value slot: it contains info
+  related to the function being executed within this guest frame, its
+  type and link to the parent guest frame
+  [<frame type>] delta=<slots in frame>, <lj-tv for LJ_TFUNC slot>
+  - <frame type>:
+    + L:  VM performs a call as a result of bytecode execution
+    + C:  VM performs a call as a result of lj_vm_call
+    + M:  VM performs a call to a metamethod as a result of bytecode
+          execution
+    + V:  Variable-length frame for storing arguments of a variadic
+          function
+    + CP: Protected C frame
+    + PP: VM performs a call as a result of executinig pcall or xpcall
+
+If L is omitted the main coroutine is used.
+    '''
+    return dump_stack(L(parse_arg(arg)), structured)
+
+
+@command('lj-bt')
+def lj_bt(arg, structured):
+    '''
+lj-bt [--json] [<lua_State *>]
+
+The command receives a lua_State address and dumps the Lua backtrace of
+the given coroutine from the top frame:
+
+#<level> [<frame type>] <chunk>:<line> in <lj-tv for LJ_TFUNC slot>
+          <slot ptr> <local name> = <lj-tv for the slot>
+
+* <frame type>: see help lj-stack for more info
+* <line>: the line the Lua function is suspended at, decoded from the
+  prototype lineinfo ("?" if it is unknown, e.g. for the top frame
+  being executed, or the debug info is stripped)
+* <local name>: the local variables alive at this line, decoded from the
+  prototype varinfo
+
+The lines and locals of every prototype are decoded once per session.
+
+If L is omitted the main coroutine is used.
+    '''
+    return dump_backtrace(L(parse_arg(arg)), structured)
+
+
+@command('lj-coroutines')
+def lj_coroutines(arg, structured):
+    '''
+lj-coroutines [--json] [--all-stacks]
+
+The command walks the GC heap and dumps all the coroutines (i.e.
+lua_State objects) sorted by the size of their stacks:
+
+<lua_State *> <status> [(main, current)]: <stack size> slots (<bytes>
+bytes), <used slots> used, at <chunk>:<line>
+
+* <status>: the one reported by coroutine.status, i.e. running,
+  suspended, normal or dead
+* main: the main coroutine
+* current: the coroutine being executed (i.e. g->cur_L)
+* <chunk>:<line>: location of the top Lua frame (see lj-bt)
+
+If --all-stacks is given, the stack of every coroutine found is dumped
+as well (see lj-stack). The whole heap is walked once, but the walk can
+be interrupted via Ctrl-C.
+    '''
+    parser = ArgumentParser(prog='lj-coroutines', add_help=False)
+    parser.add_argument('--all-stacks', action='store_true')
+    args = parser.parse_args(shlex.split(arg or ''))
+    return dump_coroutines(G(L(None)), args.all_stacks, structured)
+
+
+@command('lj-vm')
+def lj_vm(arg, structured):
+    '''
+lj-vm [--json] [--scan] [--tls <expr>]
+      [<N>|<lua_State *>|<global_State *>|main]
+
+The command dumps the VMs (i.e. global_State instances) found in the
+process and selects the one the rest of the commands are run for:
+
+#<N> global_State @ <g>, main coroutine @ <L>, current @ <g->cur_L>,
+gc.total: <bytes> bytes (<sources>) [selected]
+
+* <sources>: how the VM is found:
+  - symbol <name>: the main coroutine global (e.g. globalL)
+  - thread <id>: the lua_State variable (L) in the frames of the thread
+  - <expr> in thread <id>: the thread-local anchor given via --tls
+  - scan: the GG_State signature found via --scan
+  - user: the address given by the user
+
+If --scan is given, all the readable memory of the process is scanned
+for the GG_State signatures (it takes a while for the huge processes
+and can be interrupted via Ctrl-C). If --tls is given, the expression
+evaluated in every thread (e.g. the thread-local variable) is used as
+the lua_State address since now on. The found VMs are kept for the rest
+of the session.
+
+The VM is selected by its number, the address of its global_State or
+any of its coroutines, or 'main' for the one of the main coroutine found
+via the globals (i.e. the default one). Any other command may be run
+for the particular VM or all of them via the --vm option as well.
+    '''
+    global SELECTED_VM
+    parser = ArgumentParser(prog='lj-vm', add_help=False)
+    parser.add_argument('--scan', action='store_true')
+    parser.add_argument('--tls', action='append', default=[])
+    parser.add_argument('vm', nargs='?')
+    args = parser.parse_args(shlex.split(arg or ''))
+    for expr in args.tls:
+        if expr not in TLS_ANCHORS:
+            TLS_ANCHORS.append(expr)
+    if args.tls:
+        MEMORY.derived.pop('vm_discover', None)
+    if args.vm == 'all':
+        raise Error('lj-vm: use --vm all to run the command for all VMs')
+    if args.vm is not None:
+        SELECTED_VM = vm_resolve(args.vm)[0][1]
+    return dump_vms(args.scan, structured)
+
+
+@command('lj-trace')
+def lj_trace(arg, structured):
+    '''
+lj-trace [--json] [<traceno>|<GCtrace *>]
+
+The command dumps the trace with the given number or address (all the
+traces are listed if it's omitted):
+
+TRACE #<traceno> @ <GCtrace *>: <chunk>:<line>, <N> IR instructions,
+<N> snapshots, link: <link type> [#<linked trace>][, root: #<root trace>]
+mcode @ <machine code>, <size> bytes[, loop @ <loop start>]
+K<NNN>    <type>  <opcode> <value>
+<NNNN> <flags> <type>  <opcode> <operands>
+....          SNAP   #<N> [ <slots> ] pc: <BCIns *>, mcofs: <offset>
+(<exit address>), exits: <count>
+
+* <chunk>:<line>: the location the trace is started at
+* K<NNN>: the constants below REF_BIAS (K001 is REF_NIL), every constant
+  is shown instead of its reference in the operands and the snapshots
+* <flags>: '>' for the guards, '+' for the PHI operands
+* <operands>: the references of the IR instructions (<NNNN>), the
+  constants and the literals (e.g. #<slot> and the mode flags for SLOAD
+  or the function name for CALL*)
+* SNAP: the snapshot taken before the instruction below with the
+  references stored to the stack slots ('----' for the untouched slots,
+  '|' marks the frame slots), the bytecode PC to resume at, the offset of
+  the machine code the exits of this snapshot are looked up by and the
+  number of the exits taken ('linked' if the side trace is attached)
+
+The names of the IR opcodes, types and functions are taken from the
+IROp, IRType and IRCallID enums, so they match the particular build. They
+are resolved once along with the rest of the layout.
+    '''
+    g = G(L(None))
+    arg = (arg or '').strip()
+    if not arg:
+        return dump_traces(g, structured)
+    if arg.isdigit():
+        return dump_trace(trace_by_number(g, int(arg)), structured)
+    return dump_trace(BACKEND.evaluate(arg), structured)
+
+
+@command('lj-state')
+def lj_state(arg, structured):
+    '''
+lj-state [--json]
+The command requires no args and dumps current VM and GC states
+* VM state: <INTERP|C|GC|EXIT|RECORD|OPT|ASM|TRACE>
+* GC state: <PAUSE|PROPAGATE|ATOMIC|SWEEPSTRING|SWEEP|FINALIZE|LAST>
+* JIT state: <IDLE|ACTIVE|RECORD|START|END|ASM|ERR>
+    '''
+    g = G(L(None))
+    if structured:
+        yield {
+            'kind': 'state',
+            'vm': vm_state(g),
+            'gc': gc_state(g),
+            'jit': jit_state(g),
+        }
+        return
+    yield 'VM state: {}'.format(vm_state(g))
+    yield 'GC state: {}'.format(gc_state(g))
+    yield 'JIT state: {}'.format(jit_state(g))
+
+
+@command('lj-gc')
+def lj_gc(arg, structured):
+    '''
+lj-gc [--json] [--time <seconds>] [--objects <N>]
+
+The command dumps current GC stats:
+* total: <total number of allocated bytes in GC area>
+* threshold: <limit when gc step is triggered>
+* debt: <how much GC is behind schedule>
+* estimate: <estimate of memory actually in use>
+* stepmul: <incremental GC step granularity>
+* pause: <pause between successive GC cycles>
+* sweepstr: <sweep position in string table>
+* root: <number of all collectable objects>
+* gray: <number of gray objects>
+* grayagain: <number of objects for atomic traversal>
+* weak: <number of weak tables (to be cleared)>
+* mmudata: <number of udata|cdata to be finalized>
+
+The object lists are walked until the given time (in seconds) or object
+budget is exhausted or the walk is interrupted via Ctrl-C. In this case
+the number of objects in gc.root is extrapolated from gc.total and is
+reported as "~<estimate>", and the lower bound ">= <count> (<reason>)"
+is reported for other lists. NB: gc.root is ordered from the newest
+objects to the oldest, so the estimate is biased towards the recent
+allocations and has no error bound.
+    '''
+    budget = parse_budget('lj-gc', arg)
+    return dump_gc(G(L(None)), budget, structured)
+
+
+@command('lj-heap')
+def lj_heap(arg, structured):
+    '''
+lj-heap [--json] [--time <seconds>] [--objects <N>]
+
+The command dumps the census of the objects in the GC heap. All the
+objects linked to gc.root, gc.mmudata and the string hash chains are
+bucketed by their type (the open upvalues of the coroutines are walked
+with gc.root) and the size of every object is computed following the
+rules the VM uses to free it:
+* <type>: <number of objects>, <total size of the objects in bytes>
+* string hash: <size of the string hash table anchors>
+* other: <the rest of gc.total, e.g. buffers, JIT structures>
+
+The main coroutine size includes the whole GG_State it is allocated
+within.
+
+The heap is walked until the given time (in seconds) or object budget is
+exhausted or the walk is interrupted via Ctrl-C. In this case the string
+hash chains are sampled at random and scaled to g->strnum, and their
+sizes are reported as "~<estimate> (+/-<error>)" with the 95% confidence
+interval. The rest of gc.total is considered to be the objects from
+gc.root with the same type and size distribution as the walked ones and
+is reported as "~<estimate>" with no error bound: gc.root is ordered from
+the newest objects to the oldest, so the walked ones are not a random
+sample and the estimate is biased towards the recent allocations.
+    '''
+    budget = parse_budget('lj-heap', arg)
+    return dump_heap(G(L(None)), budget, structured)
+
+
+@command('lj-retained')
+def lj_retained(arg, structured):
+    '''
+lj-retained [--json] [<N>]
+
+The command builds the graph of the references between the GC objects
+and dumps the top <N> (20 by default) objects by their retained size,
+i.e. the total size of the objects that are reachable only via the given
+one (its own size included):
+* Retained sizes: <reachable objects>, <their size>
+  (unreachable: <objects to be swept>, <their size>)
+* <retained size> bytes (<own size> self), idom <address>: <object>
+
+The <object> is dumped the same way as by lj-tv. <address> is the
+immediate dominator of the object, i.e. the closest object all the paths
+from the GC roots to the given one go through ("GC roots" if there is no
+such object).
+
+The GC roots are the main coroutine, the registry, the base metatables,
+the metamethod names, the traces, the cdata finalizers and the objects
+to be finalized. The weak references are not considered according to the
+weak marks of the tables set by the last GC cycle. The object sizes are
+the same as the ones of lj-heap. The whole heap is walked, but the walk
+can be interrupted via Ctrl-C. The graph is built once per stop and is
+reused by lj-whyalive.
+    '''
+    parser = ArgumentParser(prog='lj-retained', add_help=False)
+    parser.add_argument('count', type=int, nargs='?', default=20)
+    args = parser.parse_args(shlex.split(arg or ''))
+    if args.count <= 0:
+        raise Error('lj-retained: the number of objects must be positive')
+    return dump_retained(G(L(None)), args.count, structured)
+
+
+@command('lj-whyalive')
+def lj_whyalive(arg, structured):
+    '''
+lj-whyalive [--json] <GCobj *>
+
+The command dumps the shortest chain of references from the GC roots to
+the given GC object, i.e. why the object is not collected:
+* Shortest path from GC roots to <object>:
+* <GC root> -> <reference> -> ... -> <reference>
+* <GC root>: <object referenced by the GC root>
+* <reference>: <object referenced via it by the previous one>
+
+If there is no such chain, the object is to be swept by the GC, unless
+it's marked as fixed (e.g. the reserved words):
+* <object> is not reachable from GC roots [(fixed)]
+
+The objects are dumped the same way as by lj-tv. The references are
+labeled the following way:
+* [<key>]: the value of the table slot with the given key (the string
+  keys are quoted)
+* key: the key of the table slot
+* metatable, environment: the metatable or the environment of the object
+* upvalue #<n>: the upvalue of the function (the upvalue object for the
+  Lua functions, that refers to the value)
+* prototype, constant #<n>, chunkname: the prototype of the function and
+  the GC constants of the prototype
+* stack slot #<n>, open upvalue: the references of the coroutine
+
+The GC roots and the weak references are treated the same way as by
+lj-retained. The graph of references is built once per stop (the whole
+heap is walked, but the walk can be interrupted via Ctrl-C), so the next
+queries are answered instantly.
+    '''
+    addr = parse_arg(arg)
+    if addr is None:
+        raise Error('lj-whyalive: the GC object address is required')
+    return dump_whyalive(G(L(None)), addr, structured)
+
+
+@command('lj-classes')
+def lj_classes(arg, structured):
+    '''
+lj-classes [--json] [<N>]
+
+The command groups the tables and the userdata in the heap by their
+metatable and dumps the top <N> (20 by default) groups by their size:
+* Classes: <number of metatables>, <number of objects>, <their size>
+* <number of objects> objects, <their size> bytes: <name> (<type>,
+  metatable @ <address>)
+
+The <name> of the metatable is resolved in the following order:
+* the value of its __name field
+* the path to the metatable from the globals or the registry via the
+  string keys, e.g. _G.app.Conn or registry._LOADED["app.conn"].mt
+* the path to its __index table followed by "(__index)"
+* the list of its string keys, e.g. {__gc, __index, __len}
+
+The paths are searched breadth-first up to 4 levels deep, the tables
+with more than 4096 hash slots are not searched through (except the
+globals and the registry). The whole heap is walked once per stop, but
+the walk can be interrupted via Ctrl-C.
+    '''
+    parser = ArgumentParser(prog='lj-classes', add_help=False)
+    parser.add_argument('count', type=int, nargs='?', default=20)
+    args = parser.parse_args(shlex.split(arg or ''))
+    if args.count <= 0:
+        raise Error('lj-classes: the number of classes must be positive')
+    return dump_classes(G(L(None)), args.count, structured)
+
+
+@command('lj-snapshot')
+def lj_snapshot(arg, structured):
+    '''
+lj-snapshot [--json] <file>
+
+The command saves the heap snapshot to the given file to be compared
+later with lj-snapdiff (e.g. the snapshot of the core file taken hours
+after). The snapshot is the summary of the heap: the number and the size
+of the objects grouped by
+* the type of the object
+* the metatable of the table or userdata, named the same way as by
+  lj-classes
+* the prototype (<chunkname>:<firstline>) of the Lua function, of the
+  prototype itself and of the tables held by the upvalues of the Lua
+  functions
+
+The command dumps the summary of the written snapshot:
+* groups: <number of groups>
+* objects: <number of objects> (<size of objects in bytes>)
+* file size: <size of the snapshot in bytes>
+
+The whole heap is walked once per stop, but the walk can be interrupted
+via Ctrl-C.
+    '''
+    parser = ArgumentParser(prog='lj-snapshot', add_help=False)
+    parser.add_argument('file')
+    args = parser.parse_args(shlex.split(arg or ''))
+    stats = write_snapshot(os.path.expanduser(args.file),
+                           current_snapshot(G(L(None))))
+    if structured:
+        record = {'kind': 'snapshot', 'file': args.file}
+        record.update(stats)
+        yield record
+        return
+    yield 'Heap snapshot: {}'.format(args.file)
+    yield '\tgroups: {}'.format(stats['groups'])
+    yield '\tobjects: {} ({} bytes)'.format(stats['objects'], stats['bytes'])
+    yield '\tfile size: {} bytes'.format(stats['size'])
+
+
+@command('lj-snapdiff')
+def lj_snapdiff(arg, structured):
+    '''
+lj-snapdiff [--json] [--top <N>] <old file> [<new file>]
+
+The command compares the heap snapshots saved by lj-snapshot (the new
+one is the snapshot of the current heap if omitted) and dumps the top
+<N> (20 by default) groups of objects grown either in number or in size,
+largest growth in bytes first:
+* Heap diff: <number of grown groups> groups grown
+* objects: <old number> -> <new number> (<difference>)
+* bytes: <old size> -> <new size> (<difference>)
+* <size difference> bytes, <number difference> objects
+  (<new number> objects, <new size> bytes): <group>
+
+The <group> is the type of objects followed by the metatable and the
+prototype labels if any (see lj-snapshot):
+  <type>[, metatable <label>][, proto <chunkname>:<firstline>]
+    '''
+    parser = ArgumentParser(prog='lj-snapdiff', add_help=False)
+    parser.add_argument('--top', type=int, default=20, metavar='N')
+    parser.add_argument('old')
+    parser.add_argument('new', nargs='?')
+    args = parser.parse_args(shlex.split(arg or ''))
+    if args.top <= 0:
+        raise Error('lj-snapdiff: the number of groups must be positive')
+    old = read_snapshot(os.path.expanduser(args.old))
+    new = read_snapshot(os.path.expanduser(args.new)) if args.new \
+        else current_snapshot(G(L(None)))
+    return dump_snapdiff(old, new, args.top, structured)
+
+
+@command('lj-export')
+def lj_export(arg, structured):
+    '''
+lj-export [--json] <file>
+
+The command exports the Lua heap to the given file in the heap snapshot
+format of Chrome DevTools, so it can be loaded into the Memory panel of
+DevTools (or any other viewer of .heapsnapshot files). The nodes are the
+GC objects with their sizes (the same as the ones of lj-heap) and names:
+* strings are named by their payload (truncated to 128 bytes)
+* tables and userdata are named by their metatable (see lj-classes) or
+  by their type if there is no metatable
+* Lua functions and prototypes are named as <chunkname>:<firstline>
+* the rest of the objects are named by their type
+
+The edges are the references the GC follows: the table slots (named by
+their keys), the upvalues, the metatables, the environments, the stack
+slots, the prototypes and their constants. The weak references are
+omitted. The synthetic "(GC roots)" node refers to the GC roots (see
+lj-retained).
+
+The file is streamed, so only the addresses of the objects are kept in
+memory. The command dumps the summary of the written file:
+* nodes: <number of nodes>
+* edges: <number of edges>
+* strings: <number of strings>
+* file size: <size of the file in bytes>
+
+The whole heap is walked twice, but the walk can be interrupted via
+Ctrl-C.
+    '''
+    parser = ArgumentParser(prog='lj-export', add_help=False)
+    parser.add_argument('file')
+    args = parser.parse_args(shlex.split(arg or ''))
+    stats = write_devtools(os.path.expanduser(args.file), G(L(None)))
+    if structured:
+        record = {'kind': 'export', 'file': args.file}
+        record.update(stats)
+        yield record
+        return
+    yield 'Heap snapshot: {}'.format(args.file)
+    for key in ('nodes', 'edges', 'strings'):
+        yield '\t{}: {}'.format(key, stats[key])
+    yield '\tfile size: {} bytes'.format(stats['size'])
+
+
+@command('lj-cache')
+def lj_cache(arg, structured):
+    '''
+lj-cache [--json] [reset]
+
+The command dumps the statistics of the inferior memory cache shared by
+all the commands:
+* pages: <number of cached pages> (<size of cached pages>)
+* hits: <number of cached pages requested> (<hit rate>)
+* misses: <number of pages read from the inferior memory>
+* reads: <number of inferior memory reads> (<bytes transferred>)
+* invalidated: <how many times the cache was dropped>
+
+The cached pages are dropped when the inferior is resumed. If reset is
+given, the cache is dropped and the statistics are reset.
+    '''
+    arg = (arg or '').strip()
+    if arg == 'reset':
+        MEMORY.invalidate()
+        MEMORY.reset()
+    elif arg:
+        raise Error('lj-cache: unexpected argument {}'.format(arg))
+    elif structured:
+        record = {'kind': 'cache'}
+        record.update(MEMORY.counters())
+        yield record
+    else:
+        yield 'Memory cache:'
+        for stat in MEMORY.stats():
+            yield '\t' + stat
+
+
+@command('lj-minidump')
+def lj_minidump(arg, structured):
+    '''
+lj-minidump [--json] <file>
+
+The command writes the minidump of the Lua heap to the given file. Only
+the memory pages holding the following are dumped:
+* all the GC objects with their array, hash and stack parts
+* GG_State (i.e. global_State, jit_State and the main coroutine)
+* the string hash table and the C type table
+* the machine code of the traces
+
+The pages are compressed, and the build-id and the layout of the LuaJIT
+structures are stored in the file header, so the minidump is read by
+luajit-core.py in place of the whole core file:
+
+  luajit-core.py <file> <command> [<args>]
+
+The command dumps the summary of the written minidump:
+* pages: <number of pages> (<size of pages in bytes>)
+* blocks: <number of compressed blocks>
+* file size: <size of the minidump in bytes>
+    '''
+    parser = ArgumentParser(prog='lj-minidump', add_help=False)
+    parser.add_argument('file')
+    args = parser.parse_args(shlex.split(arg or ''))
+    # The heap is walked in whole, but can be interrupted via Ctrl-C.
+    stats = write_minidump(os.path.expanduser(args.file), G(L(None)),
+                           WalkBudget())
+    if structured:
+        record = {'kind': 'minidump', 'file': args.file}
+        record.update(stats)
+        yield record
+        return
+    yield 'Minidump: {}'.format(args.file)
+    yield '\tpages: {} ({} bytes)'.format(
+        stats['bytes'] // MINIDUMP_PAGE_SIZE, stats['bytes']
+    )
+    yield '\tblocks: {}'.format(stats['blocks'])
+    yield '\tfile size: {} bytes'.format(stats['size'])
+
+
+def parse_options(arg):
+    # --json and --vm are accepted only in front of the arguments, since
+    # the rest of them may be an arbitrary expression (e.g. for lj-tab).
+    structured, vm = False, None
+    while True:
+        match = re.match(r'\s*--json(?:\s+|$)', arg or '')
+        if match:
+            structured = True
+            arg = arg[match.end():]
+            continue
+        match = re.match(r'\s*--vm\s+(\S+)(?:\s+|$)', arg or '')
+        if match:
+            vm = match.group(1)
+            arg = arg[match.end():]
+            continue
+        return structured, vm, arg
+
+
+def run_vms(func, arg, structured, vms):
+    # Run the command for every given VM with the header for each of them
+    # (unless the only one is given).
+    global SELECTED_VM
+    selected = SELECTED_VM
+    try:
+        for number, g in vms:
+            SELECTED_VM = g
+            if len(vms) > 1:
+                if structured:
+                    yield {'kind': 'vm', 'number': number, 'g': strx64(g)}
+                else:
+                    yield 'VM #{}: global_State @ {}'.format(number,
+                                                             strx64(g))
+            try:
+                for line in func(arg, structured):
+                    yield line
+            except Error as e:
+                if len(vms) == 1:
+                    raise
+                yield {'kind': 'error', 'error': str(e)} if structured \
+                    else 'Failed: {}'.format(e)
+    finally:
+        SELECTED_VM = selected
+
+
+def run(name, arg):
+    # Run the command with the given name and yield the chunks of its
+    # output to be written by the frontend. The chunk is yielded when it's
+    # large enough or the output is stalled (e.g. by the heap walk), so the
+    # first lines are shown as soon as possible.
+    structured, vm, arg = parse_options(arg)
+    output = COMMANDS[name](arg, structured) if vm is None \
+        else run_vms(COMMANDS[name], arg, structured, vm_resolve(vm))
+    lines = []
+    flushed = time.time()
+    for line in output:
+        lines.append(json.dumps(line) if structured else line)
+        if len(lines) == CHUNK_SIZE or time.time() - flushed >= FLUSH_PERIOD:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+            flushed = time.time()
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+# }}}
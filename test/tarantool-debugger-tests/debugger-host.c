@@ -0,0 +1,28 @@
+#include "lua.h"
+#include "lauxlib.h"
+#include "lualib.h"
+
+/*
+ * The host application the debugger extensions are tested
+ * against. Unlike the luajit binary, it doesn't run the chunk via
+ * lua_cpcall(), so no light userdata is created and the
+ * lightuserdata segment map is not allocated at all (see
+ * lj_lightud_intern()).
+ */
+
+/* The main coroutine is found by the same name as in luajit.c. */
+lua_State *globalL = NULL;
+
+int main(int argc, char **argv)
+{
+	int status;
+	if (argc != 2)
+		return 1;
+	globalL = luaL_newstate();
+	if (globalL == NULL)
+		return 1;
+	luaL_openlibs(globalL);
+	status = luaL_dofile(globalL, argv[1]);
+	lua_close(globalL);
+	return status;
+}
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# End-to-end tests of the LuaJIT debugger extensions: the host application
+# (see debugger-host.c) is stopped in GDB with luajit-gdb.py loaded, its
+# core file and minidump are dumped, and then the commands are run against
+# both of them via luajit-core.py.
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       os.pardir, os.pardir, 'src')
+LUAJIT_GDB = os.path.join(SRC_DIR, 'luajit-gdb.py')
+LUAJIT_CORE = os.path.join(SRC_DIR, 'luajit-core.py')
+GDB = os.environ.get('GDB') or shutil.which('gdb')
+DEBUGGER_HOST = os.environ.get('DEBUGGER_HOST')
+TIMEOUT = 120
+
+# The host is stopped at the print call below with the coroutine
+# suspended and the loop compiled.
+SCRIPT = '''\
+local t = {key7 = 7, big = {1, 2, 3}, ["'big'"] = 'quoted'}
+io.write(tostring(t), '\\n')
+io.flush()
+local function f(tab, n)
+  local x = tab.key7 + n
+  print(x)
+end
+local co = coroutine.create(function(a)
+  local b = a * 2
+  coroutine.yield(b)
+end)
+coroutine.resume(co, 21)
+local point = setmetatable({x = 1, y = 2}, {__name = 'Point'})
+local blob = string.rep('luajit-', 10000)
+local sum = 0
+for i = 1, 1000 do
+  sum = sum + i
+end
+f(t, 35)
+'''
+
+
+@unittest.skipUnless(GDB and DEBUGGER_HOST,
+                     'gdb or the host application is not found')
+class TestLuajitCore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        # The layout resolved by luajit-gdb.py is cached here to be used
+        # by luajit-core.py.
+        cls.env = dict(os.environ, XDG_CACHE_HOME=cls.tmpdir.name)
+        script = os.path.join(cls.tmpdir.name, 'script.lua')
+        with open(script, 'w') as f:
+            f.write(SCRIPT)
+        cls.core = os.path.join(cls.tmpdir.name, 'host.core')
+        cls.minidump = os.path.join(cls.tmpdir.name, 'host.dmp')
+        output = subprocess.run([
+            GDB, '-batch', '-nx',
+            '-ex', 'set confirm off',
+            '-ex', 'source {}'.format(LUAJIT_GDB),
+            '-ex', 'break lj_cf_print',
+            '-ex', 'run',
+            '-ex', 'gcore {}'.format(cls.core),
+            '-ex', 'lj-minidump {}'.format(cls.minidump),
+            '-ex', 'kill',
+            '--args', DEBUGGER_HOST, script,
+        ], env=cls.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, timeout=TIMEOUT).stdout
+        match = re.search(r'table: (0x[0-9a-f]+)', output)
+        if match is None or not os.path.exists(cls.core) \
+                or not os.path.exists(cls.minidump):
+            cls.tmpdir.cleanup()
+            raise RuntimeError('the host is not dumped:\n' + output)
+        cls.table = match.group(1)
+        # The images the commands are run against.
+        cls.images = [cls.core, cls.minidump]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def run_command(self, image, command, *args):
+        proc = subprocess.run(
+            [sys.executable, LUAJIT_CORE, image, command] + list(args),
+            env=self.env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, timeout=TIMEOUT,
+        )
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        return proc.stdout
+
+    def test_stack(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-stack')
+                self.assertRegex(output,
+                                 r'FRAME: \[\w+\] .*"@.*script\.lua":4')
+                self.assertIn('VALUE: table @ {}'.format(self.table), output)
+                self.assertRegex(output, r' VALUE: number 500500\n')
+                self.assertRegex(output, r'\[S   \] FRAME: dummy L\n$')
+
+    def test_bt(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-bt')
+                self.assertRegex(output, r'\] @.*script\.lua:6 in ')
+                self.assertIn(' tab = table @ {}'.format(self.table), output)
+                self.assertRegex(output, r' n = number 35\n')
+                self.assertRegex(output, r' x = number 42\n')
+
+    def test_bt_json(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-bt', '--json')
+                records = [json.loads(line) for line in output.splitlines()]
+                frames = [record for record in records
+                          if record['kind'] == 'frame'
+                          and record['line'] == 6]
+                self.assertEqual(len(frames), 1)
+                self.assertEqual(frames[0]['func']['firstline'], 4)
+                variables = {
+                    record['name']: record['value'] for record in records
+                    if record['kind'] == 'local'
+                    and record['level'] == frames[0]['level']
+                }
+                self.assertEqual(variables['tab']['type'], 'table')
+                self.assertEqual(int(variables['tab']['addr'], 16),
+                                 int(self.table, 16))
+                self.assertEqual(variables['n'],
+                                 {'type': 'number', 'value': 35})
+                self.assertEqual(variables['x'],
+                                 {'type': 'number', 'value': 42})
+
+    def test_coroutines(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-coroutines',
+                                          '--all-stacks')
+                self.assertIn('Coroutines: 2 coroutines', output)
+                self.assertRegex(output, r'\nCoroutine 0x[0-9a-f]+ running '
+                                         r'\(main, current\): .*script\.lua:6')
+                self.assertRegex(output, r'\nCoroutine 0x[0-9a-f]+ suspended'
+                                         r': .*script\.lua:10')
+                self.assertNotIn('Failed to dump the stack', output)
+                # The stack of the suspended coroutine.
+                self.assertRegex(output, r'FRAME: \[CP\] .*"@.*script\.lua"'
+                                         r':8\n')
+                self.assertRegex(output, r' VALUE: number 21\n')
+
+    def test_tab(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-tab', self.table)
+                self.assertIn('Hash part: 4 nodes', output)
+                self.assertRegex(output, r'{ string "key7" .* } => '
+                                         r'{ number 7 }')
+                self.assertRegex(output, r'{ string "\'big\'" .* } => '
+                                         r'{ string "quoted" .* }')
+
+    def test_tab_key(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-tab', self.table,
+                                          'key', '"key7"')
+                self.assertEqual(len(output.splitlines()), 1)
+                self.assertRegex(output, r'{ string "key7" .* } => '
+                                         r'{ number 7 }')
+                output = self.run_command(image, 'lj-tab', self.table,
+                                          'key', "'big'")
+                self.assertRegex(output, r'{ string "big" .* } => { table @ ')
+                output = self.run_command(image, 'lj-tab', self.table,
+                                          'key', 'key8')
+                self.assertEqual(output, 'Key key8 is not found\n')
+                output = self.run_command(image, 'lj-tab', self.table,
+                                          'key', '"\'big\'"')
+                self.assertRegex(output, r'{ string "\'big\'" .* } => '
+                                         r'{ string "quoted" .* }')
+
+    def test_tab_stats(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-tab', '--stats',
+                                          self.table)
+                self.assertIn('\thash part: 3/4 (75.0%) nodes used', output)
+                self.assertIn('\tdead keys: 0\n', output)
+                self.assertIn('\tstring: 3\n', output)
+
+    def test_tables(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-tables')
+                self.assertRegex(output, r'^Tables: [1-9]\d* tables, \d+ '
+                                         r'bytes wasted\n')
+                self.assertRegex(output, r'\tstring: [1-9]\d*\n')
+
+    def test_gc(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-gc')
+                self.assertRegex(output, r'\troot: [1-9]\d* objects\n')
+                self.assertIn('\tmmudata: 0 objects\n', output)
+
+    def test_heap(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-heap')
+                self.assertRegex(output, r'^Heap census: \d+ objects, '
+                                         r'\d+ bytes \(gc.total: \d+ bytes\)')
+                # The main coroutine and the suspended one.
+                self.assertRegex(output, r'\tthread: 2 objects, \d+ bytes\n')
+                self.assertRegex(output, r'\ttrace: 1 objects, \d+ bytes\n')
+                self.assertRegex(output, r'\tstring hash: \d+ bytes\n')
+
+    def test_heap_budget(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-heap', '--objects', '50')
+                self.assertRegex(output, r'^Heap census: ~\d+ objects')
+                self.assertIn('estimated from 50 objects '
+                              '(object budget exhausted)', output)
+                # gc.root is walked from its newest objects, so no error
+                # bound is reported for the extrapolated values.
+                self.assertRegex(output, r'\ttable: ~\d+ objects, ~\d+ '
+                                         r'bytes\n')
+                output = self.run_command(image, 'lj-gc', '--objects', '50')
+                self.assertRegex(output, r'\troot: ~\d+ objects\n')
+
+    def test_retained(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-retained', '5')
+                self.assertRegex(output, r'^Retained sizes: \d+ reachable '
+                                         r'objects, \d+ bytes')
+                # The blob is held only by the stack of the main coroutine.
+                self.assertRegex(output, r'\t70025 bytes \(70025 self\), '
+                                         r'idom 0x[0-9a-f]+: string '
+                                         r'"luajit-luajit-')
+
+    def test_whyalive(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-whyalive', self.table)
+                # The table is held by the local of the main chunk.
+                self.assertRegex(output, r'\tmain coroutine -> '
+                                         r'stack slot #\d+\n')
+                self.assertIn('table @ {}'.format(self.table), output)
+
+    def test_snapshot(self):
+        snapshot = os.path.join(self.tmpdir.name, 'heap.snapshot')
+        output = self.run_command(self.core, 'lj-snapshot', snapshot)
+        self.assertRegex(output, r'\tobjects: [1-9]\d* \(\d+ bytes\)\n')
+        # The minidump has the same heap as the core file.
+        output = self.run_command(self.minidump, 'lj-snapdiff', snapshot)
+        self.assertRegex(output, r'^Heap diff: 0 groups grown\n')
+
+    def test_classes(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-classes')
+                self.assertRegex(output, r'\t1 objects, \d+ bytes: Point '
+                                         r'\(table, metatable @ 0x')
+
+    def test_export(self):
+        path = os.path.join(self.tmpdir.name, 'host.heapsnapshot')
+        output = self.run_command(self.core, 'lj-export', path)
+        self.assertRegex(output, r'\tnodes: [1-9]\d*\n')
+        with open(path) as f:
+            snapshot = json.load(f)
+        meta = snapshot['snapshot']['meta']
+        self.assertEqual(len(snapshot['nodes']),
+                         snapshot['snapshot']['node_count']
+                         * len(meta['node_fields']))
+        self.assertIn('Point', snapshot['strings'])
+
+    def test_strtab(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-strtab', '3')
+                # All the chains are walked, so no string is missed.
+                match = re.search(r'\tstrnum: (\d+) \((\d+) walked\)\n',
+                                  output)
+                self.assertIsNotNone(match, output)
+                self.assertEqual(match.group(1), match.group(2))
+                self.assertRegex(output, r'\tstrmask: 0x[0-9a-f]+\n')
+                self.assertIn('Longest chains:', output)
+
+    def test_strfind(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-strfind', 'quoted')
+                self.assertRegex(output, r'\t0x[0-9a-f]+: 6 bytes, match at '
+                                         r'0: "quoted"\n')
+                self.assertRegex(output, r'Found: 1 strings')
+                output = self.run_command(image, 'lj-strfind', '--regex',
+                                          '^KEY[0-9]$', '--ignore-case')
+                self.assertIn('"key7"', output)
+
+    def test_bigstrings(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-bigstrings', '1')
+                self.assertRegex(output, r'\t70000 bytes \([\d.]+%\): '
+                                         r'string "luajit-luajit-')
+
+    def test_vm(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-vm')
+                self.assertRegex(output, r'^VMs: 1 found\n\t#0 global_State '
+                                         r'@ 0x[0-9a-f]+, .* \[selected\]\n')
+                output = self.run_command(image, 'lj-gc', '--vm', '0')
+                self.assertRegex(output, r'\troot: [1-9]\d* objects\n')
+
+    def test_trace(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-trace')
+                self.assertRegex(output, r'^Traces: 1\n\tTRACE #1 @ 0x'
+                                         r'[0-9a-f]+: @.*script\.lua:16, ')
+                output = self.run_command(image, 'lj-trace', '1')
+                self.assertIn('\nK001    nil     KPRI\n', output)
+                # The IR starts right after the IR_BASE pseudo instruction.
+                self.assertNotRegex(output, r'\n0000 ')
+                self.assertRegex(output, r'\n0001    int     SLOAD  #\d+ ')
+                self.assertRegex(output, r'\n0\d{3} >  nil     LOOP\n')
+                self.assertRegex(output, r'\n\.{4} +SNAP   #0 ')
+
+    def test_heap_json(self):
+        for image in self.images:
+            with self.subTest(image=os.path.basename(image)):
+                output = self.run_command(image, 'lj-heap', '--json',
+                                          '--objects', '50')
+                records = [json.loads(line) for line in output.splitlines()]
+                self.assertEqual(records[0]['kind'], 'heap')
+                self.assertEqual(records[0]['walked'], 50)
+                types = {record['type']: record for record in records
+                         if record['kind'] == 'heap_type'}
+                # No error bound is reported for the values extrapolated
+                # from gc.root.
+                self.assertTrue(types['table']['estimated'])
+                self.assertIsNone(types['table']['count_error'])
+                output = self.run_command(image, 'lj-gc', '--json')
+                record = json.loads(output)
+                self.assertEqual(record['kind'], 'gc')
+                self.assertFalse(record['root']['estimated'])
+                self.assertGreater(record['root']['count'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
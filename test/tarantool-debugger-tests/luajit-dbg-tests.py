@@ -0,0 +1,694 @@
+#!/usr/bin/env python3
+# Unit tests of the debugger agnostic core of the LuaJIT debugger
+# extensions (see src/luajit_dbg.py) and the minidump reader of
+# luajit-core.py. No process or core file is involved here.
+
+import importlib.util
+import json
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       os.pardir, os.pardir, 'src')
+sys.path.insert(0, SRC_DIR)
+import luajit_dbg  # noqa: E402
+
+spec = importlib.util.spec_from_file_location(
+    'luajit_core', os.path.join(SRC_DIR, 'luajit-core.py')
+)
+luajit_core = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(luajit_core)
+
+PAGE_SIZE = luajit_dbg.MINIDUMP_PAGE_SIZE
+
+GC64 = {'LJ_64': True, 'LJ_GC64': True, 'LJ_DUALNUM': False}
+LJ64 = {'LJ_64': True, 'LJ_GC64': False, 'LJ_DUALNUM': False}
+DUALNUM = {'LJ_64': False, 'LJ_GC64': False, 'LJ_DUALNUM': True}
+
+# The part of the GC64 layout the tests below rely on.
+TYPES = {
+    'GCState':      (0x40, {'lightudseg': [0x30, 8],
+                            'lightudnum': [0x38, 4]}),
+    'global_State': (0x100, {'gc': [0x10, 0x40]}),
+    'lua_State':    (0x60, {'glref': [0x10, 8]}),
+}
+
+
+def new_layout(flags, types=TYPES):
+    layout = luajit_dbg.new_layout(flags)
+    for typestr, (size, fields) in types.items():
+        layout['types'][typestr] = {
+            'size': size, 'fields': dict(fields), 'absent': [],
+        }
+    return layout
+
+
+class PagesBackend(luajit_dbg.Backend):
+    # The memory of the process is the given pages only.
+    debuginfo = False
+
+    def __init__(self, pages, globals_):
+        self.pages = pages
+        self.globals = globals_
+
+    def read_memory(self, addr, size):
+        data = b''
+        for page in range(addr // PAGE_SIZE,
+                          (addr + size - 1) // PAGE_SIZE + 1):
+            if page not in self.pages:
+                raise luajit_dbg.MemoryReadError(
+                    'Cannot access memory at address 0x{:x}'.format(addr)
+                )
+            data += self.pages[page]
+        offset = addr % PAGE_SIZE
+        return data[offset:offset + size]
+
+    def lookup_global(self, name):
+        return self.globals.get(name)
+
+
+class DebugInfoBackend(luajit_dbg.Backend):
+    # The debug info is the given {<type>: (<size>, <fields>)} dict and
+    # the {<enum type>: [[<name>, <value>]]} one.
+
+    def __init__(self, types, enums=None):
+        self.types = types
+        self.enums = enums or {}
+        self.lookups = 0
+
+    def type_size(self, typestr):
+        self.lookups += 1
+        return self.types[typestr][0] if typestr in self.types else None
+
+    def field_layout(self, typestr, field):
+        self.lookups += 1
+        return self.types[typestr][1].get(field)
+
+    def enum_values(self, typestr):
+        self.lookups += 1
+        return self.enums.get(typestr)
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def setUp(self):
+        pages = {page: bytes(bytearray([page]) * PAGE_SIZE)
+                 for page in range(0x10, 0x20)}
+        self.backend = PagesBackend(pages, {})
+        self.reads = []
+        read_memory = self.backend.read_memory
+
+        def counted(addr, size):
+            self.reads.append((addr, size))
+            return read_memory(addr, size)
+
+        self.backend.read_memory = counted
+        self.key = 1
+        self.backend.memory_key = lambda: self.key
+        luajit_dbg.configure(self.backend, new_layout(GC64), None, '<')
+        luajit_dbg.MEMORY.reset()
+
+    def test_pages(self):
+        # The read crossing the page boundary loads both pages at once.
+        self.assertEqual(luajit_dbg.read_memory(0x10ffe, 4),
+                         b'\x10\x10\x11\x11')
+        self.assertEqual(self.reads, [(0x10000, 2 * PAGE_SIZE)])
+        self.assertEqual(luajit_dbg.read_memory(0x11000, 8), b'\x11' * 8)
+        self.assertEqual(len(self.reads), 1)
+        self.assertEqual(luajit_dbg.MEMORY.hits, 1)
+        self.assertEqual(luajit_dbg.MEMORY.misses, 2)
+
+    def test_invalidate(self):
+        luajit_dbg.read_memory(0x10000, 8)
+        # The process is resumed, so the memory is read again.
+        self.key = 2
+        luajit_dbg.read_memory(0x10000, 8)
+        self.assertEqual(len(self.reads), 2)
+        self.assertEqual(luajit_dbg.MEMORY.invalidations, 1)
+
+    def test_readahead(self):
+        for page in range(0x10, 0x14):
+            luajit_dbg.read_memory(page * PAGE_SIZE, 8)
+        # The window grows while the pages are missed sequentially.
+        self.assertEqual([size // PAGE_SIZE for _, size in self.reads],
+                         [1, 2, 3])
+
+    def test_unmapped(self):
+        # The pages read ahead beyond the mapping are not required.
+        for page in range(0x1c, 0x20):
+            luajit_dbg.read_memory(page * PAGE_SIZE, 8)
+        self.assertRaises(luajit_dbg.MemoryReadError,
+                          luajit_dbg.read_memory, 0x20000, 8)
+
+
+class TestLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.dict(os.environ,
+                                  {'XDG_CACHE_HOME': self.tmpdir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.types = {
+            typestr: (0x10, {field: [8 * i, 8] for i, field in
+                             enumerate(fields)})
+            for typestr, fields in luajit_dbg.LAYOUT_TYPES.items()
+        }
+        # The fields of the segmented lightuserdata are absent in the
+        # 32-bit builds.
+        del self.types['GCState'][1]['lightudseg']
+        # IRCallID is absent in the builds with no JIT.
+        self.enums = {'IROp': [['IR_LT', 0], ['IR_GE', 1]],
+                      'IRType': [['IRT_NIL', 0], ['IRT_FALSE', 1]],
+                      'IRFPMathOp': [['IRFPM_FLOOR', 0]],
+                      'TraceLink': [['LJ_TRLINK_NONE', 0]]}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def configure(self, backend, layout):
+        luajit_dbg.configure(backend, layout, '42', '<')
+
+    def test_roundtrip(self):
+        backend = DebugInfoBackend(self.types, self.enums)
+        self.configure(backend, luajit_dbg.new_layout(DUALNUM))
+        self.assertTrue(backend.lookups)
+        layout = luajit_dbg.load_layout('42')
+        self.assertEqual(layout, luajit_dbg.LAYOUT)
+        self.assertEqual(layout['flags'], DUALNUM)
+        self.assertEqual(layout['types']['GCState']['absent'],
+                         ['lightudseg'])
+
+        # The cached layout is complete, so no debug info is needed.
+        backend = DebugInfoBackend(self.types, self.enums)
+        self.configure(backend, layout)
+        self.assertEqual(backend.lookups, 0)
+        self.assertEqual(luajit_dbg.offsetof('GCtab', 'asize'),
+                         8 * luajit_dbg.LAYOUT_TYPES['GCtab'].index('asize'))
+        self.assertEqual(luajit_dbg.sizeof('Node'), 0x10)
+        self.assertFalse(luajit_dbg.has_field('GCState', 'lightudseg'))
+        self.assertRaises(luajit_dbg.Error, luajit_dbg.fieldof, 'GCState',
+                          'lightudseg')
+        self.assertEqual(luajit_dbg.ir_names('IROp'), {0: 'LT', 1: 'GE'})
+        self.assertEqual(luajit_dbg.ir_name('IRCallID', 3), '3')
+
+    def test_absent_type(self):
+        self.configure(DebugInfoBackend(self.types, self.enums),
+                       luajit_dbg.new_layout(DUALNUM))
+        self.assertRaises(luajit_dbg.Error, luajit_dbg.sizeof, 'GCtrace2')
+        self.assertIsNone(luajit_dbg.load_layout('42')['types']['GCtrace2'])
+
+    def test_version(self):
+        layout = luajit_dbg.new_layout(DUALNUM)
+        layout['version'] = luajit_dbg.LAYOUT_VERSION + 1
+        os.makedirs(os.path.dirname(luajit_dbg.layout_cache_path('42')))
+        with open(luajit_dbg.layout_cache_path('42'), 'w') as f:
+            json.dump(layout, f)
+        self.assertIsNone(luajit_dbg.load_layout('42'))
+        self.assertIsNone(luajit_dbg.load_layout('43'))
+
+    def test_no_debuginfo(self):
+        luajit_dbg.configure(PagesBackend({}, {}), new_layout(GC64), None,
+                             '<')
+        self.assertRaises(luajit_dbg.Error, luajit_dbg.sizeof, 'GCtab')
+        self.assertRaises(luajit_dbg.Error, luajit_dbg.has_field, 'GCState',
+                          'root')
+
+
+def tvalue(itype, payload):
+    # Pack the TValue with the given type the same way the VM does.
+    if luajit_dbg.LJ_GC64:
+        return ((itype << 47) | payload) & 0xFFFFFFFFFFFFFFFF
+    return (itype << 32) | payload
+
+
+def number(n):
+    return struct.unpack('<Q', struct.pack('<d', n))[0]
+
+
+class TestTValue(unittest.TestCase):
+
+    def configure(self, flags, pages=None, globals_=None):
+        luajit_dbg.configure(PagesBackend(pages or {}, globals_ or {}),
+                             new_layout(flags), None, '<')
+
+    def dump(self, *u64s):
+        return [luajit_dbg.dump_tvalue(u64) for u64 in u64s]
+
+    def test_gc64(self):
+        self.configure(GC64)
+        LJ_T = luajit_dbg.LJ_T
+        self.assertEqual(self.dump(
+            tvalue(LJ_T['NIL'], 0), tvalue(LJ_T['FALSE'], 0),
+            tvalue(LJ_T['TRUE'], 0), number(0.5),
+            tvalue(LJ_T['UDATA'], 0x7f0000001000),
+        ), [
+            'nil', 'false', 'true', 'number 0.5',
+            'userdata @ 0x7f0000001000',
+        ])
+
+    def test_lj64(self):
+        self.configure(LJ64)
+        LJ_T = luajit_dbg.LJ_T
+        self.assertEqual(self.dump(
+            tvalue(LJ_T['NIL'], 0), tvalue(LJ_T['TRUE'], 0), number(-2.0),
+            tvalue(LJ_T['THREAD'], 0x4000a0),
+        ), ['nil', 'true', 'number -2', 'thread @ 0x4000a0'])
+
+    def test_dualnum(self):
+        self.configure(DUALNUM)
+        self.assertEqual(self.dump(
+            tvalue(luajit_dbg.LJ_TISNUM, 42),
+            tvalue(luajit_dbg.LJ_TISNUM, 0xffffffd6),
+            number(42.0),
+        ), ['integer 42', 'integer -42', 'number 42'])
+
+    def configure_vm(self, segmap, segs):
+        # The main coroutine, its global_State and the segment map are
+        # located on the single page.
+        L, g = 0x10000, 0x10100
+        page = bytearray(PAGE_SIZE)
+        struct.pack_into('<Q', page, L - 0x10000 + 0x10, g)
+        struct.pack_into('<QI', page, g - 0x10000 + 0x10 + 0x30, segmap,
+                         max(len(segs) - 1, 0))
+        if segmap:
+            struct.pack_into('<{}I'.format(len(segs)), page,
+                             segmap - 0x10000, *segs)
+        self.configure(GC64, {0x10: bytes(page)}, {'globalL': L})
+        return g
+
+    def test_lightud(self):
+        self.configure_vm(0x10800, [0x7f12, 0x55aa])
+        seg1 = 1 << luajit_dbg.LJ_LIGHTUD_BITS_LO
+        self.assertEqual(self.dump(
+            tvalue(luajit_dbg.LJ_T['LIGHTUD'], 0x1234),
+            tvalue(luajit_dbg.LJ_T['LIGHTUD'], seg1 | 0x5678),
+        ), [
+            'light userdata @ 0x7f1200001234',
+            'light userdata @ 0x55aa00005678',
+        ])
+        seg2 = 2 << luajit_dbg.LJ_LIGHTUD_BITS_LO
+        self.assertRaises(luajit_dbg.Error, luajit_dbg.dump_tvalue,
+                          tvalue(luajit_dbg.LJ_T['LIGHTUD'], seg2))
+
+    def test_lightud_segmap(self):
+        # The segment map is not allocated until the first light userdata
+        # is created.
+        g = self.configure_vm(0, [])
+        self.assertRaises(luajit_dbg.Error, luajit_dbg.dump_tvalue,
+                          tvalue(luajit_dbg.LJ_T['LIGHTUD'], 0x1234))
+        # The map is not read unless the light userdata is decoded.
+        self.configure(GC64)
+        segmap = luajit_dbg.lightud_segmap(g)
+        self.assertEqual(luajit_dbg.dump_tvalue(number(1.5), segmap),
+                         'number 1.5')
+        self.assertRaises(luajit_dbg.MemoryReadError, luajit_dbg.dump_tvalue,
+                          tvalue(luajit_dbg.LJ_T['LIGHTUD'], 0x1234), segmap)
+
+
+class TestStack(unittest.TestCase):
+
+    def test_frames(self):
+        # The GC64 stack of the coroutine with the single C frame on top of
+        # the sentinel one: [dummy func, sentinel framelink, nil, C func,
+        # C framelink, args...].
+        L, stack = 0x10000, 0x10100
+        types = dict(TYPES, lua_State=(0x60, {
+            'glref': [0x10, 8], 'stack': [0x18, 8], 'maxstack': [0x20, 8],
+            'top': [0x28, 8], 'base': [0x30, 8],
+        }))
+        page = bytearray(PAGE_SIZE)
+        struct.pack_into('<QQQQ', page, 0x18, stack, stack + 8 * 10,
+                         stack + 8 * 7, stack + 8 * 5)
+        cframe = luajit_dbg.FRAME['C'] | 8 * 3
+        slots = [0, luajit_dbg.FRAME['C'] | 8 * 2, 0, 0x4000, cframe, 0, 0]
+        struct.pack_into('<7Q', page, 0x100, *slots)
+        luajit_dbg.configure(PagesBackend({0x10: bytes(page)}, {}),
+                             new_layout(GC64, types), None, '<')
+        base, raw = luajit_dbg.read_stack(L)
+        self.assertEqual(base, stack)
+        # The whole stack with the red zone is read at once.
+        self.assertEqual(len(raw), 10 + 1 + 5 + 2)
+        self.assertEqual(list(luajit_dbg.frames_raw(L, base, raw)), [
+            (4, 7, cframe, 1),
+            (1, 2, slots[1], None),
+        ])
+        self.assertEqual(luajit_dbg.frameraw_func(raw, 4), 0x4000)
+
+
+class TestHeap(unittest.TestCase):
+
+    def setUp(self):
+        types = dict(TYPES, **{
+            'GCRef':     (8, {}),
+            'GCfuncC':   (0x30, {}),
+            'GCfuncL':   (0x28, {}),
+            'GCstr':     (0x18, {}),
+            'GCtab':     (0x40, {}),
+            'GCupval':   (0x28, {}),
+            'Node':      (0x18, {}),
+            'TValue':    (8, {}),
+        })
+        luajit_dbg.configure(PagesBackend({}, {}), new_layout(GC64, types),
+                             None, '<')
+
+    def size(self, gct, **fields):
+        return luajit_dbg.gcobj_size(None, gct, 0, fields, {})
+
+    def test_sizes(self):
+        self.assertEqual(self.size('LJ_TSTR', len=5), 0x18 + 6)
+        self.assertEqual(self.size('LJ_TUPVAL'), 0x28)
+        self.assertEqual(self.size('LJ_TTHREAD', stacksize=10), 0x60 + 80)
+        self.assertEqual(self.size('LJ_TPROTO', sizept=0x123), 0x123)
+        self.assertEqual(self.size('LJ_TFUNC', ffid=0, nupvalues=2),
+                         0x28 + 8)
+        self.assertEqual(self.size('LJ_TFUNC', ffid=1, nupvalues=2),
+                         0x30 + 8)
+
+    def test_table(self):
+        # The empty table.
+        self.assertEqual(self.size('LJ_TTAB', colo=0, asize=0, hmask=0),
+                         0x40)
+        # The separate array part.
+        self.assertEqual(self.size('LJ_TTAB', colo=0, asize=4, hmask=3),
+                         0x40 + 4 * 0x18 + 4 * 8)
+        # The colocated array part and the one that is separated from it
+        # when the table is grown (see lj_tab_resize): the colocated slots
+        # are still accounted, and the high bit of colo is set.
+        self.assertEqual(self.size('LJ_TTAB', colo=4, asize=4, hmask=0),
+                         0x40 + 4 * 8)
+        self.assertEqual(self.size('LJ_TTAB', colo=-124, asize=8, hmask=0),
+                         0x40 + 8 * 8 + 4 * 8)
+
+
+class TestWalkBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = PagesBackend({}, {})
+        luajit_dbg.configure(self.backend, new_layout(GC64), None, '<')
+        self.taken = []
+
+    def walker(self, count):
+        for i in range(count):
+            self.taken.append(i)
+            yield i
+
+    def test_objects(self):
+        budget = luajit_dbg.WalkBudget(objects=3)
+        self.assertEqual(list(budget.walk(self.walker(10))), [0, 1, 2])
+        # No object beyond the budget is taken from the walker.
+        self.assertEqual(self.taken, [0, 1, 2])
+        self.assertEqual(budget.visited, 3)
+        self.assertEqual(budget.stopped, luajit_dbg.STOP_OBJECTS)
+        self.assertEqual(list(budget.walk(self.walker(10))), [])
+
+    def test_complete(self):
+        budget = luajit_dbg.WalkBudget(objects=5)
+        self.assertEqual(list(budget.walk(self.walker(3))), [0, 1, 2])
+        self.assertEqual(budget.visited, 3)
+        self.assertIsNone(budget.stopped)
+
+    def test_share(self):
+        budget = luajit_dbg.WalkBudget(objects=10)
+        nested = budget.share(0.5)
+        self.assertEqual(list(nested.walk(self.walker(10))), list(range(5)))
+        budget.charge(nested)
+        self.assertEqual(budget.visited, 5)
+        self.assertIsNone(budget.stopped)
+
+    def test_interrupted(self):
+        self.backend.interrupted = lambda: True
+        budget = luajit_dbg.WalkBudget()
+        self.assertEqual(list(budget.walk(self.walker(10))), [])
+        self.assertEqual(self.taken, [])
+        self.assertEqual(budget.stopped, luajit_dbg.STOP_INTERRUPTED)
+
+    def test_estimate(self):
+        self.assertEqual(luajit_dbg.dump_estimate(42, None), '42')
+        self.assertEqual(luajit_dbg.dump_estimate(41.6, 0.05),
+                         '~42 (+/-5.0%)')
+        self.assertEqual(luajit_dbg.dump_estimate(41.6, luajit_dbg.NO_BOUND),
+                         '~42')
+        self.assertEqual(luajit_dbg.dump_count(7, None, 'interrupted'),
+                         '>= 7 (interrupted)')
+
+
+def heap_graph(sizes, edges, roots):
+    # Build the object graph with the given references between the
+    # objects numbered in the order of their addresses, bypassing the
+    # heap walk.
+    graph = luajit_dbg.HeapGraph.__new__(luajit_dbg.HeapGraph)
+    graph.count = len(sizes)
+    graph.root = graph.count
+    graph.addrs = list(range(graph.count))
+    graph.sizes = sizes
+    graph.offsets = [0]
+    graph.edges = []
+    for v in range(graph.count):
+        graph.add_edges(w for u, w in edges if u == v)
+    graph.add_edges(roots)
+    graph.reversed = None
+    return graph
+
+
+class TestHeapGraph(unittest.TestCase):
+
+    def setUp(self):
+        # 0 and 1 are the roots both referring to 2, 3 and 4 form the
+        # cycle held by 2 and by the unreachable 5.
+        self.graph = heap_graph(
+            [1, 2, 4, 8, 16, 32],
+            [(0, 2), (1, 2), (2, 3), (3, 4), (4, 3), (5, 4)],
+            [0, 1],
+        )
+
+    def test_dominators(self):
+        idom, order = self.graph.dominators()
+        root = self.graph.root
+        self.assertEqual(list(idom), [root, root, root, 2, 3, -1, root])
+        self.assertEqual(sorted(order), [0, 1, 2, 3, 4, root])
+        self.assertEqual(order[-1], root)
+
+    def test_retained(self):
+        idom, retained, order = self.graph.retained()
+        self.assertEqual(list(retained), [1, 2, 28, 24, 16, 32, 31])
+
+
+class TestHashes(unittest.TestCase):
+    # The expected hashes are the ones calculated by the C functions
+    # on x86_64.
+
+    def setUp(self):
+        luajit_dbg.ENDIAN = '<'
+
+    def test_lua_hash(self):
+        for payload, expected in [
+            (b'', 0),
+            (b'a', 551756350),
+            (b'ab', 1820401365),
+            (b'abc', 1820401365),
+            (b'key7', 549554883),
+            (b'hello', 3569210501),
+            (b'luajit-gdb.py', 1685674706),
+            (b'The quick brown fox jumps over the lazy dog', 3792977697),
+        ]:
+            with self.subTest(payload=payload):
+                self.assertEqual(luajit_dbg.lua_hash(payload), expected)
+                # The signedness of chars matters only for the short
+                # strings with non-ASCII chars.
+                self.assertEqual(luajit_dbg.lua_hash(payload, False),
+                                 expected)
+
+    def test_lua_hash_signedchar(self):
+        self.assertEqual(luajit_dbg.lua_hash(b'\xff'), 4091350049)
+        self.assertEqual(luajit_dbg.lua_hash(b'\xff', False), 1382479320)
+        self.assertEqual(luajit_dbg.lua_hash(b'\xd0\xbf\xd1\x80'),
+                         1387627685)
+
+    def test_lj_fullhash(self):
+        self.assertEqual(luajit_dbg.lj_fullhash(b'luajit-gdb.py'),
+                         1414158994)
+        self.assertEqual(luajit_dbg.lj_fullhash(
+            b'The quick brown fox jumps over the lazy dog'
+        ), 2499328095)
+
+    def test_hashrot(self):
+        for lo, hi, expected in [
+            (0, 0, 0),
+            (1, 0, 4294959105),
+            (0x3ff00000, 0, 1072691202),
+            (0xdeadbeef, 0x7f, 497279679),
+            (0x12345678, 0x9abcdef0, 453872166),
+        ]:
+            with self.subTest(lo=lo, hi=hi):
+                # Both variants give the same result.
+                self.assertEqual(luajit_dbg.hashrot(lo, hi), expected)
+                self.assertEqual(luajit_dbg.hashrot(lo, hi, False),
+                                 expected)
+
+
+class TestParseTabkey(unittest.TestCase):
+
+    def test_strings(self):
+        for token, expected in [
+            ('"key7"', b'key7'),
+            ("'big'", b'big'),
+            ('"42"', b'42'),
+            ('"true"', b'true'),
+            ('foo', b'foo'),
+            (r'"\310\n"', b'\xc8\n'),
+            ('"к"', b'\xd0\xba'),
+        ]:
+            with self.subTest(token=token):
+                self.assertEqual(luajit_dbg.parse_tabkey(token),
+                                 ('string', expected))
+
+    def test_numbers(self):
+        for token, expected in [
+            ('42', 42.0),
+            ('-1', -1.0),
+            ('0x10', 16.0),
+            ('1e3', 1000.0),
+            ('0.5', 0.5),
+            ('inf', float('inf')),
+        ]:
+            with self.subTest(token=token):
+                self.assertEqual(luajit_dbg.parse_tabkey(token),
+                                 ('number', expected))
+
+    def test_booleans(self):
+        self.assertEqual(luajit_dbg.parse_tabkey('true'), ('boolean', True))
+        self.assertEqual(luajit_dbg.parse_tabkey('false'),
+                         ('boolean', False))
+
+    def test_invalid(self):
+        for token in ('nil', 'nan'):
+            with self.subTest(token=token):
+                self.assertRaises(luajit_dbg.Error, luajit_dbg.parse_tabkey,
+                                  token)
+
+
+class TestVMFrames(unittest.TestCase):
+
+    def test_vm_frame(self):
+        for function in ('lj_vm_call', 'lj_BC_FUNCC', 'lj_ff_print',
+                         'lj_vm_pcall(void)', 'lj_vmeta_call'):
+            with self.subTest(function=function):
+                self.assertTrue(luajit_dbg.is_vm_frame(function))
+
+    def test_native_frame(self):
+        # The helpers called with their own native frame.
+        for function in (None, 0x1234, 'main', 'lua_pcall', 'lj_vm_modi',
+                         'lj_vm_foldarith', 'lj_vm_ffi_call'):
+            with self.subTest(function=function):
+                self.assertFalse(luajit_dbg.is_vm_frame(function))
+
+
+class TestPageRuns(unittest.TestCase):
+
+    def runs(self, pages):
+        return [(addr // PAGE_SIZE, size // PAGE_SIZE)
+                for addr, size in luajit_dbg.page_runs(pages)]
+
+    def test_empty(self):
+        self.assertEqual(self.runs([]), [])
+
+    def test_consecutive(self):
+        self.assertEqual(self.runs([1, 2, 3, 5, 6, 10]),
+                         [(1, 3), (5, 2), (10, 1)])
+
+    def test_block_limit(self):
+        limit = luajit_dbg.MINIDUMP_BLOCK_PAGES
+        self.assertEqual(self.runs(range(2 * limit + 2)),
+                         [(0, limit), (limit, limit), (2 * limit, 2)])
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'heap.snapshot')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        groups = {
+            ('table', 'Point', None): [3, 120],
+            ('table', None, 'Lua function <@init.lua:1>'): [1, 64],
+            ('function', None, 'Lua function <@init.lua:1>'): [2, 80],
+            ('string', None, None): [10, 400],
+        }
+        stats = luajit_dbg.write_snapshot(self.path, groups)
+        self.assertEqual(stats['groups'], 4)
+        self.assertEqual(stats['objects'], 16)
+        self.assertEqual(stats['bytes'], 664)
+        self.assertEqual(stats['size'], os.path.getsize(self.path))
+        self.assertEqual(luajit_dbg.read_snapshot(self.path), groups)
+
+    def test_not_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot')
+        self.assertRaises(luajit_dbg.Error, luajit_dbg.read_snapshot,
+                          self.path)
+
+
+class TestMinidump(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'heap.dmp')
+        self.pages = {page: bytes([page]) * PAGE_SIZE
+                      for page in (0x10, 0x12, 0x13, 0x20)}
+        self.layout = luajit_dbg.new_layout({
+            'LJ_64': True, 'LJ_GC64': True, 'LJ_DUALNUM': False,
+        })
+        luajit_dbg.configure(
+            PagesBackend(self.pages, {'globalL': 0x10008}),
+            self.layout, None, '<',
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        # The page 0x11 is not readable, so the rest of its run is dumped
+        # page by page.
+        with mock.patch.object(luajit_dbg, 'minidump_pages',
+                               return_value=[0x10, 0x11, 0x12, 0x13, 0x20]):
+            stats = luajit_dbg.write_minidump(self.path, None, None)
+        self.assertEqual(stats['blocks'], 4)
+        self.assertEqual(stats['bytes'], 4 * PAGE_SIZE)
+        self.assertEqual(stats['size'], os.path.getsize(self.path))
+
+        self.assertTrue(luajit_core.MinidumpFile.detect(self.path))
+        dump = luajit_core.MinidumpFile(self.path)
+        self.assertEqual(dump.header['globals'], {'globalL': 0x10008})
+        self.assertEqual(dump.header['layout'], self.layout)
+        self.assertEqual(dump.regions(), [
+            (0x10000, 0x11000), (0x12000, 0x13000), (0x13000, 0x14000),
+            (0x20000, 0x21000),
+        ])
+        for page, data in self.pages.items():
+            with self.subTest(page=page):
+                self.assertEqual(
+                    dump.read_memory(page * PAGE_SIZE, PAGE_SIZE), data
+                )
+        # The read crossing the block boundary.
+        self.assertEqual(dump.read_memory(0x12ff8, 16),
+                         b'\x12' * 8 + b'\x13' * 8)
+        self.assertRaises(luajit_dbg.MemoryReadError, dump.read_memory,
+                          0x11000, 8)
+
+    def test_not_minidump(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x7fELF')
+        self.assertFalse(luajit_core.MinidumpFile.detect(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)